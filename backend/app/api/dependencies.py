@@ -1,36 +1,43 @@
 from typing import Annotated
 
 import jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jwt.exceptions import InvalidTokenError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import SessionLocal
-from app.models import User
-from app.schemas import TokenData
+from app.db import get_sessionmaker
+from app.profiling import profile_timer
+from app.replicas import read_session, record_write
+from app.schemas import TokenData, User
 from app.services import UserService
 from app.settings import Settings, get_settings
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
 
-def get_session():
-    session = SessionLocal()
-    try:
+async def get_session():
+    async with get_sessionmaker()() as session:
         yield session
-    finally:
-        session.close()
 
 
-SessionDep = Annotated[Session, Depends(get_session)]
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
 TokenDep = Annotated[str, Depends(oauth2_scheme)]
 SettingsDep = Annotated[Settings, Depends(get_settings)]
 
 
 async def get_current_user(
-    session: SessionDep, token: TokenDep, settings: SettingsDep
+    request: Request, session: SessionDep, token: TokenDep, settings: SettingsDep
 ) -> User:
+    with profile_timer("auth_time"):
+        user = await _authenticate(session, token, settings)
+    if request.method not in ("GET", "HEAD", "OPTIONS"):
+        # Routes share the request's session, so this takes effect if they commit
+        await record_write(session, user.id)
+    return user
+
+
+async def _authenticate(session: AsyncSession, token: str, settings: Settings) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -46,7 +53,7 @@ async def get_current_user(
         token_data = TokenData(username=username)
     except InvalidTokenError:
         raise credentials_exception
-    user = UserService(session=session).get_user_by_username(
+    user = await UserService(session=session).get_principal(
         username=token_data.username
     )
     if user is None:
@@ -66,3 +73,12 @@ async def get_current_active_user(
 
 
 CurrentActiveUserDep = Annotated[User, Depends(get_current_active_user)]
+
+
+async def get_read_session(current_user: CurrentUserDep):
+    async with read_session(current_user.id) as session:
+        yield session
+
+
+# For read-only routes, which may be served from a replica
+ReadSessionDep = Annotated[AsyncSession, Depends(get_read_session)]
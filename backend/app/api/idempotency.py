@@ -0,0 +1,116 @@
+import hashlib
+from typing import Annotated, Any, Awaitable, Callable, Optional
+
+from fastapi import Depends, Header, HTTPException, Request, Response
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.api.dependencies import CurrentActiveUserDep, SessionDep, SettingsDep
+from app.api.responses import get_adapter
+from app.replicas import record_write
+from app.services.idempotency import IdempotencyService
+
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+class IdempotentRequest:
+    """Runs a write once per Idempotency-Key, replaying its response to retries.
+
+    Keys belong to the user who sends them. Without the header the write
+    simply runs.
+    """
+
+    def __init__(
+        self,
+        request: Request,
+        session: AsyncSession,
+        service: IdempotencyService,
+        user_id: int,
+        key: Optional[str],
+        ttl: float,
+        wait: float,
+    ):
+        self.request = request
+        self.session = session
+        self.service = service
+        self.user_id = user_id
+        self.key = key
+        self.ttl = ttl
+        self.wait = wait
+
+    async def run(
+        self, data: BaseModel, model: Any, write: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """Run `write` and return its result as `model`.
+
+        `write` must commit what it writes, and raise only if it wrote nothing.
+        """
+        if self.key is None:
+            return await write()
+        fingerprint = hashlib.sha256(
+            f"{self.request.method} {self.request.url.path}\n".encode()
+            + data.model_dump_json().encode()
+        ).digest()
+        earlier = await self.service.claim(
+            user_id=self.user_id,
+            key=self.key,
+            fingerprint=fingerprint,
+            ttl=self.ttl,
+            wait=self.wait,
+        )
+        if earlier is not None:
+            if earlier.fingerprint != fingerprint:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Idempotency-Key was already used for a different request",
+                )
+            if earlier.response is None:
+                raise HTTPException(
+                    status_code=409,
+                    detail="A request with this Idempotency-Key is still in progress",
+                )
+            return Response(
+                content=earlier.response,
+                status_code=earlier.status_code or 200,
+                media_type="application/json",
+                headers={REPLAYED_HEADER: "true"},
+            )
+        # Waiting on an earlier claim rolled back the write announced on login
+        await record_write(self.session, self.user_id)
+        try:
+            result = await write()
+        except Exception:
+            # The write didn't happen, so a retry should run it again
+            await self.service.release(user_id=self.user_id, key=self.key)
+            raise
+        adapter = get_adapter(model)
+        content = adapter.dump_json(
+            adapter.validate_python(result, from_attributes=True)
+        )
+        await self.service.save_response(
+            user_id=self.user_id, key=self.key, status_code=200, response=content
+        )
+        return Response(content=content, media_type="application/json")
+
+
+async def get_idempotent_request(
+    request: Request,
+    session: SessionDep,
+    settings: SettingsDep,
+    current_user: CurrentActiveUserDep,
+    idempotency_key: Annotated[
+        Optional[str], Header(alias="Idempotency-Key", min_length=1, max_length=255)
+    ] = None,
+) -> IdempotentRequest:
+    return IdempotentRequest(
+        request=request,
+        session=session,
+        service=IdempotencyService(session=session),
+        user_id=current_user.id,
+        key=idempotency_key,
+        ttl=settings.IDEMPOTENCY_KEY_TTL_SECONDS,
+        wait=settings.IDEMPOTENCY_WAIT_SECONDS,
+    )
+
+
+IdempotencyDep = Annotated[IdempotentRequest, Depends(get_idempotent_request)]
@@ -1,9 +1,20 @@
 from fastapi import APIRouter
 
-from app.api.routers import books, loans, login, users
+from app.api.routers import (
+    books,
+    feed,
+    loans,
+    login,
+    metrics,
+    monitoring,
+    users,
+)
 
 api_router = APIRouter()
 api_router.include_router(login.router)
 api_router.include_router(users.router)
 api_router.include_router(books.router)
 api_router.include_router(loans.router)
+api_router.include_router(feed.router)
+api_router.include_router(monitoring.router)
+api_router.include_router(metrics.router)
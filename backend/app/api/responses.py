@@ -0,0 +1,59 @@
+from functools import lru_cache
+from typing import Any, AsyncIterable, Optional, Sequence
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+
+from app.settings import get_settings
+
+
+@lru_cache
+def get_adapter(model: Any) -> TypeAdapter:
+    """One compiled validator and serializer per response type."""
+    return TypeAdapter(model)
+
+
+def render(content: Any, model: Any, response: Optional[Response] = None) -> Any:
+    """Serialize `content` straight to JSON bytes when FAST_JSON_RESPONSES is on.
+
+    This skips FastAPI's response_model pass, which builds the whole response as
+    Python dicts before json.dumps walks it again. Otherwise `content` is
+    returned unchanged for the route's response_model to handle.
+    """
+    if not get_settings().FAST_JSON_RESPONSES:
+        return content
+    adapter = get_adapter(model)
+    # Returning a Response bypasses FastAPI, so carry over headers set on `response`
+    return Response(
+        content=adapter.dump_json(
+            adapter.validate_python(content, from_attributes=True)
+        ),
+        media_type="application/json",
+        headers=dict(response.headers) if response else None,
+    )
+
+
+async def iter_json_array(
+    chunks: AsyncIterable[Sequence[Any]], model: Any
+) -> AsyncIterable[bytes]:
+    """Encode each chunk of items in one call and join them into a JSON array."""
+    adapter = get_adapter(list[model])
+    yield b"["
+    first = True
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        # Drop the chunk's own brackets so the pieces join into one array
+        body = adapter.dump_json(chunk)[1:-1]
+        yield body if first else b"," + body
+        first = False
+    yield b"]"
+
+
+def stream_json_array(
+    chunks: AsyncIterable[Sequence[Any]], model: Any
+) -> StreamingResponse:
+    return StreamingResponse(
+        iter_json_array(chunks, model), media_type="application/json"
+    )
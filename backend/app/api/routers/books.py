@@ -1,37 +1,147 @@
-from fastapi import APIRouter, HTTPException
+from typing import Annotated, Any, Iterable, Optional
+
+from fastapi import APIRouter, HTTPException, Query, Request, Response
 
 from app import schemas
-from app.api.dependencies import CurrentActiveUserDep, SessionDep
+from app.api.dependencies import (
+    CurrentActiveUserDep,
+    ReadSessionDep,
+    SessionDep,
+    SettingsDep,
+)
+from app.api.etags import digest, etag_matches, make_etag, not_modified
+from app.api.idempotency import IdempotencyDep
+from app.api.responses import render, stream_json_array
+from app.bulk import ImportFormat, iter_records
+from app.db import get_sessionmaker
 from app.models import Role
+from app.profiling import ProfiledRoute
 from app.services import BookService
 
-router = APIRouter(prefix="/books", tags=["books"])
+router = APIRouter(prefix="/books", tags=["books"], route_class=ProfiledRoute)
+
+
+def _page_etag(books: Iterable[Any], next_cursor: Optional[str]) -> str:
+    # Every change to a book bumps its version, so this changes with the page
+    return make_etag(
+        "books", digest(next_cursor, *((book.id, book.version) for book in books))
+    )
+
+
+@router.get("/", response_model=schemas.Page[schemas.Book])
+async def get_books(
+    query: Annotated[schemas.BookQuery, Query()],
+    request: Request,
+    response: Response,
+    session: ReadSessionDep,
+    _: CurrentActiveUserDep,
+):
+    book_service = BookService(session=session)
+    if request.headers.get("if-none-match"):
+        # Ids and versions are enough to tell whether the client's copy is current
+        versions, next_cursor = await book_service.get_book_versions(query=query)
+        etag = _page_etag(versions, next_cursor)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+    books, next_cursor = await book_service.get_books(query=query)
+    response.headers["ETag"] = _page_etag(books, next_cursor)
+    return render(
+        {"items": books, "next_cursor": next_cursor},
+        schemas.Page[schemas.Book],
+        response,
+    )
+
 
+@router.get("/export", response_model=list[schemas.Book])
+async def export_books(settings: SettingsDep, current_user: CurrentActiveUserDep):
+    if current_user.role != Role.ADMIN:
+        raise HTTPException(status_code=403, detail="User not allowed to export books")
 
-@router.get("/", response_model=list[schemas.Book])
-def get_books(session: SessionDep, _: CurrentActiveUserDep):
-    return BookService(session=session).get_books()
+    async def chunks():
+        # The request's session is closed before the body streams, so use our own
+        async with get_sessionmaker()() as session:
+            async for chunk in BookService(session=session).iter_books(
+                chunk_size=settings.EXPORT_CHUNK_SIZE
+            ):
+                yield chunk
+
+    return stream_json_array(chunks(), schemas.Book)
+
+
+@router.get("/search", response_model=list[schemas.Book])
+async def search_books(
+    query: Annotated[schemas.BookSearchQuery, Query()],
+    session: ReadSessionDep,
+    _: CurrentActiveUserDep,
+):
+    books = await BookService(session=session).search_books(query=query)
+    return render(books, list[schemas.Book])
 
 
 @router.get("/{id}", response_model=schemas.Book)
-def get_book_by_id(id: int, session: SessionDep, _: CurrentActiveUserDep):
-    book = BookService(session=session).get_book_by_id(id=id)
+async def get_book_by_id(
+    id: int,
+    request: Request,
+    response: Response,
+    session: ReadSessionDep,
+    _: CurrentActiveUserDep,
+):
+    book_service = BookService(session=session)
+    if request.headers.get("if-none-match"):
+        version = await book_service.get_book_version(id=id)
+        if version is not None and etag_matches(
+            request, make_etag("book", id, version)
+        ):
+            return not_modified(make_etag("book", id, version))
+    book = await book_service.get_book_by_id(id=id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
-    return book
+    response.headers["ETag"] = make_etag("book", book.id, book.version)
+    return render(book, schemas.Book, response)
 
 
 @router.post("/", response_model=schemas.Book)
-def create_book(
-    data: schemas.BookCreate, session: SessionDep, current_user: CurrentActiveUserDep
+async def create_book(
+    data: schemas.BookCreate,
+    session: SessionDep,
+    current_user: CurrentActiveUserDep,
+    idempotency: IdempotencyDep,
 ):
     # TODO: Consider whether it would be better to instantiate
     # services with the user and apply permissions at the service level
     if current_user.role != Role.ADMIN:
         raise HTTPException(status_code=403, detail="User not allowed to create books")
-    return BookService(session=session).create_book(data=data)
+    return await idempotency.run(
+        data, schemas.Book, lambda: BookService(session=session).create_book(data=data)
+    )
 
 
 @router.patch("/", response_model=schemas.Book)
-def update_book(data: schemas.BookUpdate, session: SessionDep, _: CurrentActiveUserDep):
-    return BookService(session=session).update_book(data=data)
+async def update_book(
+    data: schemas.BookUpdate, session: SessionDep, _: CurrentActiveUserDep
+):
+    return await BookService(session=session).update_book(data=data)
+
+
+@router.post("/import", response_model=schemas.BookImportReport)
+async def import_books(
+    request: Request,
+    session: SessionDep,
+    settings: SettingsDep,
+    current_user: CurrentActiveUserDep,
+):
+    if current_user.role != Role.ADMIN:
+        raise HTTPException(status_code=403, detail="User not allowed to create books")
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    try:
+        format = ImportFormat(content_type)
+    except ValueError:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Expected one of: {', '.join(f.value for f in ImportFormat)}",
+        )
+    # The body is parsed as it arrives rather than buffered
+    records = iter_records(format, request.stream())
+    return await BookService(session=session).import_books(
+        records=records, batch_size=settings.IMPORT_BATCH_SIZE
+    )
@@ -0,0 +1,48 @@
+from typing import Annotated, Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from app.api.dependencies import CurrentActiveUserDep, SessionDep, SettingsDep
+from app.feed import get_availability_feed
+from app.profiling import ProfiledRoute
+
+router = APIRouter(prefix="/feed", tags=["feed"], route_class=ProfiledRoute)
+
+# Seconds to wait for this worker's listener to connect
+LISTENER_TIMEOUT = 5
+
+
+@router.get("/availability", response_class=StreamingResponse)
+async def availability_feed(
+    session: SessionDep,
+    settings: SettingsDep,
+    _: CurrentActiveUserDep,
+    after: Annotated[Optional[str], Query(max_length=64)] = None,
+    last_event_id: Annotated[Optional[str], Header(max_length=64)] = None,
+):
+    """Server-Sent Events for every change to books' available copies.
+
+    Reconnect with the last event's id as Last-Event-ID, or pass it as
+    `after`, to get only what came since. A 'reset' event means events were
+    lost: refetch, then carry on.
+    """
+    if not settings.AVAILABILITY_FEED:
+        raise HTTPException(status_code=404, detail="Availability feed is disabled")
+    # The stream can stay open for hours; don't hold a pooled connection for it
+    await session.close()
+    feed = get_availability_feed()
+    if not await feed.start(timeout=LISTENER_TIMEOUT):
+        raise HTTPException(
+            status_code=503,
+            detail="Availability feed is unavailable, try again shortly",
+            headers={"Retry-After": "5"},
+        )
+    # A reconnecting EventSource repeats the URL, so its Last-Event-ID is newer
+    resume_from = last_event_id if last_event_id is not None else after
+    return StreamingResponse(
+        feed.stream(after=resume_from),
+        media_type="text/event-stream",
+        # Proxies must pass events through as they come
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
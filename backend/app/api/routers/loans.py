@@ -1,63 +1,130 @@
-from fastapi import APIRouter, HTTPException
+from typing import Annotated
+
+from fastapi import APIRouter, HTTPException, Query
 
 from app import schemas
-from app.api.dependencies import CurrentActiveUserDep, SessionDep
-from app.models import Role
-from app.services import BookService, LoanService, UserService
+from app.api.dependencies import CurrentActiveUserDep, ReadSessionDep, SessionDep
+from app.api.idempotency import IdempotencyDep
+from app.models import Loan, Role
+from app.profiling import ProfiledRoute
+from app.services import (
+    LoanHistoryService,
+    LoanService,
+    OverdueService,
+)
+from app.services.loan import LoanError
+
+router = APIRouter(prefix="/loans", tags=["loans"], route_class=ProfiledRoute)
+
+
+@router.get("/overdue", response_model=schemas.Page[schemas.OverdueNotice])
+async def get_overdue_loans(
+    query: Annotated[schemas.OverdueQuery, Query()],
+    session: SessionDep,
+    current_user: CurrentActiveUserDep,
+):
+    if current_user.role != Role.ADMIN:
+        raise HTTPException(
+            status_code=403, detail="User not allowed to view overdue loans"
+        )
+    notices, next_cursor = await OverdueService(session=session).get_notices(
+        query=query
+    )
+    return {"items": notices, "next_cursor": next_cursor}
 
-router = APIRouter(prefix="/loans", tags=["loans"])
+
+@router.get("/history", response_model=schemas.Page[schemas.Loan])
+async def get_loan_history(
+    query: Annotated[schemas.LoanHistoryQuery, Query()],
+    session: ReadSessionDep,
+    current_user: CurrentActiveUserDep,
+):
+    if current_user.role != Role.ADMIN:
+        # Readers see their own history only
+        if query.user_id not in (None, current_user.id):
+            raise HTTPException(
+                status_code=403, detail="User not allowed to view others' loans"
+            )
+        query.user_id = current_user.id
+    loans, next_cursor = await LoanHistoryService(session=session).get_history(
+        query=query
+    )
+    return {"items": loans, "next_cursor": next_cursor}
 
 
 @router.post("/", response_model=schemas.Loan)
-def create_loan(
-    data: schemas.LoanCreate, session: SessionDep, current_user: CurrentActiveUserDep
+async def create_loan(
+    data: schemas.LoanCreate,
+    session: SessionDep,
+    current_user: CurrentActiveUserDep,
+    idempotency: IdempotencyDep,
 ):
-    # TODO: Consider whether this validation would be better done in the service
-    book_service = BookService(session=session)
-    book = book_service.get_book_by_id(id=data.book_id)
-    if not book:
-        raise HTTPException(status_code=404, detail="Book not found")
-    if book.available_copies < 1:
-        raise HTTPException(status_code=400, detail="No available copies")
     # Users should be able to self-serve or admins should be able to create loans for users
     if current_user.id != data.user_id and current_user.role != Role.ADMIN:
         raise HTTPException(
             status_code=403,
             detail="Only admins can create loans on behalf of other readers",
         )
-    # TODO: Improve loan creation and update of book record to ensure the two stay in sync.
-    # Currently we commit loan changes and update the book after.
-    # Same thinking applies to functionality like updating the 'borrowed_books' field on the User model.
-    loan = LoanService(session=session).create_loan(data=data)
-    book_service.update_book(
-        data=schemas.BookUpdate(id=book.id, available_copies=book.available_copies - 1)
-    )
-    user_service = UserService(session=session, current_user=current_user)
-    user = user_service.get_user_by_id(id=data.user_id)
-    if user:
-        # FIXME: Pydantic/SQLALchemy model confusion here needs fixing.
-        user_service.update_user(
-            data=schemas.UserUpdate(
-                id=user.id, borrowed_books=[*user.borrowed_books, book]
-            )
-        )
-    return loan
+
+    async def checkout() -> Loan:
+        result = await LoanService(session=session).checkout(data=data)
+        if isinstance(result, LoanError):
+            # A missing book or reader is a 404, like the batch's per-item errors
+            status_code = 400 if result == LoanError.NO_AVAILABLE_COPIES else 404
+            raise HTTPException(status_code=status_code, detail=result)
+        return result
+
+    return await idempotency.run(data, schemas.Loan, checkout)
 
 
 @router.patch("/", response_model=schemas.Loan)
-def update_loan(data: schemas.LoanUpdate, session: SessionDep, _: CurrentActiveUserDep):
-    loan = LoanService(session=session).update_loan(data=data)
+async def update_loan(
+    data: schemas.LoanUpdate, session: SessionDep, _: CurrentActiveUserDep
+):
+    loan_service = LoanService(session=session)
+    loan = await loan_service.return_loan(data=data)
     if not loan:
-        raise HTTPException(status_code=404, detail="Loan not found")
-    book_service = BookService(session=session)
-    book = book_service.get_book_by_id(id=loan.book_id)
-    # If we have updated the loan then we shouldn't need to check if the book exists.
-    # This needs refactoring.
-    if book:
-        book_service.update_book(
-            data=schemas.BookUpdate(
-                id=book.id, available_copies=book.available_copies + 1
-            )
-        )
-    # TODO: Update borrowed_books field on User model when book is returned.
+        found = await loan_service.get_loan_by_id(id=data.id) is not None
+        if not found and not await loan_service.is_archived(id=data.id):
+            raise HTTPException(status_code=404, detail="Loan not found")
+        raise HTTPException(status_code=400, detail="Loan already returned")
     return loan
+
+
+def _batch_item(result: Loan | str) -> dict:
+    if isinstance(result, Loan):
+        return {"loan": result}
+    return {"error": result}
+
+
+@router.post("/batch", response_model=schemas.LoanBatchResult)
+async def create_loans(
+    data: schemas.LoanBatchCreate,
+    session: SessionDep,
+    current_user: CurrentActiveUserDep,
+):
+    def allowed(item: schemas.LoanCreate) -> bool:
+        return current_user.role == Role.ADMIN or item.user_id == current_user.id
+
+    permitted = [item for item in data.loans if allowed(item)]
+    checkouts = iter(
+        await LoanService(session=session).checkout_many(data=permitted)
+        if permitted
+        else []
+    )
+    return {
+        "results": [
+            _batch_item(next(checkouts))
+            if allowed(item)
+            else {"error": "Only admins can create loans on behalf of other readers"}
+            for item in data.loans
+        ]
+    }
+
+
+@router.patch("/batch", response_model=schemas.LoanBatchResult)
+async def update_loans(
+    data: schemas.LoanBatchUpdate, session: SessionDep, _: CurrentActiveUserDep
+):
+    results = await LoanService(session=session).return_many(data=data.loans)
+    return {"results": [_batch_item(result) for result in results]}
@@ -5,11 +5,13 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 
 from app.api.dependencies import SessionDep, SettingsDep
+from app.metrics import LOGINS
+from app.profiling import ProfiledRoute
 from app.schemas import Token
 from app.security import create_access_token
 from app.services.user import UserService
 
-router = APIRouter(prefix="/login", tags=["login"])
+router = APIRouter(prefix="/login", tags=["login"], route_class=ProfiledRoute)
 
 
 @router.post("/")
@@ -18,15 +20,17 @@ async def login(
     settings: SettingsDep,
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
 ) -> Token:
-    user = UserService(session=session).authenticate_user(
+    user = await UserService(session=session).authenticate_user(
         username=form_data.username, password=form_data.password
     )
     if not user:
+        LOGINS.inc("failure")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    LOGINS.inc("success")
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
@@ -0,0 +1,30 @@
+from datetime import datetime
+from secrets import compare_digest
+from typing import Annotated, Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from app.api.dependencies import SessionDep, SettingsDep
+from app.metrics import CONTENT_TYPE, LOANS_OPEN, REGISTRY
+from app.profiling import ProfiledRoute
+from app.services import LoanService
+
+router = APIRouter(tags=["monitoring"], route_class=ProfiledRoute)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(
+    session: SessionDep,
+    settings: SettingsDep,
+    authorization: Annotated[Optional[str], Header()] = None,
+) -> PlainTextResponse:
+    # Scrapers can't log in, so this takes a static token instead of a user's
+    if settings.METRICS_TOKEN and not compare_digest(
+        (authorization or "").encode(), f"Bearer {settings.METRICS_TOKEN}".encode()
+    ):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    counts = await LoanService(session=session).get_open_loan_counts(now=datetime.now())
+    LOANS_OPEN.set(counts.overdue, "true")
+    LOANS_OPEN.set(counts.open - counts.overdue, "false")
+    return PlainTextResponse(REGISTRY.exposition(), media_type=CONTENT_TYPE)
@@ -0,0 +1,33 @@
+from fastapi import APIRouter, HTTPException
+
+from app.api.dependencies import CurrentActiveUserDep
+from app.db import get_pool_status
+from app.models import Role
+from app.profiling import ProfiledRoute
+from app.services.book import get_book_cache
+from app.services.user import get_principal_cache
+
+router = APIRouter(prefix="/monitoring", tags=["monitoring"], route_class=ProfiledRoute)
+
+
+@router.get("/pool")
+async def get_pool(current_user: CurrentActiveUserDep) -> dict[str, int | float]:
+    if current_user.role != Role.ADMIN:
+        raise HTTPException(
+            status_code=403, detail="User not allowed to view monitoring"
+        )
+    return get_pool_status()
+
+
+@router.get("/caches")
+async def get_caches(
+    current_user: CurrentActiveUserDep,
+) -> dict[str, dict[str, int | float]]:
+    if current_user.role != Role.ADMIN:
+        raise HTTPException(
+            status_code=403, detail="User not allowed to view monitoring"
+        )
+    return {
+        "books": get_book_cache().stats(),
+        "principals": get_principal_cache().stats(),
+    }
@@ -1,20 +1,48 @@
-from fastapi import APIRouter, HTTPException
+from typing import Annotated
+
+from fastapi import APIRouter, HTTPException, Query
 
 from app import schemas
-from app.api.dependencies import CurrentActiveUserDep, SessionDep
+from app.api.dependencies import CurrentActiveUserDep, ReadSessionDep, SessionDep
+from app.api.responses import render
+from app.models import Role
+from app.profiling import ProfiledRoute
 from app.services import UserService
 
-router = APIRouter(prefix="/users", tags=["users"])
+router = APIRouter(prefix="/users", tags=["users"], route_class=ProfiledRoute)
 
 
-@router.get("/", response_model=list[schemas.User])
-def get_users(session: SessionDep, current_user: CurrentActiveUserDep):
-    return UserService(session=session, current_user=current_user).get_users()
+@router.get("/", response_model=schemas.Page[schemas.User])
+async def get_users(
+    query: Annotated[schemas.UserQuery, Query()],
+    session: ReadSessionDep,
+    current_user: CurrentActiveUserDep,
+):
+    user_service = UserService(session=session, current_user=current_user)
+    users, next_cursor = await user_service.get_users(query=query)
+    return render(
+        {"items": users, "next_cursor": next_cursor}, schemas.Page[schemas.User]
+    )
 
 
 @router.get("/{id}", response_model=schemas.UserDetail)
-def get_user_by_id(id: int, session: SessionDep, current_user: CurrentActiveUserDep):
-    user = UserService(session=session, current_user=current_user).get_user_by_id(id=id)
+async def get_user_by_id(
+    id: int, session: ReadSessionDep, current_user: CurrentActiveUserDep
+):
+    user_service = UserService(session=session, current_user=current_user)
+    user = await user_service.get_user_by_id(id=id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return render(user, schemas.UserDetail)
+
+
+@router.post("/{id}/deactivate", response_model=schemas.User)
+async def deactivate_user(
+    id: int, session: SessionDep, current_user: CurrentActiveUserDep
+):
+    if current_user.role != Role.ADMIN:
+        raise HTTPException(status_code=403, detail="Only admins can deactivate users")
+    user = await UserService(session=session).deactivate_user(id=id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
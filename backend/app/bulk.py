@@ -0,0 +1,137 @@
+import codecs
+import csv
+import io
+from dataclasses import dataclass
+from enum import StrEnum
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Optional
+
+
+@dataclass
+class Unreadable:
+    """A record that couldn't be parsed at all, reported like an invalid one."""
+
+    error: str
+
+
+# A parsed record: CSV rows come out as dicts, NDJSON rows as their raw JSON
+# text so that pydantic can parse and validate them in one pass.
+Record = dict[str, str] | str | Unreadable
+
+NOT_UTF8 = Unreadable("Not valid UTF-8")
+
+
+class _OpenQuote(Exception):
+    """The lines read so far end inside a quoted field."""
+
+
+class ImportFormat(StrEnum):
+    CSV = "text/csv"
+    NDJSON = "application/x-ndjson"
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into lines, holding at most one partial line in memory.
+
+    Bytes that aren't valid UTF-8 come through as lone surrogates, for the
+    records they are in to be rejected.
+    """
+    # utf-8-sig drops the byte order mark spreadsheet exports like to add
+    decoder = io.IncrementalNewlineDecoder(
+        codecs.getincrementaldecoder("utf-8-sig")(errors="surrogateescape"),
+        translate=True,
+    )
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def iter_ndjson_records(
+    chunks: AsyncIterable[bytes],
+) -> AsyncIterator[tuple[int, Record]]:
+    line_number = 0
+    async for line in iter_lines(chunks):
+        line_number += 1
+        if line.strip():
+            yield line_number, line if _is_utf8(line) else NOT_UTF8
+
+
+async def iter_csv_records(
+    chunks: AsyncIterable[bytes],
+) -> AsyncIterator[tuple[int, Record]]:
+    """Parse CSV with a header row, yielding each record with its starting line.
+
+    Quoted fields may span lines, so the csv module is handed a record's lines
+    one more at a time until it reads a whole row from them.
+    """
+    header: Optional[list[str]] = None
+    record_lines: list[str] = []
+    start_line = 0
+    line_number = 0
+    async for line in iter_lines(chunks):
+        line_number += 1
+        if not record_lines:
+            if not line.strip():
+                continue
+            start_line = line_number
+        record_lines.append(line)
+        try:
+            row = _read_csv_row(record_lines)
+        except _OpenQuote:
+            continue
+        except csv.Error as e:
+            row = Unreadable(str(e))
+        lines, record_lines = record_lines, []
+        if header is None:
+            header = [] if isinstance(row, Unreadable) else [n.strip() for n in row]
+            continue
+        yield start_line, _csv_record(header, lines, row)
+    if record_lines and header is not None:
+        # The file ended inside a quoted field; the csv module closes it
+        try:
+            row = _read_csv_row(record_lines, final=True)
+        except csv.Error as e:
+            row = Unreadable(str(e))
+        yield start_line, _csv_record(header, record_lines, row)
+
+
+def _read_csv_row(lines: list[str], final: bool = False) -> list[str]:
+    def feed() -> Iterator[str]:
+        for line in lines:
+            yield line + "\n"
+        if not final:
+            raise _OpenQuote
+
+    return next(csv.reader(feed()))
+
+
+def _is_utf8(text: str) -> bool:
+    try:
+        text.encode()
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _csv_record(
+    header: list[str], lines: list[str], row: Iterable[str] | Unreadable
+) -> Record:
+    if isinstance(row, Unreadable):
+        return row
+    if not all(_is_utf8(line) for line in lines):
+        return NOT_UTF8
+    # Empty cells count as missing so required columns are reported as such
+    return {name: value for name, value in zip(header, row) if value}
+
+
+def iter_records(
+    format: ImportFormat, chunks: AsyncIterable[bytes]
+) -> AsyncIterator[tuple[int, Record]]:
+    if format == ImportFormat.CSV:
+        return iter_csv_records(chunks)
+    return iter_ndjson_records(chunks)
@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import (
+    Any,
+    Callable,
+    Generic,
+    Hashable,
+    Iterable,
+    Optional,
+    Protocol,
+    TypeVar,
+)
+
+import psycopg
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """Size-bounded LRU cache whose entries also expire after `ttl` seconds.
+
+    Not thread-safe; it is only used from the event loop thread.
+    """
+
+    def __init__(
+        self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped by every invalidation. A caller that read the value from the
+        # database before an invalidation must not cache it afterwards.
+        self.generation = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= self.timer():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: K, value: V, generation: Optional[int] = None) -> None:
+        if self.maxsize <= 0:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (self.timer() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: K) -> None:
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+_PENDING_INVALIDATIONS = "pending_invalidations"
+
+
+@event.listens_for(Session, "after_commit")
+def _deliver_pending_invalidations(session: Session) -> None:
+    for deliver in session.info.pop(_PENDING_INVALIDATIONS, []):
+        deliver()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_invalidations(session: Session) -> None:
+    session.info.pop(_PENDING_INVALIDATIONS, None)
+
+
+class Invalidatable(Protocol):
+    """Anything that can forget keys, as a TTLCache can."""
+
+    def invalidate(self, key: Any) -> None: ...
+
+    def clear(self) -> None: ...
+
+
+class InvalidationBus(Protocol):
+    """Delivers a writing transaction's invalidations to the caches holding the keys."""
+
+    def subscribe(
+        self, name: str, cache: Invalidatable, parse: Callable[[str], Any]
+    ) -> None: ...
+
+    async def publish(
+        self, session: AsyncSession, name: str, keys: Iterable[object]
+    ) -> None: ...
+
+    async def start(self) -> None: ...
+
+    async def stop(self) -> None: ...
+
+
+class LocalInvalidationBus:
+    """Invalidates this worker's caches once the publishing transaction commits.
+
+    Enough on its own for a single worker, and stands in for the shared bus in
+    tests that run several caches in one process.
+    """
+
+    def __init__(self):
+        self.subscribers: dict[
+            str, list[tuple[Invalidatable, Callable[[str], Any]]]
+        ] = {}
+
+    def subscribe(
+        self, name: str, cache: Invalidatable, parse: Callable[[str], Any]
+    ) -> None:
+        self.subscribers.setdefault(name, []).append((cache, parse))
+
+    async def publish(
+        self, session: AsyncSession, name: str, keys: Iterable[object]
+    ) -> None:
+        keys = [str(key) for key in keys]
+        session.info.setdefault(_PENDING_INVALIDATIONS, []).append(
+            lambda: self.deliver(name, keys)
+        )
+
+    def deliver(self, name: str, keys: Iterable[str]) -> None:
+        for cache, parse in self.subscribers.get(name, []):
+            for key in keys:
+                cache.invalidate(parse(key))
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class PostgresInvalidationBus(LocalInvalidationBus):
+    """Fans invalidations out to every worker through LISTEN/NOTIFY.
+
+    NOTIFY is sent on the writer's session, so it is only delivered if and
+    when the write commits. Each worker holds one listening connection. If it
+    drops, notifications may have been missed, so subscribed caches are cleared.
+    """
+
+    CHANNEL = "cache_invalidation"
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self._task: Optional[asyncio.Task] = None
+
+    async def publish(
+        self, session: AsyncSession, name: str, keys: Iterable[object]
+    ) -> None:
+        keys = [str(key) for key in keys]
+        await super().publish(session, name, keys)
+        payload = f"{name}:{','.join(keys)}"
+        await session.execute(select(func.pg_notify(self.CHANNEL, payload)))
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    self.dsn, autocommit=True
+                ) as conn:
+                    await conn.execute(f"LISTEN {self.CHANNEL}")
+                    async for notify in conn.notifies():
+                        name, _, keys = notify.payload.partition(":")
+                        self.deliver(name, keys.split(","))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Cache invalidation listener lost its connection")
+            for subscribers in self.subscribers.values():
+                for cache, _ in subscribers:
+                    cache.clear()
+            await asyncio.sleep(1)
+
+
+@lru_cache
+def get_invalidation_bus() -> InvalidationBus:
+    settings = get_settings()
+    if settings.CACHE_INVALIDATION_BACKEND == "postgres":
+        return PostgresInvalidationBus(dsn=settings.PSYCOPG_DATABASE_URI)
+    return LocalInvalidationBus()
@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from app.bulk import ImportFormat, iter_records
+from app.db import get_engine, get_sessionmaker, migrate_db
+from app.jobs import archive_loans, scan_overdue_loans
+from app.models import Role
+from app.query_plans import QueryCheck, check_query_plans
+from app.schemas import BookImportReport, UserCreate
+from app.services import BookService, UserService
+from app.settings import get_settings
+from app.synthetic import seed
+
+CHUNK_SIZE = 64 * 1024
+DEMO_READERS = ("alice", "bob")
+
+
+async def read_chunks(path: Path) -> AsyncIterator[bytes]:
+    with path.open("rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+async def import_books(
+    path: Path, format: ImportFormat, batch_size: int
+) -> BookImportReport:
+    async with get_sessionmaker()() as session:
+        return await BookService(session=session).import_books(
+            records=iter_records(format, read_chunks(path)), batch_size=batch_size
+        )
+
+
+async def create_initial_users(demo_readers: bool) -> list[str]:
+    """Create the superuser, and the demo readers if asked, unless they exist."""
+    settings = get_settings()
+    users = [
+        UserCreate(
+            username=settings.FIRST_SUPERUSER_USERNAME,
+            password=settings.FIRST_SUPERUSER_PASSWORD,
+            is_active=True,
+            is_superuser=True,
+            role=Role.ADMIN,
+        )
+    ]
+    if demo_readers:
+        users.extend(
+            UserCreate(
+                username=reader,
+                password="books",
+                is_active=True,
+                is_superuser=False,
+                role=Role.READER,
+            )
+            for reader in DEMO_READERS
+        )
+    created = []
+    async with get_sessionmaker()() as session:
+        user_service = UserService(session=session)
+        for user in users:
+            if not await user_service.get_user_by_username(username=user.username):
+                await user_service.create_user(data=user)
+                created.append(user.username)
+    return created
+
+
+async def run_query_plan_check(books: int, users: int, loans: int) -> list[QueryCheck]:
+    async with get_engine().connect() as conn:
+        return await check_query_plans(conn, books=books, users=users, loans=loans)
+
+
+def print_query_checks(checks: list[QueryCheck]) -> None:
+    for check in checks:
+        print(f"{'ok' if check.ok else 'FAIL':>4}  {check.name}")
+        for plan in check.plans:
+            if plan.seq_scans:
+                statement = " ".join(plan.statement.split())
+                print(f"      seq scan on {', '.join(plan.seq_scans)}: {statement}")
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser(
+        "import-books", help="Bulk import books from a CSV or NDJSON file"
+    )
+    import_parser.add_argument("path", type=Path)
+    import_parser.add_argument(
+        "--format",
+        choices=["csv", "ndjson"],
+        help="Defaults to the file extension",
+    )
+    import_parser.add_argument(
+        "--batch-size", type=int, default=get_settings().IMPORT_BATCH_SIZE
+    )
+
+    commands.add_parser(
+        "scan-overdue", help="Record notices for loans that have fallen overdue"
+    )
+
+    commands.add_parser(
+        "archive-loans",
+        help="Move loans returned over LOAN_ARCHIVE_AFTER_DAYS ago to loan_history",
+    )
+
+    migrate_parser = commands.add_parser(
+        "migrate", help="Upgrade the database schema to the latest migration"
+    )
+    migrate_parser.add_argument("--revision", default="head")
+
+    bootstrap_parser = commands.add_parser(
+        "bootstrap", help="Create the superuser if it doesn't exist yet"
+    )
+    bootstrap_parser.add_argument(
+        "--demo-readers",
+        action="store_true",
+        help=f"Also create the readers {' and '.join(DEMO_READERS)}, password 'books'",
+    )
+
+    plans_parser = commands.add_parser(
+        "check-query-plans",
+        help="Fail if any CRUD query plans a sequential scan on a large table",
+    )
+    plans_parser.add_argument("--books", type=int, default=20_000)
+    plans_parser.add_argument("--users", type=int, default=2_000)
+    plans_parser.add_argument("--loans", type=int, default=100_000)
+
+    seed_parser = commands.add_parser(
+        "seed",
+        help="Bulk load synthetic readers, books and loan history from a fixed seed",
+    )
+    seed_parser.add_argument("--books", type=int, default=1_000_000)
+    seed_parser.add_argument("--users", type=int, default=200_000)
+    seed_parser.add_argument("--loans", type=int, default=10_000_000)
+    seed_parser.add_argument("--seed", type=int, default=0)
+    seed_parser.add_argument("--username-prefix", default="reader-")
+    seed_parser.add_argument(
+        "--password", default="books", help="Shared by every synthetic reader"
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "import-books":
+        name = args.format or args.path.suffix.lstrip(".").lower()
+        format = ImportFormat.CSV if name == "csv" else ImportFormat.NDJSON
+        report = asyncio.run(
+            import_books(path=args.path, format=format, batch_size=args.batch_size)
+        )
+        print(report.model_dump_json(indent=2))
+    elif args.command == "scan-overdue":
+        print(asyncio.run(scan_overdue_loans()).model_dump_json(indent=2))
+    elif args.command == "archive-loans":
+        print(asyncio.run(archive_loans()).model_dump_json(indent=2))
+    elif args.command == "migrate":
+        asyncio.run(migrate_db(revision=args.revision))
+    elif args.command == "bootstrap":
+        created = asyncio.run(create_initial_users(demo_readers=args.demo_readers))
+        print(f"Created {', '.join(created)}" if created else "Nothing to create")
+    elif args.command == "check-query-plans":
+        checks = asyncio.run(
+            run_query_plan_check(books=args.books, users=args.users, loans=args.loans)
+        )
+        print_query_checks(checks)
+        if not all(check.ok for check in checks):
+            sys.exit(1)
+    elif args.command == "seed":
+        try:
+            report = asyncio.run(
+                seed(
+                    books=args.books,
+                    users=args.users,
+                    loans=args.loans,
+                    seed=args.seed,
+                    username_prefix=args.username_prefix,
+                    password=args.password,
+                )
+            )
+        except ValueError as e:
+            sys.exit(str(e))
+        print(report.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,219 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import os
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING
 
-from app.models import Base
-from app.settings import get_settings
+from sqlalchemy import Connection, event, exc, func, inspect, select, text
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-engine = create_engine(str(get_settings().SQLALCHEMY_DATABASE_URI))
+from app.profiling import record_query
+from app.settings import Settings, get_settings
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if TYPE_CHECKING:
+    from alembic.config import Config
 
 
-def create_db():
-    Base.metadata.create_all(bind=engine)
+@dataclass
+class PoolWaitStats:
+    checkouts: int = 0
+    timeouts: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long callers wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.wait_stats.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            self.wait_stats.checkouts += 1
+            self.wait_stats.total_wait += wait
+            self.wait_stats.max_wait = max(self.wait_stats.max_wait, wait)
+
+
+def _connect_args(settings: Settings) -> dict:
+    if settings.DB_STATEMENT_TIMEOUT_MS is None:
+        return {}
+    return {"options": f"-c statement_timeout={settings.DB_STATEMENT_TIMEOUT_MS}"}
+
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    # A connection runs one statement at a time
+    conn.info["query_start"] = time.perf_counter()
+
+
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    record_query(statement, time.perf_counter() - conn.info.pop("query_start"))
+
+
+def pool_limits(settings: Settings) -> tuple[int, int]:
+    """The pool size and overflow for one worker.
+
+    With DB_CONNECTION_BUDGET set, the budget is split evenly between the
+    workers, less each worker's listeners for invalidations and the
+    availability feed, and DB_POOL_SIZE only caps the persistent part of
+    each share.
+    """
+    if settings.DB_CONNECTION_BUDGET is None:
+        return settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW
+    per_worker = settings.DB_CONNECTION_BUDGET // settings.WEB_CONCURRENCY
+    if settings.CACHE_INVALIDATION_BACKEND == "postgres":
+        per_worker -= 1
+    if settings.AVAILABILITY_FEED:
+        per_worker -= 1
+    if per_worker < 1:
+        raise ValueError(
+            f"DB_CONNECTION_BUDGET of {settings.DB_CONNECTION_BUDGET} leaves no "
+            f"connections for {settings.WEB_CONCURRENCY} workers"
+        )
+    pool_size = min(settings.DB_POOL_SIZE, per_worker)
+    return pool_size, per_worker - pool_size
+
+
+def build_engine(url: str, settings: Settings, **connect_args) -> AsyncEngine:
+    """An instrumented engine for `url`, sized to this worker's share of connections."""
+    pool_size, max_overflow = pool_limits(settings)
+    # The psycopg dialect picks its async driver when used with create_async_engine
+    engine = create_async_engine(
+        url,
+        poolclass=InstrumentedPool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        connect_args={**_connect_args(settings), **connect_args},
+    )
+    event.listen(engine.sync_engine, "before_cursor_execute", _start_query_timer)
+    event.listen(engine.sync_engine, "after_cursor_execute", _record_query)
+    return engine
+
+
+@lru_cache
+def get_engine() -> AsyncEngine:
+    """The process's engine, created on first use rather than at import."""
+    settings = get_settings()
+    return build_engine(str(settings.SQLALCHEMY_DATABASE_URI), settings)
+
+
+def _reset_after_fork() -> None:
+    # A forked child must not use, or close, the parent's pooled connections;
+    # dispose(close=False) just forgets them, and the child builds its own
+    if get_engine.cache_info().currsize:
+        get_engine().sync_engine.dispose(close=False)
+    get_engine.cache_clear()
+    get_sessionmaker.cache_clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@lru_cache
+def get_sessionmaker() -> async_sessionmaker[AsyncSession]:
+    # CRUD methods refresh what they return, so expiring everything on commit
+    # would only cost another SELECT when the response is serialized.
+    return async_sessionmaker(
+        autocommit=False, autoflush=False, expire_on_commit=False, bind=get_engine()
+    )
+
+
+def get_pool_status() -> dict[str, int | float]:
+    """Saturation figures for telling pool waits apart from slow queries."""
+    pool = get_engine().sync_engine.pool
+    assert isinstance(pool, InstrumentedPool)
+    stats = pool.wait_stats
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow_in_use": max(pool.overflow(), 0),
+        "max_overflow": pool_limits(get_settings())[1],
+        "checkouts": stats.checkouts,
+        "timeouts": stats.timeouts,
+        "wait_seconds_total": stats.total_wait,
+        "wait_seconds_max": stats.max_wait,
+        "wait_seconds_avg": stats.total_wait / stats.checkouts
+        if stats.checkouts
+        else 0.0,
+    }
+
+
+MIGRATIONS_PATH = Path(__file__).parent / "migrations"
+# Any constant works, as long as nothing else takes the same advisory lock
+MIGRATION_LOCK_ID = 0x736B6F6F62
+
+
+def get_alembic_config() -> "Config":
+    # Imported here so that serving requests never loads Alembic
+    from alembic.config import Config
+
+    config = Config()
+    config.set_main_option("script_location", str(MIGRATIONS_PATH))
+    return config
+
+
+# Brings a schema made by Base.metadata.create_all, before there were
+# migrations, up to revision 0001. The models gained some of these objects
+# before 0001 was written, so each statement does nothing where they exist.
+CREATE_ALL_TO_INITIAL_REVISION = [
+    "ALTER TABLE books ADD COLUMN IF NOT EXISTS version integer DEFAULT 1 NOT NULL",
+    # create_all left the defaults to Python
+    "ALTER TABLE loans ALTER COLUMN loaned_at SET DEFAULT LOCALTIMESTAMP",
+    "ALTER TABLE loans ALTER COLUMN due_date "
+    "SET DEFAULT localtimestamp + interval '14 days'",
+    "CREATE INDEX IF NOT EXISTS ix_loans_open_due_date ON loans (due_date, id) "
+    "WHERE returned_at IS NULL",
+    "CREATE TABLE IF NOT EXISTS overdue_scan_cursor "
+    "(id integer PRIMARY KEY, due_date timestamp, loan_id integer)",
+    "CREATE TABLE IF NOT EXISTS overdue_notices ("
+    "id serial PRIMARY KEY, "
+    "loan_id integer NOT NULL UNIQUE REFERENCES loans (id), "
+    "user_id integer NOT NULL REFERENCES users (id), "
+    "book_id integer NOT NULL REFERENCES books (id), "
+    "due_date timestamp NOT NULL, "
+    "notified_at timestamp DEFAULT LOCALTIMESTAMP NOT NULL)",
+    "INSERT INTO overdue_scan_cursor (id) VALUES (1) ON CONFLICT DO NOTHING",
+]
+
+
+def upgrade_schema(connection: Connection, revision: str = "head") -> None:
+    """Upgrade the schema on `connection` to `revision`.
+
+    A database that create_all made is first adopted at revision 0001.
+    """
+    from alembic import command
+
+    connection.execute(select(func.pg_advisory_xact_lock(MIGRATION_LOCK_ID)))
+    config = get_alembic_config()
+    config.attributes["connection"] = connection
+    tables = inspect(connection)
+    if tables.has_table("users") and not tables.has_table("alembic_version"):
+        for statement in CREATE_ALL_TO_INITIAL_REVISION:
+            connection.execute(text(statement))
+        command.stamp(config, "0001")
+    command.upgrade(config, revision)
+
+
+async def migrate_db(revision: str = "head") -> None:
+    """Upgrade the schema to `revision`, one process at a time."""
+    async with get_engine().begin() as conn:
+        await conn.run_sync(upgrade_schema, revision)
@@ -0,0 +1,241 @@
+"""A push feed of book availability and loan events, as Server-Sent Events.
+
+Every transaction that changes books sends one NOTIFY with the books' copies
+as they now stand, identified by its transaction id. Two writes to the same
+book are ordered by the book's row lock, and NOTIFY is delivered in commit
+order, so every worker's single listener sees the same events in the same
+order, each book's in the order they happened. Workers keep the most recent
+events, so a client can resume from the id of the last event it saw, on
+this worker or another. Changes that can't be replayed, e.g. by the seeder or
+while the listener was reconnecting, are passed on as a 'reset' event:
+clients refetch what they show and carry on.
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from collections import deque
+from functools import lru_cache
+from typing import AsyncIterator, Iterable, Optional
+
+import psycopg
+from sqlalchemy import (
+    JSON,
+    Text,
+    case,
+    cast,
+    func,
+    literal,
+    literal_column,
+    select,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Book
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "availability"
+# NOTIFY payloads are limited to 8000 bytes. Beyond this many books and loans
+# together, an event just says to refetch; this many of the longest fit.
+MAX_EVENT_ITEMS = 100
+NOTIFY_PAYLOAD_LIMIT = 8000
+# Seconds between comments that keep idle streams from being timed out
+KEEPALIVE_SECONDS = 15
+
+
+async def publish_availability(
+    session: AsyncSession,
+    book_ids: Optional[Iterable[int]],
+    loans: Iterable[tuple[int, int, str]] = (),
+) -> None:
+    """Announce the books' copies, and the loans, once the session commits.
+
+    Call it after the books are updated. `loans` are (loan id, book id,
+    'checkout' or 'return'); `book_ids` of None tells subscribers to refetch
+    everything, e.g. after a bulk import.
+    """
+    if not get_settings().AVAILABILITY_FEED:
+        return
+    id = cast(func.pg_current_xact_id(), Text)
+    ids = None if book_ids is None else sorted(set(book_ids))
+    loans = list(loans)
+    reset = cast(func.json_build_object("id", id, "reset", True), Text)
+    if ids is None or len(ids) + len(loans) > MAX_EVENT_ITEMS:
+        await session.execute(select(func.pg_notify(CHANNEL, reset)))
+        return
+    books = (
+        select(
+            func.coalesce(
+                func.json_agg(
+                    func.json_build_object(
+                        "id", Book.id, "available_copies", Book.available_copies
+                    )
+                ),
+                literal_column("'[]'::json"),
+            )
+        )
+        .where(Book.id.in_(ids))
+        .scalar_subquery()
+    )
+    events = [
+        {"id": id, "book_id": book_id, "event": event} for id, book_id, event in loans
+    ]
+    event = select(
+        cast(
+            func.json_build_object(
+                "id", id, "books", books, "loans", literal(events, JSON)
+            ),
+            Text,
+        ).label("payload")
+    ).subquery()
+    # Should an event still outgrow NOTIFY, the write goes through with a reset
+    payload = case(
+        (func.octet_length(event.c.payload) < NOTIFY_PAYLOAD_LIMIT, event.c.payload),
+        else_=reset,
+    )
+    await session.execute(select(func.pg_notify(CHANNEL, payload)))
+
+
+def _event(id: str, name: str, data: str) -> bytes:
+    return f"id: {id}\nevent: {name}\ndata: {data}\n\n".encode()
+
+
+class AvailabilityFeed:
+    """Fans one worker's LISTEN connection out to its SSE subscribers."""
+
+    def __init__(self, dsn: str, buffer_size: int, queue_size: int):
+        self.dsn = dsn
+        self.queue_size = queue_size
+        # The id of the last event seen, and events since the one with id
+        # `since`, in the order they arrived. Until an event arrives, both
+        # are a marker of this worker's own.
+        self.last: Optional[str] = None
+        self.since: Optional[str] = None
+        self.events: deque[tuple[str, bytes]] = deque(maxlen=buffer_size)
+        self.subscribers: set[asyncio.Queue[Optional[bytes]]] = set()
+        self.dropped = 0
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, timeout: float) -> bool:
+        """Start listening if not already, and say whether it is listening in time."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except TimeoutError:
+            return False
+        return True
+
+    async def stream(self, after: Optional[str]) -> AsyncIterator[bytes]:
+        """Events after the one with id `after`, then new ones as they happen.
+
+        Call once `start` succeeds. Without `after`, the stream opens with a
+        'hello' event, whose id can be resumed from like any other.
+        """
+        queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue(self.queue_size)
+        # Registered before the backlog is read, with no await in between,
+        # so nothing can fall between the two
+        self.subscribers.add(queue)
+        try:
+            for message in self._backlog(after):
+                yield message
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.subscribers.discard(queue)
+
+    def _backlog(self, after: Optional[str]) -> list[bytes]:
+        assert self.last is not None
+        if after is None:
+            return [_event(self.last, "hello", "{}")]
+        if after == self.last:
+            return []
+        if after == self.since:
+            return [message for _, message in self.events]
+        for index, (id, _) in enumerate(self.events):
+            if id == after:
+                return [message for _, message in list(self.events)[index + 1 :]]
+        # Too old to replay, or not an event this worker has seen
+        return [_event(self.last, "reset", "{}")]
+
+    def deliver(self, id: str, message: bytes) -> None:
+        if len(self.events) == self.events.maxlen:
+            self.since = self.events[0][0]
+        self.events.append((id, message))
+        self.last = id
+        self._broadcast(message)
+
+    def _reset(self) -> None:
+        """Start over from a new marker, as events may have been missed."""
+        self.events.clear()
+        self.last = self.since = uuid.uuid4().hex
+        self._broadcast(_event(self.last, "reset", "{}"))
+
+    def _broadcast(self, message: Optional[bytes]) -> None:
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too slow to keep up; it can reconnect and resume from the buffer
+                self.dropped += 1
+                self.subscribers.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._broadcast(None)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    self.dsn, autocommit=True
+                ) as conn:
+                    await conn.execute(f"LISTEN {CHANNEL}")
+                    if self.last is None:
+                        self.last = self.since = uuid.uuid4().hex
+                    else:
+                        # Whatever was sent while it was away is lost
+                        self._reset()
+                    self._ready.set()
+                    async for notify in conn.notifies():
+                        self._receive(notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Availability feed listener lost its connection")
+            await asyncio.sleep(1)
+
+    def _receive(self, payload: str) -> None:
+        event = json.loads(payload)
+        id = event["id"]
+        if event.get("reset"):
+            # Kept like any other event, so that replays past it reset too
+            self.deliver(id, _event(id, "reset", "{}"))
+        else:
+            self.deliver(id, _event(id, "availability", payload))
+
+
+@lru_cache
+def get_availability_feed() -> AvailabilityFeed:
+    settings = get_settings()
+    return AvailabilityFeed(
+        dsn=settings.PSYCOPG_DATABASE_URI,
+        buffer_size=settings.AVAILABILITY_FEED_BUFFER_SIZE,
+        queue_size=settings.AVAILABILITY_FEED_QUEUE_SIZE,
+    )
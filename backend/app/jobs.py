@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from datetime import timedelta
+from functools import lru_cache
+from typing import Awaitable, Callable, Optional
+
+from app.db import get_sessionmaker
+from app.metrics import REGISTRY
+from app.replicas import check_replicas
+from app.schemas import LoanArchiveReport, OverdueScanReport
+from app.services.idempotency import PURGE_BATCH_SIZE, IdempotencyService
+from app.services.loan_history import LoanHistoryService
+from app.services.overdue import OverdueService
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicJob:
+    """Runs `job` every `interval` seconds on the event loop until stopped."""
+
+    def __init__(
+        self,
+        name: str,
+        job: Callable[[], Awaitable[object]],
+        interval: float,
+        log_runs: bool = True,
+    ):
+        self.name = name
+        self.job = job
+        self.interval = interval
+        self.log_runs = log_runs
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                result = await self.job()
+                if self.log_runs:
+                    logger.info("%s finished: %s", self.name, result)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("%s failed", self.name)
+            await asyncio.sleep(self.interval)
+
+
+async def scan_overdue_loans() -> OverdueScanReport:
+    async with get_sessionmaker()() as session:
+        return await OverdueService(session=session).scan(
+            batch_size=get_settings().OVERDUE_SCAN_BATCH_SIZE
+        )
+
+
+async def archive_loans() -> LoanArchiveReport:
+    settings = get_settings()
+    async with get_sessionmaker()() as session:
+        return await LoanHistoryService(session=session).archive(
+            older_than=timedelta(days=settings.LOAN_ARCHIVE_AFTER_DAYS),
+            batch_size=settings.LOAN_ARCHIVE_BATCH_SIZE,
+        )
+
+
+async def purge_idempotency_keys() -> int:
+    async with get_sessionmaker()() as session:
+        return await IdempotencyService(session=session).purge(
+            ttl=get_settings().IDEMPOTENCY_KEY_TTL_SECONDS,
+            batch_size=PURGE_BATCH_SIZE,
+        )
+
+
+async def flush_metrics() -> None:
+    REGISTRY.flush()
+
+
+@lru_cache
+def get_jobs() -> list[PeriodicJob]:
+    settings = get_settings()
+    return [
+        PeriodicJob(
+            "Overdue loan scan",
+            scan_overdue_loans,
+            interval=settings.OVERDUE_SCAN_INTERVAL_SECONDS,
+        ),
+        PeriodicJob(
+            "Loan archival",
+            archive_loans,
+            interval=settings.LOAN_ARCHIVE_INTERVAL_SECONDS,
+        ),
+        PeriodicJob(
+            "Idempotency key purge",
+            purge_idempotency_keys,
+            interval=settings.IDEMPOTENCY_PURGE_INTERVAL_SECONDS,
+        ),
+        PeriodicJob(
+            "Metrics flush",
+            flush_metrics,
+            interval=settings.METRICS_FLUSH_SECONDS if settings.METRICS_DIR else 0,
+            log_runs=False,
+        ),
+        PeriodicJob(
+            "Replica check",
+            check_replicas,
+            interval=settings.DB_REPLICA_CHECK_SECONDS
+            if settings.DB_REPLICA_URIS
+            else 0,
+            log_runs=False,
+        ),
+    ]
@@ -1,48 +1,57 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 
 from app.api.main import api_router
-from app.db import SessionLocal, create_db
-from app.models import Role
-from app.schemas import UserCreate
-from app.services import UserService
-from app.settings import get_settings
-
-settings = get_settings()
+from app.cache import get_invalidation_bus
+from app.db import get_engine
+from app.feed import get_availability_feed
+from app.jobs import get_jobs
+from app.metrics import REGISTRY, MetricsMiddleware
+from app.profiling import ProfilingMiddleware
+from app.replicas import get_replica_set
+from app.security import PasswordHasherBusy
 
 app = FastAPI()
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: PasswordHasherBusy):
+    # Shed load early rather than letting a login burst queue without limit
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Too many concurrent logins, try again shortly"},
+        headers={"Retry-After": "1"},
+    )
+
 
+@app.get("/health", include_in_schema=False)
+async def health() -> dict[str, str]:
+    # Answers as soon as the worker serves requests, without touching the database
+    return {"status": "ok"}
 
+
+# Migrations and initial users are applied once per deploy by the CLI, not here,
+# so a new worker only has to start its background tasks.
 @app.on_event("startup")
-def startup():
-    # TODO: Tables should be created with Alembic migrations
-    create_db()
-    with SessionLocal() as session:
-        # TODO: Implement better approach for seeding test data
-        user_service = UserService(session=session)
-        if not user_service.get_user_by_username(
-            username=settings.FIRST_SUPERUSER_USERNAME
-        ):
-            user_service.create_user(
-                data=UserCreate(
-                    username=settings.FIRST_SUPERUSER_USERNAME,
-                    password=settings.FIRST_SUPERUSER_PASSWORD,
-                    is_active=True,
-                    is_superuser=True,
-                    role=Role.ADMIN,
-                )
-            )
-        test_readers = {"alice", "bob"}
-        for reader in test_readers:
-            if not user_service.get_user_by_username(username=reader):
-                user_service.create_user(
-                    data=UserCreate(
-                        username=reader,
-                        password="books",
-                        is_active=True,
-                        is_superuser=False,
-                        role=Role.READER,
-                    )
-                )
+async def startup():
+    await get_invalidation_bus().start()
+    for job in get_jobs():
+        job.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for job in get_jobs():
+        await job.stop()
+    await get_availability_feed().stop()
+    # So the other workers keep counting what this one handled
+    REGISTRY.flush()
+    await get_invalidation_bus().stop()
+    # Close pooled connections now rather than leaving them for Postgres to notice
+    await get_engine().dispose()
+    await get_replica_set().dispose()
 
 
 app.include_router(api_router)
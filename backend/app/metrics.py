@@ -0,0 +1,339 @@
+"""Prometheus metrics in the text exposition format.
+
+Every worker keeps its own values in plain dicts, only touched from its event
+loop, so recording a sample takes no lock. With METRICS_DIR set, each worker
+also writes its values to a file there every METRICS_FLUSH_SECONDS, and a
+scrape of any worker merges the files of all of them.
+"""
+
+import json
+import os
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Any, Callable, Literal, Optional, Sequence, TypeVar
+
+from starlette.routing import Route
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.db import get_pool_status
+from app.feed import get_availability_feed
+from app.security import get_password_hasher
+from app.settings import get_settings
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = tuple[str, ...]
+
+
+class Metric:
+    type: str
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        collect: Optional[Callable[[], dict[Labels, Any]]] = None,
+        merge: Literal["sum", "local"] = "sum",
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # Read at scrape time instead of being recorded as things happen
+        self.collect = collect
+        # 'local' values are the same in every worker, e.g. read from the database
+        self.merge = merge
+        self.values: dict[Labels, Any] = {}
+
+    def samples(self) -> dict[Labels, Any]:
+        return self.collect() if self.collect else self.values
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = list(buckets)
+
+    def observe(self, value: float, *labels: str) -> None:
+        # A count per bucket, not cumulative, then the +Inf bucket and the sum
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> dict[str, list]:
+        return {
+            name: [[list(labels), value] for labels, value in metric.samples().items()]
+            for name, metric in self.metrics.items()
+            if metric.merge == "sum"
+        }
+
+    def flush(self) -> None:
+        """Write this worker's values for the others to merge."""
+        directory = get_settings().METRICS_DIR
+        if directory is None:
+            return
+        path = Path(directory) / f"{os.getpid()}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"time": time.time(), "metrics": self.snapshot()}))
+        # Readers see either the old file or the new one, never half of one
+        os.replace(tmp, path)
+
+    def collect_all(self) -> dict[str, dict[Labels, Any]]:
+        settings = get_settings()
+        if settings.METRICS_DIR is None:
+            return {name: m.samples() for name, m in self.metrics.items()}
+        self.flush()
+        # Gauges of workers that stopped flushing are dropped; their counters
+        # are kept so that totals never go backwards
+        stale_before = time.time() - 3 * settings.METRICS_FLUSH_SECONDS
+        merged: dict[str, dict[Labels, Any]] = {name: {} for name in self.metrics}
+        for path in Path(settings.METRICS_DIR).glob("*.json"):
+            try:
+                worker = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            for name, samples in worker["metrics"].items():
+                metric = self.metrics.get(name)
+                if metric is None or (
+                    metric.type == "gauge" and worker["time"] < stale_before
+                ):
+                    continue
+                for labels, value in samples:
+                    _add(merged[name], tuple(labels), value)
+        for name, metric in self.metrics.items():
+            if metric.merge == "local":
+                merged[name] = metric.samples()
+        return merged
+
+    def exposition(self) -> str:
+        lines = []
+        for name, samples in self.collect_all().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in sorted(samples.items()):
+                pairs = list(zip(metric.labels, labels))
+                if isinstance(metric, Histogram):
+                    lines.extend(_histogram_lines(metric, pairs, value))
+                else:
+                    lines.append(f"{name}{_format_labels(pairs)} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Counts and times every HTTP request under its route's path template."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_PROGRESS.inc(amount=-1)
+            # Templates rather than raw paths keep the number of series bounded
+            route = scope.get("route")
+            path = route.path if isinstance(route, Route) else "unmatched"
+            method = scope["method"]
+            HTTP_REQUESTS.inc(method, path, str(status))
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, method, path)
+
+
+def _add(samples: dict[Labels, Any], labels: Labels, value: Any) -> None:
+    if labels not in samples:
+        samples[labels] = value
+    elif isinstance(value, list):
+        samples[labels] = [a + b for a, b in zip(samples[labels], value)]
+    else:
+        samples[labels] += value
+
+
+def _histogram_lines(
+    metric: Histogram, pairs: list[tuple[str, str]], counts: list[float]
+) -> list[str]:
+    lines = []
+    cumulative = 0
+    bounds = [*(str(float(bound)) for bound in metric.buckets), "+Inf"]
+    for bound, count in zip(bounds, counts):
+        cumulative += count
+        labels = _format_labels([*pairs, ("le", bound)])
+        lines.append(f"{metric.name}_bucket{labels} {float(cumulative)}")
+    lines.append(f"{metric.name}_sum{_format_labels(pairs)} {float(counts[-1])}")
+    lines.append(f"{metric.name}_count{_format_labels(pairs)} {float(cumulative)}")
+    return lines
+
+
+def _format_labels(pairs: list[tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    escaped = (
+        (key, value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _pool_connections() -> dict[Labels, Any]:
+    status = get_pool_status()
+    return {
+        ("checked_out",): status["checked_out"],
+        ("checked_in",): status["checked_in"],
+        ("overflow",): status["overflow_in_use"],
+    }
+
+
+def _password_hash_tasks() -> dict[Labels, Any]:
+    hasher = get_password_hasher()
+    running = min(hasher.pending, hasher.max_workers)
+    return {("running",): running, ("queued",): hasher.pending - running}
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.register(
+    Counter(
+        "http_requests_total",
+        "HTTP requests by route and response status.",
+        ("method", "route", "status"),
+    )
+)
+HTTP_REQUEST_DURATION = REGISTRY.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time from receiving a request to sending its response.",
+        ("method", "route"),
+    )
+)
+HTTP_REQUESTS_IN_PROGRESS = REGISTRY.register(
+    Gauge("http_requests_in_progress", "Requests being handled.")
+)
+DB_POOL_CONNECTIONS = REGISTRY.register(
+    Gauge(
+        "db_pool_connections",
+        "Pooled database connections by state.",
+        ("state",),
+        collect=_pool_connections,
+    )
+)
+DB_POOL_CHECKOUTS = REGISTRY.register(
+    Counter(
+        "db_pool_checkouts_total",
+        "Connections taken from the pool.",
+        collect=lambda: {(): get_pool_status()["checkouts"]},
+    )
+)
+DB_POOL_TIMEOUTS = REGISTRY.register(
+    Counter(
+        "db_pool_timeouts_total",
+        "Checkouts that gave up waiting for a connection.",
+        collect=lambda: {(): get_pool_status()["timeouts"]},
+    )
+)
+DB_POOL_WAIT = REGISTRY.register(
+    Counter(
+        "db_pool_wait_seconds_total",
+        "Time spent waiting for a pooled connection.",
+        collect=lambda: {(): get_pool_status()["wait_seconds_total"]},
+    )
+)
+PASSWORD_HASH_TASKS = REGISTRY.register(
+    Gauge(
+        "password_hash_tasks",
+        "bcrypt hashes running on a hasher thread or queued for one.",
+        ("state",),
+        collect=_password_hash_tasks,
+    )
+)
+PASSWORD_HASH_REJECTED = REGISTRY.register(
+    Counter(
+        "password_hash_rejected_total",
+        "Hashes refused because the hasher queue was full.",
+        collect=lambda: {(): get_password_hasher().rejected},
+    )
+)
+LOGINS = REGISTRY.register(
+    Counter("logins_total", "Login attempts by outcome.", ("outcome",))
+)
+LOAN_CHECKOUTS = REGISTRY.register(
+    Counter("loan_checkouts_total", "Loans created, singly or in batches.")
+)
+LOAN_RETURNS = REGISTRY.register(
+    Counter("loan_returns_total", "Loans returned, singly or in batches.")
+)
+LOANS_OPEN = REGISTRY.register(
+    Gauge(
+        "loans_open",
+        "Loans not yet returned, by whether they are overdue.",
+        ("overdue",),
+        merge="local",
+    )
+)
+FEED_SUBSCRIBERS = REGISTRY.register(
+    Gauge(
+        "availability_feed_subscribers",
+        "Open availability feed streams.",
+        collect=lambda: {(): len(get_availability_feed().subscribers)},
+    )
+)
+FEED_DROPPED = REGISTRY.register(
+    Counter(
+        "availability_feed_dropped_total",
+        "Feed streams closed for falling too far behind.",
+        collect=lambda: {(): get_availability_feed().dropped},
+    )
+)
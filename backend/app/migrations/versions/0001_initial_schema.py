@@ -0,0 +1,114 @@
+"""Initial schema, as previously created by Base.metadata.create_all
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("username", sa.String(), nullable=False),
+        sa.Column("hashed_password", sa.String(length=255), nullable=False),
+        sa.Column("is_active", sa.Boolean(), nullable=False),
+        sa.Column("is_superuser", sa.Boolean(), nullable=False),
+        sa.Column("role", sa.Enum("ADMIN", "READER", name="role"), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("username"),
+    )
+    op.create_table(
+        "books",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("title", sa.String(), nullable=False),
+        sa.Column("author", sa.String(), nullable=False),
+        sa.Column("description", sa.String(), nullable=True),
+        sa.Column("available_copies", sa.Integer(), nullable=False),
+        sa.Column("version", sa.Integer(), server_default="1", nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "user_books",
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column("book_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["book_id"], ["books.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+    )
+    op.create_table(
+        "loans",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("book_id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "loaned_at",
+            sa.DateTime(),
+            server_default=sa.text("LOCALTIMESTAMP"),
+            nullable=False,
+        ),
+        sa.Column(
+            "due_date",
+            sa.DateTime(),
+            server_default=sa.text("localtimestamp + interval '14 days'"),
+            nullable=False,
+        ),
+        sa.Column("returned_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["book_id"], ["books.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_loans_open_due_date",
+        "loans",
+        ["due_date", "id"],
+        postgresql_where=sa.text("returned_at IS NULL"),
+    )
+    op.create_table(
+        "overdue_scan_cursor",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("due_date", sa.DateTime(), nullable=True),
+        sa.Column("loan_id", sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "overdue_notices",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("loan_id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("book_id", sa.Integer(), nullable=False),
+        sa.Column("due_date", sa.DateTime(), nullable=False),
+        sa.Column(
+            "notified_at",
+            sa.DateTime(),
+            server_default=sa.text("LOCALTIMESTAMP"),
+            nullable=False,
+        ),
+        sa.ForeignKeyConstraint(["book_id"], ["books.id"]),
+        sa.ForeignKeyConstraint(["loan_id"], ["loans.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("loan_id"),
+    )
+    # Single-row table the app updates but never inserts into
+    op.execute("INSERT INTO overdue_scan_cursor (id) VALUES (1)")
+
+
+def downgrade() -> None:
+    op.drop_table("overdue_notices")
+    op.drop_table("overdue_scan_cursor")
+    op.drop_index("ix_loans_open_due_date", table_name="loans")
+    op.drop_table("loans")
+    op.drop_table("user_books")
+    op.drop_table("books")
+    op.drop_table("users")
+    sa.Enum(name="role").drop(op.get_bind())
@@ -0,0 +1,51 @@
+"""Indexes for the loan, borrowed book and catalogue queries
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:30:00.000000
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # user_books had no key, so clear out anything the new one would reject
+    op.execute("DELETE FROM user_books WHERE user_id IS NULL OR book_id IS NULL")
+    op.execute(
+        """
+        DELETE FROM user_books a
+        USING user_books b
+        WHERE a.ctid < b.ctid AND a.user_id = b.user_id AND a.book_id = b.book_id
+        """
+    )
+    op.alter_column("user_books", "user_id", nullable=False)
+    op.alter_column("user_books", "book_id", nullable=False)
+    op.create_primary_key("user_books_pkey", "user_books", ["user_id", "book_id"])
+    op.create_index("ix_user_books_book_id", "user_books", ["book_id"])
+    op.create_index("ix_loans_user_id_book_id", "loans", ["user_id", "book_id"])
+    op.create_index("ix_loans_book_id", "loans", ["book_id"])
+    op.create_index("ix_books_author_id", "books", ["author", "id"])
+    op.create_index(
+        "ix_books_title_prefix",
+        "books",
+        ["title"],
+        postgresql_ops={"title": "text_pattern_ops"},
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_books_title_prefix", table_name="books")
+    op.drop_index("ix_books_author_id", table_name="books")
+    op.drop_index("ix_loans_book_id", table_name="loans")
+    op.drop_index("ix_loans_user_id_book_id", table_name="loans")
+    op.drop_index("ix_user_books_book_id", table_name="user_books")
+    op.drop_constraint("user_books_pkey", "user_books", type_="primary")
+    op.alter_column("user_books", "book_id", nullable=True)
+    op.alter_column("user_books", "user_id", nullable=True)
@@ -0,0 +1,71 @@
+"""Full-text, fuzzy and typeahead search indexes on books
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 15:00:00.000000
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Titles weigh most in the ranking, then authors, then descriptions
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', title), 'A') || "
+    "setweight(to_tsvector('english', author), 'B') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'C')"
+)
+
+
+def upgrade() -> None:
+    # Rewrites the table, as every existing row gets its vector computed
+    op.add_column(
+        "books",
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed(SEARCH_VECTOR, persisted=True),
+            nullable=False,
+        ),
+    )
+    op.create_index(
+        "ix_books_search_vector",
+        "books",
+        ["search_vector"],
+        postgresql_using="gin",
+    )
+    op.create_index(
+        "ix_books_title_typeahead", "books", [sa.text('lower(title) COLLATE "C"')]
+    )
+    op.create_index(
+        "ix_books_author_typeahead", "books", [sa.text('lower(author) COLLATE "C"')]
+    )
+    # pg_trgm ships with Postgres' contrib modules, which not every server
+    # has; search falls back to full-text only without it
+    available = op.get_bind().scalar(
+        sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    )
+    if available:
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.execute(
+            "CREATE INDEX ix_books_title_trgm ON books USING gin (title gin_trgm_ops)"
+        )
+        op.execute(
+            "CREATE INDEX ix_books_author_trgm ON books USING gin (author gin_trgm_ops)"
+        )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_books_author_trgm")
+    op.execute("DROP INDEX IF EXISTS ix_books_title_trgm")
+    op.drop_index("ix_books_author_typeahead", table_name="books")
+    op.drop_index("ix_books_title_typeahead", table_name="books")
+    op.drop_index("ix_books_search_vector", table_name="books")
+    op.drop_column("books", "search_vector")
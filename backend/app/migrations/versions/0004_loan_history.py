@@ -0,0 +1,61 @@
+"""Archive table for returned loans
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 18:00:00.000000
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "loan_history",
+        # Keeps the id the loan had in 'loans'
+        sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("book_id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("loaned_at", sa.DateTime(), nullable=False),
+        sa.Column("due_date", sa.DateTime(), nullable=False),
+        sa.Column("returned_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["book_id"], ["books.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_loan_history_user_id_id", "loan_history", ["user_id", "id"])
+    op.create_index("ix_loan_history_book_id_id", "loan_history", ["book_id", "id"])
+    op.create_index(
+        "ix_loans_returned_at",
+        "loans",
+        ["returned_at"],
+        postgresql_where=sa.text("returned_at IS NOT NULL"),
+    )
+    # Notices outlive their loan's move to the archive
+    op.drop_constraint(
+        "overdue_notices_loan_id_fkey", "overdue_notices", type_="foreignkey"
+    )
+
+
+def downgrade() -> None:
+    op.execute(
+        "INSERT INTO loans (id, book_id, user_id, loaned_at, due_date, returned_at) "
+        "SELECT id, book_id, user_id, loaned_at, due_date, returned_at "
+        "FROM loan_history"
+    )
+    op.create_foreign_key(
+        "overdue_notices_loan_id_fkey",
+        "overdue_notices",
+        "loans",
+        ["loan_id"],
+        ["id"],
+    )
+    op.drop_index("ix_loans_returned_at", table_name="loans")
+    op.drop_table("loan_history")
@@ -2,9 +2,26 @@ from datetime import datetime, timedelta
 from enum import StrEnum
 from typing import Optional
 
-from sqlalchemy import Column, Enum, ForeignKey, Integer, String, Table
+from sqlalchemy import (
+    Column,
+    Computed,
+    Enum,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    PrimaryKeyConstraint,
+    SmallInteger,
+    String,
+    Table,
+    func,
+    text,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
+LOAN_PERIOD = timedelta(weeks=2)
+
 
 class Base(DeclarativeBase):
     pass
@@ -15,6 +32,9 @@ user_books_association = Table(
     Base.metadata,
     Column("user_id", Integer, ForeignKey("users.id")),
     Column("book_id", Integer, ForeignKey("books.id")),
+    # The key also serves lookups by user; books need their own index
+    PrimaryKeyConstraint("user_id", "book_id"),
+    Index("ix_user_books_book_id", "book_id"),
 )
 
 
@@ -41,6 +61,10 @@ class User(Base):
     )
 
 
+# Text search configuration of the search vector; queries must use the same one
+SEARCH_CONFIG = "english"
+
+
 class Book(Base):
     __tablename__ = "books"
 
@@ -49,12 +73,44 @@ class Book(Base):
     author: Mapped[str]
     description: Mapped[Optional[str]]
     available_copies: Mapped[int] = mapped_column(default=1)
+    # Bumped by every write to the row, for per-book ETags
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
+    # Computed by Postgres on every insert and update, so no write path has
+    # to maintain it. Deferred, as nothing reads it back.
+    search_vector: Mapped[str] = mapped_column(
+        TSVECTOR,
+        Computed(
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', title), 'A') || "
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', author), 'B') || "
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', "
+            "coalesce(description, '')), 'C')",
+            persisted=True,
+        ),
+        deferred=True,
+    )
 
     borrowers: Mapped[list[User]] = relationship(
         secondary=user_books_association, back_populates="borrowed_books"
     )
     loans: Mapped[list["Loan"]] = relationship(back_populates="book")
 
+    __table_args__ = (
+        # Both filters are keyset-paginated on id, hence the trailing column
+        Index("ix_books_author_id", "author", "id"),
+        # text_pattern_ops lets title prefix (LIKE 'x%') searches use the index
+        Index(
+            "ix_books_title_prefix",
+            "title",
+            postgresql_ops={"title": "text_pattern_ops"},
+        ),
+        Index("ix_books_search_vector", "search_vector", postgresql_using="gin"),
+        # Byte order, so typeahead can both match a prefix and read matches
+        # in order straight off the index
+        Index("ix_books_title_typeahead", text('lower(title) COLLATE "C"')),
+        Index("ix_books_author_typeahead", text('lower(author) COLLATE "C"')),
+        # The trigram indexes are created by migration 0003 where pg_trgm exists
+    )
+
 
 class Loan(Base):
     __tablename__ = "loans"
@@ -62,12 +118,102 @@ class Loan(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     book_id: Mapped[int] = mapped_column(ForeignKey("books.id"))
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    # TODO: Improve derivation of due date etc
-    loaned_at: Mapped[datetime] = mapped_column(default=datetime.now())
+    # Evaluated per row, by the app for ORM inserts and by the database otherwise
+    loaned_at: Mapped[datetime] = mapped_column(
+        default=datetime.now, server_default=func.localtimestamp()
+    )
     due_date: Mapped[datetime] = mapped_column(
-        default=datetime.now() + timedelta(weeks=2)
+        default=lambda: datetime.now() + LOAN_PERIOD,
+        server_default=text(f"localtimestamp + interval '{LOAN_PERIOD.days} days'"),
     )
     returned_at: Mapped[Optional[datetime]]
 
     book: Mapped[Book] = relationship(back_populates="loans")
     user: Mapped[User] = relationship(back_populates="loans")
+
+    __table_args__ = (
+        # Also serves the 'does the user still have a copy out' checks on return
+        Index("ix_loans_user_id_book_id", "user_id", "book_id"),
+        Index("ix_loans_book_id", "book_id"),
+        # Only open loans can be overdue, so the scan never touches returned ones
+        Index(
+            "ix_loans_open_due_date",
+            "due_date",
+            "id",
+            postgresql_where=text("returned_at IS NULL"),
+        ),
+        # Finds returned loans old enough to move to loan_history
+        Index(
+            "ix_loans_returned_at",
+            "returned_at",
+            postgresql_where=text("returned_at IS NOT NULL"),
+        ),
+    )
+
+
+class LoanHistory(Base):
+    """Returned loans moved out of `loans` once they are old enough.
+
+    Keeps `loans`, and with it every query on open loans, the size of the
+    recent activity rather than of all time. Rows keep their loan id.
+    """
+
+    __tablename__ = "loan_history"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    book_id: Mapped[int] = mapped_column(ForeignKey("books.id"))
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    loaned_at: Mapped[datetime]
+    due_date: Mapped[datetime]
+    returned_at: Mapped[datetime]
+
+    __table_args__ = (
+        # Keyset-paginated by id within a reader's or a book's history
+        Index("ix_loan_history_user_id_id", "user_id", "id"),
+        Index("ix_loan_history_book_id_id", "book_id", "id"),
+    )
+
+
+class OverdueScanCursor(Base):
+    """Single-row position of the overdue scan: the last (due_date, loan id) seen."""
+
+    __tablename__ = "overdue_scan_cursor"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    due_date: Mapped[Optional[datetime]]
+    loan_id: Mapped[Optional[int]]
+
+
+class OverdueNotice(Base):
+    """One per loan found overdue, recorded once however often the scan runs."""
+
+    __tablename__ = "overdue_notices"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # No foreign key, as the loan may since have moved to loan_history
+    loan_id: Mapped[int] = mapped_column(unique=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    book_id: Mapped[int] = mapped_column(ForeignKey("books.id"))
+    due_date: Mapped[datetime]
+    notified_at: Mapped[datetime] = mapped_column(
+        default=datetime.now, server_default=func.localtimestamp()
+    )
+
+
+class IdempotencyKey(Base):
+    """A client's Idempotency-Key and the response to the request that used it."""
+
+    __tablename__ = "idempotency_keys"
+
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # SHA-256 of the request, so a key reused for another request is caught
+    fingerprint: Mapped[bytes] = mapped_column(LargeBinary)
+    created_at: Mapped[datetime] = mapped_column(
+        default=datetime.now, server_default=func.localtimestamp()
+    )
+    # Null from the write's commit until the response is saved just after
+    status_code: Mapped[Optional[int]] = mapped_column(SmallInteger)
+    response: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
+
+    __table_args__ = (Index("ix_idempotency_keys_created_at", "created_at"),)
@@ -0,0 +1,41 @@
+import base64
+import binascii
+import json
+from typing import Optional, Protocol, Sequence, TypeVar
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 100
+
+
+class HasId(Protocol):
+    id: int
+
+
+T = TypeVar("T", bound=HasId)
+
+
+def encode_cursor(id: int) -> str:
+    payload = json.dumps({"id": id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    # Cursors are opaque to clients, so anything we can't decode is rejected
+    # rather than silently treated as the first page.
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+        id = payload["id"]
+    except (binascii.Error, ValueError, TypeError, KeyError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(id, int):
+        raise ValueError("Invalid cursor")
+    return id
+
+
+def paginate(rows: Sequence[T], limit: int) -> tuple[list[T], Optional[str]]:
+    """Split a `limit + 1` row fetch into the page and the cursor for the next one."""
+    items = list(rows[:limit])
+    if len(rows) <= limit:
+        return items, None
+    return items, encode_cursor(items[-1].id)
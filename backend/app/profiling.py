@@ -0,0 +1,213 @@
+import cProfile
+import functools
+import inspect
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from fastapi.routing import APIRoute
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger("app.slow_queries")
+
+
+@dataclass
+class RequestProfile:
+    sql_count: int = 0
+    db_time: float = 0.0
+    # Token check and principal lookup in the auth dependency
+    auth_time: float = 0.0
+    # bcrypt, including any wait for a free hashing thread
+    hash_time: float = 0.0
+    endpoint_time: float = 0.0
+    handler_time: float = 0.0
+
+    @property
+    def serialization_time(self) -> float:
+        """Route handler time outside the endpoint and auth.
+
+        That is mostly request validation and response serialization.
+        """
+        return max(self.handler_time - self.endpoint_time - self.auth_time, 0.0)
+
+
+_current_profile: ContextVar[Optional[RequestProfile]] = ContextVar(
+    "current_profile", default=None
+)
+
+
+def current_profile() -> Optional[RequestProfile]:
+    return _current_profile.get()
+
+
+@contextmanager
+def profile_timer(field: str) -> Iterator[None]:
+    """Add the time spent in the block to a field of the current request's profile."""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(profile, field, getattr(profile, field) + time.perf_counter() - start)
+
+
+def record_query(statement: str, elapsed: float) -> None:
+    if profile := _current_profile.get():
+        profile.sql_count += 1
+        profile.db_time += elapsed
+    if elapsed * 1000 >= get_settings().SLOW_QUERY_MS:
+        slow_query_logger.warning(
+            json.dumps(
+                {
+                    "duration_ms": round(elapsed * 1000, 2),
+                    "statement": " ".join(statement.split()),
+                }
+            )
+        )
+
+
+def _timed_endpoint(endpoint: Callable) -> Callable:
+    # FastAPI reads the signature through __wrapped__, so dependencies still resolve
+    @functools.wraps(endpoint)
+    async def timed(*args, **kwargs):
+        with profile_timer("endpoint_time"):
+            return await endpoint(*args, **kwargs)
+
+    return timed
+
+
+class ProfiledRoute(APIRoute):
+    """Splits route time into the endpoint itself and FastAPI's work around it."""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if inspect.iscoroutinefunction(endpoint):
+            endpoint = _timed_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def profiled_handler(request):
+            with profile_timer("handler_time"):
+                return await handler(request)
+
+        return profiled_handler
+
+
+class ProfilingMiddleware:
+    """Reports each request's profile in a Server-Timing header and a log line.
+
+    A sampled share of requests also run under cProfile, and the stats are kept
+    when the request is over the latency budget. The profiler sees the whole
+    event loop, so other requests running at the same time show up too.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.settings = get_settings()
+        self.profiling = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.settings.REQUEST_PROFILING:
+            await self.app(scope, receive, send)
+            return
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        start = time.perf_counter()
+        status = 500
+        profiler = self._start_profiler()
+
+        async def send_with_timing(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total = time.perf_counter() - start
+                headers = list(message.get("headers", []))
+                headers.append(
+                    (b"server-timing", _server_timing(profile, total).encode())
+                )
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            total = time.perf_counter() - start
+            _current_profile.reset(token)
+            if profiler is not None:
+                self._finish_profiler(profiler, scope, total)
+            logger.info(
+                json.dumps(
+                    {
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "status": status,
+                        "total_ms": _ms(total),
+                        "sql_count": profile.sql_count,
+                        "db_ms": _ms(profile.db_time),
+                        "auth_ms": _ms(profile.auth_time),
+                        "hash_ms": _ms(profile.hash_time),
+                        "serialize_ms": _ms(profile.serialization_time),
+                    }
+                )
+            )
+
+    def _start_profiler(self) -> Optional[cProfile.Profile]:
+        # Only one profiler can be active at a time
+        if self.profiling or random.random() >= self.settings.PROFILE_SAMPLE_RATE:
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        self.profiling = True
+        return profiler
+
+    def _finish_profiler(
+        self, profiler: cProfile.Profile, scope: Scope, total: float
+    ) -> None:
+        profiler.disable()
+        self.profiling = False
+        if total * 1000 < self.settings.PROFILE_LATENCY_BUDGET_MS:
+            return
+        directory = Path(self.settings.PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        name = scope["path"].strip("/").replace("/", "_") or "root"
+        path = (
+            directory
+            / f"{time.strftime('%Y%m%dT%H%M%S')}-{scope['method']}-{name}.prof"
+        )
+        profiler.dump_stats(path)
+        logger.warning(
+            "%s %s took %sms, profile saved to %s",
+            scope["method"],
+            scope["path"],
+            _ms(total),
+            path,
+        )
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+def _server_timing(profile: RequestProfile, total: float) -> str:
+    metrics = [
+        f'db;dur={_ms(profile.db_time)};desc="{profile.sql_count} queries"',
+        f"auth;dur={_ms(profile.auth_time)}",
+        f"hash;dur={_ms(profile.hash_time)}",
+        f"app;dur={_ms(profile.endpoint_time)}",
+        f"serialize;dur={_ms(profile.serialization_time)}",
+        f"total;dur={_ms(total)}",
+    ]
+    return ", ".join(metrics)
@@ -0,0 +1,354 @@
+"""EXPLAIN every CRUD query against a seeded database and flag sequential scans.
+
+The seed data and everything the queries write happen inside one transaction
+that is rolled back at the end, so the check can run against any database
+that is at the latest migration.
+"""
+
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from app.models import Role
+from app.schemas import BookSearchQuery, BookUpdate
+from app.services.book import BookCRUD, BookService
+from app.services.idempotency import IdempotencyCRUD
+from app.services.loan import LoanCRUD
+from app.services.loan_history import LoanHistoryCRUD
+from app.services.overdue import OverdueCRUD
+from app.services.user import UserCRUD
+
+# Tables that grow with use; a sequential scan on any of them is a regression
+LARGE_TABLES = {
+    "books",
+    "users",
+    "loans",
+    "loan_history",
+    "idempotency_keys",
+    "user_books",
+    "overdue_notices",
+}
+PLANNED_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+@dataclass
+class SeedIds:
+    user: int
+    other_user: int
+    book: int
+    other_book: int
+    author: str
+    username: str
+    open_loan: int
+    other_open_loan: int
+
+
+@dataclass
+class StatementPlan:
+    statement: str
+    seq_scans: list[str] = field(default_factory=list)
+
+
+@dataclass
+class QueryCheck:
+    name: str
+    plans: list[StatementPlan] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not any(plan.seq_scans for plan in self.plans)
+
+
+Scenario = Callable[[AsyncSession, SeedIds], Awaitable[Any]]
+
+SCENARIOS: dict[str, Scenario] = {
+    "books: first page": lambda s, ids: BookCRUD(s).get_books(limit=51),
+    "books: later page": lambda s, ids: BookCRUD(s).get_books(
+        limit=51, after_id=ids.book
+    ),
+    "books: by author": lambda s, ids: BookCRUD(s).get_books(
+        limit=51, author=ids.author
+    ),
+    "books: by title prefix": lambda s, ids: BookCRUD(s).get_books(
+        limit=51, title="Title 123"
+    ),
+    "books: available": lambda s, ids: BookCRUD(s).get_books(limit=51, available=True),
+    "books: page versions": lambda s, ids: BookCRUD(s).get_book_versions(
+        limit=51, after_id=ids.book
+    ),
+    "books: search": lambda s, ids: BookCRUD(s).search_books(
+        terms="title 123", limit=20
+    ),
+    # Matches nothing word for word, so it runs the fuzzy search where it can
+    "books: misspelt search": lambda s, ids: BookService(s).search_books(
+        query=BookSearchQuery(q="Titel 123")
+    ),
+    "books: typeahead": lambda s, ids: BookCRUD(s).typeahead(
+        prefix="title 12", limit=10
+    ),
+    "books: record": lambda s, ids: BookCRUD(s).get_book_record(id=ids.book),
+    "books: version": lambda s, ids: BookCRUD(s).get_book_version(id=ids.book),
+    "books: update": lambda s, ids: BookCRUD(s).update_book(
+        data=BookUpdate(id=ids.book, available_copies=3)
+    ),
+    "users: first page": lambda s, ids: UserCRUD(s).get_users(
+        roles=[Role.READER], limit=51
+    ),
+    "users: principal": lambda s, ids: UserCRUD(s).get_principal(username=ids.username),
+    "users: detail": lambda s, ids: UserCRUD(s).get_user_detail(id=ids.user),
+    "loans: open counts": lambda s, ids: LoanCRUD(s).get_open_loan_counts(
+        now=datetime.now()
+    ),
+    "loans: by id": lambda s, ids: LoanCRUD(s).get_loan_by_id(id=ids.open_loan),
+    "loans: checkout": lambda s, ids: LoanCRUD(s).checkout(
+        book_id=ids.other_book, user_id=ids.other_user
+    ),
+    "loans: return": lambda s, ids: LoanCRUD(s).return_loan(
+        id=ids.open_loan, returned_at=datetime.now()
+    ),
+    "loans: batch checkout": lambda s, ids: LoanCRUD(s).checkout_many(
+        items=[(ids.book, ids.user), (ids.other_book, ids.user)]
+    ),
+    "loans: batch return": lambda s, ids: LoanCRUD(s).return_many(
+        items=[(ids.other_open_loan, datetime.now())]
+    ),
+    "loans: history": lambda s, ids: LoanHistoryCRUD(s).get_history(
+        limit=51, before_id=ids.open_loan
+    ),
+    "loans: history by reader": lambda s, ids: LoanHistoryCRUD(s).get_history(
+        limit=51, user_id=ids.user
+    ),
+    "loans: history by book": lambda s, ids: LoanHistoryCRUD(s).get_history(
+        limit=51, book_id=ids.book
+    ),
+    # Only the oldest returns, as when the job runs daily or more often
+    "loans: archive batch": lambda s, ids: LoanHistoryCRUD(s).archive_batch(
+        cutoff=datetime.now() - timedelta(days=59), limit=500
+    ),
+    "idempotency: claim": lambda s, ids: IdempotencyCRUD(s).claim(
+        user_id=ids.user,
+        key="plan-check",
+        fingerprint=b"-",
+        expired_before=datetime.now() - timedelta(days=1),
+    ),
+    "idempotency: get": lambda s, ids: IdempotencyCRUD(s).get(
+        user_id=ids.user, key="key-1"
+    ),
+    # Only the oldest keys, as when the purge runs hourly
+    "idempotency: purge batch": lambda s, ids: IdempotencyCRUD(s).purge_batch(
+        expired_before=datetime.now() - timedelta(hours=23), limit=500
+    ),
+    "overdue: scan batch": lambda s, ids: OverdueCRUD(s).scan_batch(
+        now=datetime.now(), limit=500
+    ),
+    "overdue: notices": lambda s, ids: OverdueCRUD(s).get_notices(limit=51, open=True),
+}
+
+
+async def seed(conn: AsyncConnection, books: int, users: int, loans: int) -> SeedIds:
+    result = await conn.execute(
+        text(
+            """
+            INSERT INTO users (username, hashed_password, is_active, is_superuser, role)
+            SELECT 'plan-check-' || g, '-', true, false, 'READER'
+            FROM generate_series(1, :n) g
+            RETURNING id
+            """
+        ),
+        {"n": users},
+    )
+    user_ids = result.scalars().all()
+    result = await conn.execute(
+        text(
+            """
+            INSERT INTO books (title, author, available_copies)
+            SELECT 'Title ' || g, 'Author ' || g % 500, 5
+            FROM generate_series(1, :n) g
+            RETURNING id
+            """
+        ),
+        {"n": books},
+    )
+    book_ids = result.scalars().all()
+    # As many loans again returned long ago and archived, with the earlier ids
+    now = datetime.now()
+    params = {
+        "first_book": min(book_ids),
+        "books": len(book_ids),
+        "first_user": min(user_ids),
+        "users": len(user_ids),
+        "now": now,
+        "n": loans,
+    }
+    await conn.execute(
+        text(
+            """
+            INSERT INTO loan_history
+                (id, book_id, user_id, loaned_at, due_date, returned_at)
+            SELECT
+                nextval('loans_id_seq'),
+                :first_book + g % :books,
+                :first_user + g % :users,
+                :now - make_interval(days => 400 - g % 300 + 14),
+                :now - make_interval(days => 400 - g % 300) + interval '2 days',
+                :now - make_interval(days => 400 - g % 300)
+            FROM generate_series(1, :n) g
+            """
+        ),
+        params,
+    )
+    # One loan in ten is still out, and a few of those are overdue
+    await conn.execute(
+        text(
+            """
+            INSERT INTO loans (book_id, user_id, loaned_at, due_date, returned_at)
+            SELECT
+                :first_book + g % :books,
+                :first_user + g % :users,
+                :now - make_interval(days => g % 60 + 14),
+                :now - make_interval(days => g % 60) + interval '2 days',
+                CASE
+                    WHEN g % 10 = 0 THEN NULL
+                    ELSE :now - make_interval(days => g % 60)
+                END
+            FROM generate_series(1, :n) g
+            """
+        ),
+        params,
+    )
+    await conn.execute(
+        text(
+            """
+            INSERT INTO user_books (user_id, book_id)
+            SELECT DISTINCT user_id, book_id FROM loans WHERE returned_at IS NULL
+            ON CONFLICT DO NOTHING
+            """
+        )
+    )
+    await conn.execute(
+        text(
+            """
+            INSERT INTO overdue_notices (loan_id, user_id, book_id, due_date)
+            SELECT id, user_id, book_id, due_date FROM loans
+            WHERE returned_at IS NULL AND due_date < :now
+            ON CONFLICT DO NOTHING
+            """
+        ),
+        {"now": now - timedelta(days=30)},
+    )
+    # A day's worth of keys, one per request
+    await conn.execute(
+        text(
+            """
+            INSERT INTO idempotency_keys
+                (user_id, key, fingerprint, created_at, status_code, response)
+            SELECT
+                :first_user + g % :users,
+                'key-' || g,
+                '\\x00',
+                :now - make_interval(secs => g * 86400.0 / :n),
+                200,
+                '{}'
+            FROM generate_series(1, :n) g
+            """
+        ),
+        params,
+    )
+    for table in sorted(LARGE_TABLES):
+        await conn.execute(text(f"ANALYZE {table}"))
+    # New GIN entries wait in a pending list that the planner prices as a
+    # full scan; autovacuum merges it on a live database, so do the same here
+    await conn.execute(
+        text(
+            """
+            SELECT gin_clean_pending_list(i.indexrelid) FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = c.relam
+            WHERE am.amname = 'gin'
+            """
+        )
+    )
+    open_loans = (
+        await conn.execute(
+            text(
+                "SELECT id, user_id FROM loans WHERE returned_at IS NULL "
+                "ORDER BY id DESC LIMIT 2"
+            )
+        )
+    ).all()
+    return SeedIds(
+        user=open_loans[0].user_id,
+        other_user=user_ids[-1],
+        book=book_ids[len(book_ids) // 2],
+        other_book=book_ids[-1],
+        author="Author 7",
+        username=f"plan-check-{users // 2}",
+        open_loan=open_loans[0].id,
+        other_open_loan=open_loans[1].id,
+    )
+
+
+def find_seq_scans(plan: dict) -> list[str]:
+    found = []
+    if (
+        plan.get("Node Type") == "Seq Scan"
+        and plan.get("Relation Name") in LARGE_TABLES
+    ):
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        found.extend(find_seq_scans(child))
+    return found
+
+
+async def check_query_plans(
+    conn: AsyncConnection, books: int, users: int, loans: int
+) -> list[QueryCheck]:
+    """Run each scenario for real, then EXPLAIN every statement it issued."""
+    await conn.begin()
+    try:
+        ids = await seed(conn, books=books, users=users, loans=loans)
+        issued: list[tuple[str, Any]] = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(PLANNED_STATEMENTS):
+                # Batched inserts arrive as a list; the first set plans the same
+                if executemany and isinstance(parameters, list):
+                    parameters = parameters[0]
+                issued.append((statement, parameters))
+
+        sync_engine = conn.sync_engine
+        event.listen(sync_engine, "before_cursor_execute", record)
+        checks = []
+        try:
+            for name, scenario in SCENARIOS.items():
+                issued.clear()
+                # Commits inside the CRUD methods only release a savepoint
+                session = AsyncSession(
+                    bind=conn,
+                    join_transaction_mode="create_savepoint",
+                    expire_on_commit=False,
+                )
+                await scenario(session, ids)
+                await session.close()
+                checks.append(QueryCheck(name=name))
+                for statement, parameters in list(issued):
+                    checks[-1].plans.append(await explain(conn, statement, parameters))
+        finally:
+            event.remove(sync_engine, "before_cursor_execute", record)
+        return checks
+    finally:
+        await conn.rollback()
+
+
+async def explain(
+    conn: AsyncConnection, statement: str, parameters: Any
+) -> StatementPlan:
+    # EXPLAIN without ANALYZE plans the statement but never runs it
+    result = await conn.exec_driver_sql(
+        "EXPLAIN (FORMAT JSON) " + statement, parameters
+    )
+    plan = result.scalar_one()[0]["Plan"]
+    return StatementPlan(statement=statement, seq_scans=find_seq_scans(plan))
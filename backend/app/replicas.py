@@ -0,0 +1,191 @@
+"""Routing of read-only requests to streaming replicas of the primary.
+
+Replicas that are down or further behind than DB_REPLICA_MAX_LAG_SECONDS are
+skipped, as are the replicas of users who wrote in the last
+READ_YOUR_WRITES_SECONDS, so nobody reads a state older than their own
+writes. Everything falls back to the primary when no replica is usable.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import AsyncIterator, Optional
+
+from sqlalchemy import exc, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from app.cache import get_invalidation_bus
+from app.db import build_engine, get_engine, get_sessionmaker
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a replica to accept a connection before using the primary
+CONNECT_TIMEOUT = 2
+PRIMARY_LSN_QUERY = text("SELECT pg_current_wal_lsn()")
+# Having replayed what the primary had written when the check began means
+# caught up, even when the primary has been idle and the last replayed
+# transaction is old. Having replayed all it received doesn't: a replica cut
+# off from the primary has too. NULL if it hasn't replayed anything yet.
+LAG_QUERY = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_replay_lsn() >= CAST(:primary_lsn AS pg_lsn) THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+)
+
+
+class RecentWriters:
+    """Users who wrote recently, fed by the invalidation bus from every worker."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._until: dict[int, float] = {}
+        self._everyone_until = 0.0
+
+    def invalidate(self, user_id: int) -> None:
+        self._until[user_id] = time.monotonic() + self.window
+
+    def clear(self) -> None:
+        # Writes may have gone unheard, so treat everyone as a recent writer
+        self._everyone_until = time.monotonic() + self.window
+        self._until.clear()
+
+    def __contains__(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if now < self._everyone_until:
+            return True
+        until = self._until.get(user_id)
+        if until is None:
+            return False
+        if until <= now:
+            del self._until[user_id]
+            return False
+        return True
+
+
+@dataclass
+class Replica:
+    name: str
+    engine: AsyncEngine
+    sessionmaker: async_sessionmaker[AsyncSession]
+    # Unknown until the first check, and None again while unreachable
+    lag: Optional[float] = None
+
+
+class ReplicaSet:
+    def __init__(self, replicas: list[Replica], max_lag: float, window: float):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.writers = RecentWriters(window)
+        get_invalidation_bus().subscribe("writers", self.writers, parse=int)
+
+    def choose(self, user_id: int) -> Optional[Replica]:
+        """A usable replica for the user's reads, or None for the primary."""
+        if user_id in self.writers:
+            return None
+        usable = [
+            replica
+            for replica in self.replicas
+            if replica.lag is not None and replica.lag <= self.max_lag
+        ]
+        return random.choice(usable) if usable else None
+
+    async def check(self) -> None:
+        async with get_engine().connect() as conn:
+            primary_lsn = await conn.scalar(PRIMARY_LSN_QUERY)
+        for replica in self.replicas:
+            try:
+                async with asyncio.timeout(CONNECT_TIMEOUT):
+                    async with replica.engine.connect() as conn:
+                        lag = await conn.scalar(LAG_QUERY, {"primary_lsn": primary_lsn})
+            except (exc.DBAPIError, OSError, TimeoutError):
+                if replica.lag is not None:
+                    logger.warning("Replica %s is unreachable", replica.name)
+                replica.lag = None
+                continue
+            lag = float("inf") if lag is None else float(lag)
+            if lag > self.max_lag:
+                logger.warning("Replica %s is %.1fs behind", replica.name, lag)
+            replica.lag = lag
+
+    async def dispose(self) -> None:
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+
+@lru_cache
+def get_replica_set() -> ReplicaSet:
+    settings = get_settings()
+    replicas = []
+    for index, uri in enumerate(settings.DB_REPLICA_URIS):
+        engine = build_engine(uri, settings, connect_timeout=CONNECT_TIMEOUT)
+        replicas.append(
+            Replica(
+                name=f"{index}:{engine.url.host}",
+                engine=engine,
+                sessionmaker=async_sessionmaker(
+                    autoflush=False,
+                    expire_on_commit=False,
+                    bind=engine,
+                    info={"replica": True},
+                ),
+            )
+        )
+    return ReplicaSet(
+        replicas,
+        max_lag=settings.DB_REPLICA_MAX_LAG_SECONDS,
+        window=settings.READ_YOUR_WRITES_SECONDS,
+    )
+
+
+def _reset_after_fork() -> None:
+    # As for the primary engine in app.db
+    if get_replica_set.cache_info().currsize:
+        for replica in get_replica_set().replicas:
+            replica.engine.sync_engine.dispose(close=False)
+    get_replica_set.cache_clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+async def check_replicas() -> None:
+    await get_replica_set().check()
+
+
+async def record_write(session: AsyncSession, user_id: int) -> None:
+    """Keep the user's reads on the primary for a while once the session commits."""
+    if get_replica_set().replicas:
+        await get_invalidation_bus().publish(session, "writers", [user_id])
+
+
+@asynccontextmanager
+async def read_session(user_id: int) -> AsyncIterator[AsyncSession]:
+    """A session for read-only work, on a replica where one is usable."""
+    replica_set = get_replica_set()
+    replica = replica_set.choose(user_id)
+    if replica is not None:
+        session = replica.sessionmaker()
+        try:
+            # Connect now, so that a replica that went down since the last
+            # check costs this request a retry rather than an error
+            await session.connection()
+        except (exc.DBAPIError, OSError):
+            logger.warning("Replica %s is unreachable", replica.name)
+            replica.lag = None
+            await session.close()
+        else:
+            async with session:
+                yield session
+            return
+    async with get_sessionmaker()() as session:
+        yield session
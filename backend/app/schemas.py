@@ -1,9 +1,37 @@
 from datetime import datetime
-from typing import Optional
+from typing import Generic, Literal, Optional, TypeVar
 
-from pydantic import BaseModel, NonNegativeInt
+from pydantic import BaseModel, Field, NonNegativeInt, field_validator
 
 from app.models import Role
+from app.pagination import DEFAULT_LIMIT, MAX_LIMIT, decode_cursor
+
+T = TypeVar("T")
+
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: Optional[str] = None
+
+
+class PageParams(BaseModel):
+    limit: int = Field(default=DEFAULT_LIMIT, ge=1, le=MAX_LIMIT)
+    after: Optional[str] = None
+
+    @field_validator("after")
+    @classmethod
+    def check_cursor(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None:
+            decode_cursor(value)
+        return value
+
+    @property
+    def after_id(self) -> Optional[int]:
+        return decode_cursor(self.after) if self.after else None
+
+
+class UserQuery(PageParams):
+    pass
 
 
 class UserBase(BaseModel):
@@ -39,7 +67,23 @@ class TokenData(BaseModel):
     username: str
 
 
+class BookQuery(PageParams):
+    author: Optional[str] = None
+    # Matches titles starting with this value
+    title: Optional[str] = None
+    available: Optional[bool] = None
+
+
+class BookSearchQuery(BaseModel):
+    q: str = Field(min_length=1, max_length=200)
+    # 'text' ranks full-text matches; 'prefix' matches the start of titles
+    # and authors, for typeahead
+    mode: Literal["text", "prefix"] = "text"
+    limit: int = Field(default=20, ge=1, le=MAX_LIMIT)
+
+
 class BookBase(BaseModel):
+    title: str
     author: str
     description: Optional[str] = None
     available_copies: NonNegativeInt
@@ -49,6 +93,12 @@ class Book(BookBase):
     id: int
 
 
+class BookRecord(Book):
+    """A book as held in the read cache, detached from any session."""
+
+    version: int
+
+
 class BookCreate(BookBase):
     pass
 
@@ -58,6 +108,23 @@ class BookUpdate(BaseModel):
     available_copies: NonNegativeInt
 
 
+class RejectedRow(BaseModel):
+    line: int
+    errors: list[str]
+
+
+class BookImportBatch(BaseModel):
+    batch: int
+    inserted: int
+    rejected: list[RejectedRow]
+
+
+class BookImportReport(BaseModel):
+    inserted: int = 0
+    rejected: int = 0
+    batches: list[BookImportBatch] = []
+
+
 class LoanBase(BaseModel):
     book_id: int
     user_id: int
@@ -70,6 +137,51 @@ class Loan(LoanBase):
     returned_at: Optional[datetime] = None
 
 
+class LoanHistoryQuery(PageParams):
+    # Newest first, so `after` pages back in time
+    user_id: Optional[int] = None
+    book_id: Optional[int] = None
+
+
+class OpenLoanCounts(BaseModel):
+    open: int
+    overdue: int
+
+
+class OverdueQuery(PageParams):
+    # Only notices whose loan is still out (true) or has since come back (false)
+    open: Optional[bool] = None
+
+
+class OverdueNotice(BaseModel):
+    id: int
+    loan_id: int
+    user_id: int
+    book_id: int
+    due_date: datetime
+    notified_at: datetime
+    returned_at: Optional[datetime] = None
+
+
+class SeedReport(BaseModel):
+    users: int
+    books: int
+    loans: int
+    open_loans: int
+    seconds: float
+
+
+class OverdueScanReport(BaseModel):
+    batches: int = 0
+    scanned: int = 0
+    notified: int = 0
+
+
+class LoanArchiveReport(BaseModel):
+    batches: int = 0
+    archived: int = 0
+
+
 class LoanCreate(LoanBase):
     pass
 
@@ -77,3 +189,23 @@ class LoanCreate(LoanBase):
 class LoanUpdate(BaseModel):
     id: int
     returned_at: datetime
+
+
+MAX_LOAN_BATCH = 200
+
+
+class LoanBatchCreate(BaseModel):
+    loans: list[LoanCreate] = Field(min_length=1, max_length=MAX_LOAN_BATCH)
+
+
+class LoanBatchUpdate(BaseModel):
+    loans: list[LoanUpdate] = Field(min_length=1, max_length=MAX_LOAN_BATCH)
+
+
+class LoanBatchItem(BaseModel):
+    loan: Optional[Loan] = None
+    error: Optional[str] = None
+
+
+class LoanBatchResult(BaseModel):
+    results: list[LoanBatchItem]
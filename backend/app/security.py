@@ -1,9 +1,84 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Callable, Optional, TypeVar
 
 import jwt
+from passlib.context import CryptContext
 
+from app.profiling import profile_timer
 from app.settings import get_settings
 
+T = TypeVar("T")
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded thread pool so it never blocks the event loop.
+
+    bcrypt releases the GIL while hashing, so threads give real parallelism.
+    Work beyond `max_workers + max_queued` is rejected with `PasswordHasherBusy`
+    instead of piling up behind a login burst.
+    """
+
+    def __init__(self, rounds: int, max_workers: int, max_queued: int):
+        # Pinning the rounds marks hashes with any other cost as needing an update
+        self.context = CryptContext(
+            schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds
+        )
+        self.max_workers = max_workers
+        self.max_pending = max_workers + max_queued
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(
+        self, password: str, hashed_password: str
+    ) -> tuple[bool, Optional[str]]:
+        """Verify a password, and return a new hash if the stored one is outdated."""
+        return await self._run(
+            self.context.verify_and_update, password, hashed_password
+        )
+
+    async def _run(self, fn: Callable[..., T], *args) -> T:
+        # Only touched from the event loop thread, so a plain counter is enough
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="password-hasher"
+            )
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with profile_timer("hash_time"):
+                return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+
+@lru_cache
+def get_password_hasher() -> PasswordHasher:
+    settings = get_settings()
+    return PasswordHasher(
+        rounds=settings.BCRYPT_ROUNDS,
+        max_workers=settings.PASSWORD_HASH_WORKERS,
+        max_queued=settings.PASSWORD_HASH_QUEUE_SIZE,
+    )
+
+
+# The hasher threads don't exist in a forked child, so it starts afresh
+os.register_at_fork(after_in_child=get_password_hasher.cache_clear)
+
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -0,0 +1,77 @@
+"""Production entry point: uvicorn with WEB_CONCURRENCY worker processes.
+
+    python -m app.server --host 0.0.0.0 --port 8000
+
+Workers are started fresh rather than forked from a loaded app, so each builds
+its own engine and pool. On SIGTERM or SIGINT uvicorn stops accepting
+connections and gives in-flight requests SHUTDOWN_TIMEOUT_SECONDS to finish
+before the workers run their shutdown handlers.
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import uvicorn
+
+from app.db import pool_limits
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+def clear_worker_metrics(directory: Path) -> None:
+    """Delete the values that workers of an earlier run left in `directory`.
+
+    Only the <pid>.json files the metrics registry writes, and their .tmp
+    files, as the directory may hold other things.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    for path in directory.iterdir():
+        if path.suffix in (".json", ".tmp") and path.stem.isdigit() and path.is_file():
+            path.unlink(missing_ok=True)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    settings = get_settings()
+    workers = settings.WEB_CONCURRENCY
+    # Fail here, once, rather than in every worker
+    if workers > 1 and settings.CACHE_INVALIDATION_BACKEND == "local":
+        raise SystemExit(
+            "Workers would keep serving what the others changed; set "
+            "CACHE_INVALIDATION_BACKEND=postgres to run more than one"
+        )
+    pool_size, max_overflow = pool_limits(settings)
+    logging.basicConfig(level=logging.INFO)
+    logger.info(
+        "Starting %d workers, each with %d pooled and %d overflow connections",
+        workers,
+        pool_size,
+        max_overflow,
+    )
+    if workers > 1:
+        # Workers read their settings from the environment they inherit
+        metrics_dir = settings.METRICS_DIR or tempfile.mkdtemp(prefix="metrics-")
+        clear_worker_metrics(Path(metrics_dir))
+        os.environ["METRICS_DIR"] = metrics_dir
+
+    uvicorn.run(
+        "app.main:app",
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        timeout_graceful_shutdown=settings.SHUTDOWN_TIMEOUT_SECONDS,
+        proxy_headers=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
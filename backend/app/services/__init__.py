@@ -1,3 +1,5 @@
 from .book import BookService
 from .loan import LoanService
+from .loan_history import LoanHistoryService
+from .overdue import OverdueService
 from .user import UserService
@@ -1,42 +1,318 @@
-from typing import Optional
+from functools import lru_cache
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Optional
 
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from pydantic import ValidationError
+from sqlalchemy import (
+    Row,
+    Select,
+    func,
+    insert,
+    literal,
+    or_,
+    select,
+    text,
+    union_all,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.models import Book
-from app.schemas import BookCreate, BookUpdate
+from app import schemas
+from app.bulk import Record, Unreadable
+from app.cache import TTLCache, get_invalidation_bus
+from app.feed import publish_availability
+from app.models import SEARCH_CONFIG, Book
+from app.pagination import paginate
+from app.schemas import (
+    BookCreate,
+    BookImportBatch,
+    BookImportReport,
+    BookQuery,
+    BookRecord,
+    BookSearchQuery,
+    BookUpdate,
+    RejectedRow,
+)
+from app.settings import get_settings
+
+# Responses are built straight from these columns, skipping ORM hydration
+BOOK_COLUMNS = [getattr(Book, name) for name in schemas.Book.model_fields]
+BOOK_RECORD_COLUMNS = [getattr(Book, name) for name in BookRecord.model_fields]
+# Whether pg_trgm is installed, looked up on first use
+_trigram_search: Optional[bool] = None
+
+
+@lru_cache
+def get_book_cache() -> TTLCache[int, BookRecord]:
+    settings = get_settings()
+    cache: TTLCache[int, BookRecord] = TTLCache(
+        maxsize=settings.BOOK_CACHE_SIZE, ttl=settings.BOOK_CACHE_TTL_SECONDS
+    )
+    get_invalidation_bus().subscribe("books", cache, parse=int)
+    return cache
+
+
+async def invalidate_books(session: AsyncSession, ids: Iterable[int]) -> None:
+    """Drop the books from every worker's cache once the session commits."""
+    await get_invalidation_bus().publish(session, "books", ids)
 
 
 class BookService:
-    def __init__(self, session: Session):
+    def __init__(self, session: AsyncSession):
         self.crud = BookCRUD(session=session)
+        # A replica can still be behind an invalidation that already happened
+        self.cacheable = not session.info.get("replica")
+
+    async def get_books(
+        self, query: BookQuery
+    ) -> tuple[list[BookRecord], Optional[str]]:
+        """A page of books, with their versions for the page's ETag."""
+        books = await self.crud.get_books(
+            limit=query.limit + 1,
+            after_id=query.after_id,
+            author=query.author,
+            title=query.title,
+            available=query.available,
+        )
+        return paginate(books, limit=query.limit)
+
+    async def get_book_versions(
+        self, query: BookQuery
+    ) -> tuple[list[Row[tuple[int, int]]], Optional[str]]:
+        """The ids and versions of the page `get_books` would return, and no more."""
+        versions = await self.crud.get_book_versions(
+            limit=query.limit + 1,
+            after_id=query.after_id,
+            author=query.author,
+            title=query.title,
+            available=query.available,
+        )
+        return paginate(versions, limit=query.limit)
 
-    # TODO: Implement filtering and pagination
-    def get_books(self) -> list[Book]:
-        return self.crud.get_books()
+    async def search_books(self, query: BookSearchQuery) -> list[schemas.Book]:
+        if query.mode == "prefix":
+            return await self.crud.typeahead(prefix=query.q, limit=query.limit)
+        books = await self.crud.search_books(terms=query.q, limit=query.limit)
+        # Nothing matched word for word, so try for a misspelling
+        if not books and await self.crud.has_trigram_search():
+            books = await self.crud.search_books_fuzzy(terms=query.q, limit=query.limit)
+        return books
 
-    def get_book_by_id(self, id: int) -> Optional[Book]:
-        return self.crud.get_book_by_id(id=id)
+    def iter_books(self, chunk_size: int) -> AsyncIterator[list[schemas.Book]]:
+        """The whole catalogue in id order, in chunks of at most `chunk_size`."""
+        return self.crud.iter_books(chunk_size=chunk_size)
 
-    def create_book(self, data: BookCreate) -> Book:
-        return self.crud.create_book(data=data)
+    async def get_book_by_id(self, id: int) -> Optional[BookRecord]:
+        """Read-through the book cache; misses are not cached, so new ids show up."""
+        cache = get_book_cache()
+        if (cached := cache.get(id)) is not None:
+            return cached
+        generation = cache.generation
+        record = await self.crud.get_book_record(id=id)
+        if not record:
+            return None
+        # Skipped if the book was invalidated while it was being read
+        if self.cacheable:
+            cache.set(id, record, generation=generation)
+        return record
+
+    async def get_book_version(self, id: int) -> Optional[int]:
+        if (cached := get_book_cache().get(id)) is not None:
+            return cached.version
+        return await self.crud.get_book_version(id=id)
+
+    async def create_book(self, data: BookCreate) -> Book:
+        return await self.crud.create_book(data=data)
 
-    def update_book(self, data: BookUpdate) -> Optional[Book]:
-        return self.crud.update_book(data=data)
+    async def update_book(self, data: BookUpdate) -> Optional[Book]:
+        return await self.crud.update_book(data=data)
+
+    async def import_books(
+        self, records: AsyncIterable[tuple[int, Record]], batch_size: int
+    ) -> BookImportReport:
+        """Validate and insert streamed records, one transaction per batch.
+
+        Invalid rows are reported by line and skipped; the rest of their batch
+        is still inserted.
+        """
+        report = BookImportReport()
+        books: list[BookCreate] = []
+        rejected: list[RejectedRow] = []
+        async for line, record in records:
+            try:
+                if isinstance(record, Unreadable):
+                    rejected.append(RejectedRow(line=line, errors=[record.error]))
+                elif isinstance(record, str):
+                    books.append(BookCreate.model_validate_json(record))
+                else:
+                    books.append(BookCreate.model_validate(record))
+            except ValidationError as e:
+                rejected.append(RejectedRow(line=line, errors=_error_messages(e)))
+            if len(books) + len(rejected) >= batch_size:
+                await self._import_batch(report, books, rejected)
+                books, rejected = [], []
+        if books or rejected:
+            await self._import_batch(report, books, rejected)
+        return report
+
+    async def _import_batch(
+        self,
+        report: BookImportReport,
+        books: list[BookCreate],
+        rejected: list[RejectedRow],
+    ) -> None:
+        inserted = await self.crud.create_books(data=books)
+        report.inserted += inserted
+        report.rejected += len(rejected)
+        report.batches.append(
+            BookImportBatch(
+                batch=len(report.batches) + 1, inserted=inserted, rejected=rejected
+            )
+        )
 
 
 class BookCRUD:
-    def __init__(self, session: Session):
+    def __init__(self, session: AsyncSession):
         self.session = session
 
-    def get_books(self) -> list[Book]:
-        return self.session.query(Book).all()
+    async def get_books(
+        self,
+        limit: int,
+        after_id: Optional[int] = None,
+        author: Optional[str] = None,
+        title: Optional[str] = None,
+        available: Optional[bool] = None,
+    ) -> list[BookRecord]:
+        stmt = self._page(
+            BOOK_RECORD_COLUMNS, limit, after_id, author, title, available
+        )
+        # Column types already match the schema, so rows skip validation
+        return [
+            BookRecord.model_construct(**row._mapping)
+            for row in await self.session.execute(stmt)
+        ]
 
-    def get_book_by_id(self, id: int) -> Optional[Book]:
+    async def get_book_versions(
+        self,
+        limit: int,
+        after_id: Optional[int] = None,
+        author: Optional[str] = None,
+        title: Optional[str] = None,
+        available: Optional[bool] = None,
+    ) -> list[Row[tuple[int, int]]]:
+        stmt = self._page(
+            [Book.id, Book.version], limit, after_id, author, title, available
+        )
+        return list(await self.session.execute(stmt))
+
+    @staticmethod
+    def _page(
+        columns: Iterable[Any],
+        limit: int,
+        after_id: Optional[int],
+        author: Optional[str],
+        title: Optional[str],
+        available: Optional[bool],
+    ) -> Select:
+        # Keyset pagination on the primary key, so deep pages cost the same as the first
+        stmt = select(*columns).order_by(Book.id).limit(limit)
+        if after_id is not None:
+            stmt = stmt.where(Book.id > after_id)
+        if author is not None:
+            stmt = stmt.where(Book.author == author)
+        if title is not None:
+            stmt = stmt.where(Book.title.startswith(title, autoescape=True))
+        if available is True:
+            stmt = stmt.where(Book.available_copies > 0)
+        elif available is False:
+            stmt = stmt.where(Book.available_copies == 0)
+        return stmt
+
+    async def search_books(self, terms: str, limit: int) -> list[schemas.Book]:
+        query = func.websearch_to_tsquery(SEARCH_CONFIG, terms)
+        stmt = (
+            select(*BOOK_COLUMNS)
+            .where(Book.search_vector.bool_op("@@")(query))
+            .order_by(func.ts_rank_cd(Book.search_vector, query).desc(), Book.id)
+            .limit(limit)
+        )
+        return [
+            schemas.Book.model_construct(**row._mapping)
+            for row in await self.session.execute(stmt)
+        ]
+
+    async def search_books_fuzzy(self, terms: str, limit: int) -> list[schemas.Book]:
+        # % is pg_trgm's similarity operator, which the trigram indexes serve
+        similarity = func.greatest(
+            func.similarity(Book.title, terms), func.similarity(Book.author, terms)
+        )
+        stmt = (
+            select(*BOOK_COLUMNS)
+            .where(or_(Book.title.bool_op("%")(terms), Book.author.bool_op("%")(terms)))
+            .order_by(similarity.desc(), Book.id)
+            .limit(limit)
+        )
+        return [
+            schemas.Book.model_construct(**row._mapping)
+            for row in await self.session.execute(stmt)
+        ]
+
+    async def has_trigram_search(self) -> bool:
+        global _trigram_search
+        if _trigram_search is None:
+            stmt = text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            _trigram_search = bool(await self.session.scalar(stmt))
+        return _trigram_search
+
+    async def typeahead(self, prefix: str, limit: int) -> list[schemas.Book]:
+        """Books whose title, then those whose author, starts with `prefix`.
+
+        Each side is a range scan of its index that stops after `limit` rows,
+        however many books match.
+        """
+        prefix = prefix.lower()
+        sides = []
+        for side, column in enumerate((Book.title, Book.author)):
+            key = func.lower(column).collate("C")
+            sides.append(
+                select(*BOOK_COLUMNS, literal(side).label("side"), key.label("key"))
+                .where(key.startswith(prefix, autoescape=True))
+                .order_by(key)
+                .limit(limit)
+                .subquery()
+                .select()
+            )
+        matches = union_all(*sides).subquery()
+        stmt = select(*(matches.c[name] for name in schemas.Book.model_fields))
+        stmt = stmt.order_by(matches.c.side, matches.c.key)
+        books: dict[int, schemas.Book] = {}
+        for row in await self.session.execute(stmt):
+            # A book can match on both its title and its author
+            books.setdefault(row.id, schemas.Book.model_construct(**row._mapping))
+        return list(books.values())[:limit]
+
+    async def iter_books(self, chunk_size: int) -> AsyncIterator[list[schemas.Book]]:
+        # A server-side cursor, so only one chunk of rows is held at a time
+        stmt = (
+            select(*BOOK_COLUMNS)
+            .order_by(Book.id)
+            .execution_options(yield_per=chunk_size)
+        )
+        result = await self.session.stream(stmt)
+        async for rows in result.partitions():
+            yield [schemas.Book.model_construct(**row._mapping) for row in rows]
+
+    async def get_book_by_id(self, id: int) -> Optional[Book]:
         stmt = select(Book).where(Book.id == id)
-        return self.session.scalars(stmt).first()
+        return (await self.session.scalars(stmt)).first()
+
+    async def get_book_record(self, id: int) -> Optional[BookRecord]:
+        stmt = select(*BOOK_RECORD_COLUMNS).where(Book.id == id)
+        row = (await self.session.execute(stmt)).first()
+        return BookRecord.model_construct(**row._mapping) if row else None
 
-    def create_book(self, data: BookCreate) -> Book:
+    async def get_book_version(self, id: int) -> Optional[int]:
+        return await self.session.scalar(select(Book.version).where(Book.id == id))
+
+    async def create_book(self, data: BookCreate) -> Book:
         book = Book(
             title=data.title,
             author=data.author,
@@ -44,15 +320,39 @@ class BookCRUD:
             available_copies=data.available_copies,
         )
         self.session.add(book)
-        self.session.commit()
-        self.session.refresh(book)
+        await self.session.flush()
+        await publish_availability(self.session, [book.id])
+        await self.session.commit()
+        await self.session.refresh(book)
         return book
 
-    def update_book(self, data: BookUpdate) -> Optional[Book]:
-        book = self.get_book_by_id(id=data.id)
+    async def create_books(self, data: list[BookCreate]) -> int:
+        if not data:
+            return 0
+        # A list of parameter sets makes this a batched multi-row INSERT
+        await self.session.execute(insert(Book), [book.model_dump() for book in data])
+        await publish_availability(self.session, None)
+        await self.session.commit()
+        return len(data)
+
+    async def update_book(self, data: BookUpdate) -> Optional[Book]:
+        book = await self.get_book_by_id(id=data.id)
         if not book:
             return None
         book.available_copies = data.available_copies
-        self.session.commit()
-        self.session.refresh(book)
+        book.version += 1
+        await self.session.flush()
+        await invalidate_books(self.session, [book.id])
+        await publish_availability(self.session, [book.id])
+        await self.session.commit()
+        await self.session.refresh(book)
         return book
+
+
+def _error_messages(error: ValidationError) -> list[str]:
+    return [
+        f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}"
+        if e["loc"]
+        else e["msg"]
+        for e in error.errors()
+    ]
@@ -0,0 +1,172 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import any_, delete, func, literal_column, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import IdempotencyKey
+
+# Seconds between looks at a key whose write committed but whose response
+# isn't saved yet, which is usually a matter of milliseconds
+POLL_INTERVAL = 0.02
+# Expired keys deleted per transaction by the purge
+PURGE_BATCH_SIZE = 5000
+
+
+class IdempotencyService:
+    def __init__(self, session: AsyncSession):
+        self.crud = IdempotencyCRUD(session=session)
+
+    async def claim(
+        self, user_id: int, key: str, fingerprint: bytes, ttl: float, wait: float
+    ) -> Optional[IdempotencyKey]:
+        """Claim the key for this request, else return the request that holds it.
+
+        The claim is part of the session's transaction, so it commits along
+        with the write. A retry of a request still in flight waits on the
+        first one's claim until that commits or rolls back, then for its
+        response for up to `wait` seconds; the record returned may still have
+        no response if the wait runs out. Waiting rolls the session back, so
+        anything it did before the claim is undone.
+        """
+        deadline = time.monotonic() + wait
+        while True:
+            expired_before = datetime.now() - timedelta(seconds=ttl)
+            if await self.crud.claim(
+                user_id=user_id,
+                key=key,
+                fingerprint=fingerprint,
+                expired_before=expired_before,
+            ):
+                return None
+            record = await self.crud.get(user_id=user_id, key=key)
+            if record is None:
+                # Released by a request that failed; try to claim it again
+                continue
+            if (
+                record.response is not None
+                or record.fingerprint != fingerprint
+                or time.monotonic() >= deadline
+            ):
+                return record
+            # Hold no transaction open while waiting
+            await self.crud.rollback()
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def save_response(
+        self, user_id: int, key: str, status_code: int, response: bytes
+    ) -> None:
+        await self.crud.save_response(
+            user_id=user_id, key=key, status_code=status_code, response=response
+        )
+
+    async def release(self, user_id: int, key: str) -> None:
+        """Give up a claim whose request failed, so that a retry runs again."""
+        await self.crud.release(user_id=user_id, key=key)
+
+    async def purge(self, ttl: float, batch_size: int) -> int:
+        """Delete expired keys one batch per transaction, returning how many."""
+        expired_before = datetime.now() - timedelta(seconds=ttl)
+        purged = 0
+        while True:
+            deleted = await self.crud.purge_batch(
+                expired_before=expired_before, limit=batch_size
+            )
+            purged += deleted
+            if deleted < batch_size:
+                return purged
+
+
+class IdempotencyCRUD:
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def claim(
+        self, user_id: int, key: str, fingerprint: bytes, expired_before: datetime
+    ) -> bool:
+        # Waits on the unique key while another transaction holds the same
+        # claim uncommitted, but takes no lock on a key that is already taken
+        stmt = (
+            insert(IdempotencyKey)
+            .values(user_id=user_id, key=key, fingerprint=fingerprint)
+            .on_conflict_do_nothing(
+                index_elements=[IdempotencyKey.user_id, IdempotencyKey.key]
+            )
+            .returning(IdempotencyKey.user_id)
+        )
+        if (await self.session.execute(stmt)).first() is not None:
+            return True
+        # An expired key counts as free, whether or not the purge got to it
+        # yet. Only a row that is expired gets locked.
+        stmt = (
+            update(IdempotencyKey)
+            .where(
+                IdempotencyKey.user_id == user_id,
+                IdempotencyKey.key == key,
+                IdempotencyKey.created_at < expired_before,
+            )
+            .values(
+                fingerprint=fingerprint,
+                created_at=func.localtimestamp(),
+                status_code=None,
+                response=None,
+            )
+            .returning(IdempotencyKey.user_id)
+        )
+        return (await self.session.execute(stmt)).first() is not None
+
+    async def get(self, user_id: int, key: str) -> Optional[IdempotencyKey]:
+        stmt = (
+            select(IdempotencyKey)
+            .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+            # Each poll must see the row as it now is, not as first loaded
+            .execution_options(populate_existing=True)
+        )
+        return (await self.session.scalars(stmt)).first()
+
+    async def save_response(
+        self, user_id: int, key: str, status_code: int, response: bytes
+    ) -> None:
+        await self.session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+            .values(status_code=status_code, response=response)
+        )
+        await self.session.commit()
+
+    async def rollback(self) -> None:
+        await self.session.rollback()
+
+    async def release(self, user_id: int, key: str) -> None:
+        # The claim is gone with the rollback unless the write committed it
+        await self.session.rollback()
+        await self.session.execute(
+            delete(IdempotencyKey).where(
+                IdempotencyKey.user_id == user_id,
+                IdempotencyKey.key == key,
+                IdempotencyKey.response.is_(None),
+            )
+        )
+        await self.session.commit()
+
+    async def purge_batch(self, expired_before: datetime, limit: int) -> int:
+        # By row address, as the key has two columns
+        ctid = literal_column("ctid")
+        batch = (
+            select(ctid)
+            .select_from(IdempotencyKey)
+            .where(IdempotencyKey.created_at < expired_before)
+            .order_by(IdempotencyKey.created_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        result = await self.session.execute(
+            delete(IdempotencyKey).where(
+                ctid == any_(func.array(batch.scalar_subquery()))
+            )
+        )
+        await self.session.commit()
+        return result.rowcount
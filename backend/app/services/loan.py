@@ -1,43 +1,392 @@
+from collections import Counter
+from datetime import datetime
+from enum import StrEnum
 from typing import Optional
 
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from psycopg.errors import ForeignKeyViolation
+from sqlalchemy import (
+    DateTime,
+    Integer,
+    and_,
+    column,
+    delete,
+    exists,
+    func,
+    insert,
+    literal,
+    select,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.models import Loan
-from app.schemas import LoanCreate, LoanUpdate
+from app.feed import publish_availability
+from app.metrics import LOAN_CHECKOUTS, LOAN_RETURNS
+from app.models import LOAN_PERIOD, Book, Loan, User, user_books_association
+from app.schemas import LoanCreate, LoanUpdate, OpenLoanCounts
+from app.services.book import invalidate_books
+from app.services.loan_history import LoanHistoryCRUD
+
+
+class LoanError(StrEnum):
+    BOOK_NOT_FOUND = "Book not found"
+    USER_NOT_FOUND = "User not found"
+    NO_AVAILABLE_COPIES = "No available copies"
+    LOAN_NOT_FOUND = "Loan not found"
+    ALREADY_RETURNED = "Loan already returned"
+    DUPLICATE = "Loan appears more than once in the batch"
 
 
 class LoanService:
-    def __init__(self, session: Session):
+    def __init__(self, session: AsyncSession):
         self.crud = LoanCRUD(session=session)
 
-    def create_loan(self, data: LoanCreate) -> Loan:
-        return self.crud.create_loan(data=data)
+    async def get_loan_by_id(self, id: int) -> Optional[Loan]:
+        return await self.crud.get_loan_by_id(id=id)
+
+    async def is_archived(self, id: int) -> bool:
+        return id in await LoanHistoryCRUD(self.crud.session).get_archived_ids(ids=[id])
 
-    def update_loan(self, data: LoanUpdate) -> Optional[Loan]:
-        return self.crud.update_loan(data=data)
+    async def get_open_loan_counts(self, now: datetime) -> OpenLoanCounts:
+        return await self.crud.get_open_loan_counts(now=now)
+
+    async def checkout(self, data: LoanCreate) -> Loan | LoanError:
+        """Create a loan if the book has a copy available, else say why not."""
+        result = await self.crud.checkout(book_id=data.book_id, user_id=data.user_id)
+        if isinstance(result, Loan):
+            LOAN_CHECKOUTS.inc()
+        return result
+
+    async def return_loan(self, data: LoanUpdate) -> Optional[Loan]:
+        """Mark an open loan as returned, else return None."""
+        loan = await self.crud.return_loan(id=data.id, returned_at=data.returned_at)
+        if loan:
+            LOAN_RETURNS.inc()
+        return loan
+
+    async def checkout_many(self, data: list[LoanCreate]) -> list[Loan | LoanError]:
+        """Check out a batch in one transaction, one result per item in input order."""
+        results = await self.crud.checkout_many(
+            items=[(item.book_id, item.user_id) for item in data]
+        )
+        LOAN_CHECKOUTS.inc(amount=sum(isinstance(r, Loan) for r in results))
+        return results
+
+    async def return_many(self, data: list[LoanUpdate]) -> list[Loan | LoanError]:
+        """Return a batch in one transaction, with a result per item in input order."""
+        results = await self.crud.return_many(
+            items=[(item.id, item.returned_at) for item in data]
+        )
+        LOAN_RETURNS.inc(amount=sum(isinstance(r, Loan) for r in results))
+        return results
 
 
 class LoanCRUD:
-    def __init__(self, session: Session):
+    def __init__(self, session: AsyncSession):
         self.session = session
 
-    def get_loan_by_id(self, id: int) -> Optional[Loan]:
+    async def get_loan_by_id(self, id: int) -> Optional[Loan]:
         stmt = select(Loan).where(Loan.id == id)
-        return self.session.scalars(stmt).first()
+        return (await self.session.scalars(stmt)).first()
+
+    async def get_open_loan_counts(self, now: datetime) -> OpenLoanCounts:
+        # Both counts come from the partial index on open loans
+        stmt = select(
+            func.count().label("open"),
+            func.count().filter(Loan.due_date < now).label("overdue"),
+        ).where(Loan.returned_at.is_(None))
+        row = (await self.session.execute(stmt)).one()
+        return OpenLoanCounts(open=row.open, overdue=row.overdue)
 
-    def create_loan(self, data: LoanCreate) -> Loan:
-        loan = Loan(book_id=data.book_id, user_id=data.user_id)
-        self.session.add(loan)
-        self.session.commit()
-        self.session.refresh(loan)
+    async def checkout(self, book_id: int, user_id: int) -> Loan | LoanError:
+        # The decrement, loan insert and 'borrowed_books' insert are a single
+        # statement: the conditional UPDATE takes the row lock, so concurrent
+        # checkouts of the same book queue on it rather than overselling copies.
+        decremented = (
+            update(Book)
+            .where(Book.id == book_id, Book.available_copies > 0)
+            .values(
+                available_copies=Book.available_copies - 1, version=Book.version + 1
+            )
+            .returning(Book.id)
+            .cte("decremented")
+        )
+        # A concurrent checkout of the same book by the same user can't see
+        # this one's row yet, so only the key conflict tells them apart
+        borrowed = (
+            pg_insert(user_books_association)
+            .from_select(
+                ["user_id", "book_id"], select(literal(user_id), decremented.c.id)
+            )
+            .on_conflict_do_nothing()
+            .cte("borrowed")
+        )
+        # Column defaults aren't applied to INSERT ... SELECT, so set the dates here
+        loaned_at = datetime.now()
+        stmt = (
+            insert(Loan)
+            .from_select(
+                ["book_id", "user_id", "loaned_at", "due_date"],
+                select(
+                    decremented.c.id,
+                    literal(user_id),
+                    literal(loaned_at),
+                    literal(loaned_at + LOAN_PERIOD),
+                ),
+            )
+            .returning(Loan)
+            .add_cte(borrowed)
+        )
+        try:
+            loan = (
+                await self.session.scalars(select(Loan).from_statement(stmt))
+            ).first()
+        except IntegrityError as error:
+            await self.session.rollback()
+            # The book id comes from the updated row, so only the user can be missing
+            if isinstance(error.orig, ForeignKeyViolation):
+                return LoanError.USER_NOT_FOUND
+            raise
+        if not loan:
+            await self.session.rollback()
+            book_exists = await self.session.scalar(
+                select(exists().where(Book.id == book_id))
+            )
+            return (
+                LoanError.NO_AVAILABLE_COPIES
+                if book_exists
+                else LoanError.BOOK_NOT_FOUND
+            )
+        await invalidate_books(self.session, [book_id])
+        await publish_availability(
+            self.session, [book_id], loans=[(loan.id, book_id, "checkout")]
+        )
+        await self.session.commit()
         return loan
 
-    def update_loan(self, data: LoanUpdate) -> Optional[Loan]:
-        loan = self.get_loan_by_id(id=data.id)
+    async def return_loan(self, id: int, returned_at: datetime) -> Optional[Loan]:
+        stmt = (
+            update(Loan)
+            .where(Loan.id == id, Loan.returned_at.is_(None))
+            .values(returned_at=returned_at)
+            .returning(Loan)
+        )
+        loan = (await self.session.scalars(select(Loan).from_statement(stmt))).first()
         if not loan:
+            await self.session.rollback()
             return None
-        loan.returned_at = data.returned_at
-        self.session.commit()
-        self.session.refresh(loan)
+        # The book stays in 'borrowed_books' while the user has another copy out
+        other_open_loans = exists().where(
+            Loan.user_id == loan.user_id,
+            Loan.book_id == loan.book_id,
+            Loan.returned_at.is_(None),
+        )
+        unborrowed = (
+            delete(user_books_association)
+            .where(
+                and_(
+                    user_books_association.c.user_id == loan.user_id,
+                    user_books_association.c.book_id == loan.book_id,
+                    ~other_open_loans,
+                )
+            )
+            .cte("unborrowed")
+        )
+        await self.session.execute(
+            update(Book)
+            .where(Book.id == loan.book_id)
+            .values(
+                available_copies=Book.available_copies + 1, version=Book.version + 1
+            )
+            .add_cte(unborrowed)
+            .execution_options(synchronize_session=False)
+        )
+        await invalidate_books(self.session, [loan.book_id])
+        await publish_availability(
+            self.session, [loan.book_id], loans=[(loan.id, loan.book_id, "return")]
+        )
+        await self.session.commit()
         return loan
+
+    async def checkout_many(
+        self, items: list[tuple[int, int]]
+    ) -> list[Loan | LoanError]:
+        # Each step below is one set-based statement however large the batch is
+        book_ids = sorted({book_id for book_id, _ in items})
+        user_ids = {user_id for _, user_id in items}
+        # Lock in id order so concurrent batches over the same books can't deadlock
+        available = dict(
+            (
+                await self.session.execute(
+                    select(Book.id, Book.available_copies)
+                    .where(Book.id.in_(book_ids))
+                    .order_by(Book.id)
+                    .with_for_update()
+                )
+            ).all()
+        )
+        existing_users = set(
+            await self.session.scalars(select(User.id).where(User.id.in_(user_ids)))
+        )
+
+        results: list[Loan | LoanError | None] = []
+        accepted: list[int] = []
+        taken: Counter[int] = Counter()
+        for index, (book_id, user_id) in enumerate(items):
+            if book_id not in available:
+                results.append(LoanError.BOOK_NOT_FOUND)
+            elif user_id not in existing_users:
+                results.append(LoanError.USER_NOT_FOUND)
+            elif available[book_id] - taken[book_id] < 1:
+                results.append(LoanError.NO_AVAILABLE_COPIES)
+            else:
+                taken[book_id] += 1
+                accepted.append(index)
+                results.append(None)
+        if not accepted:
+            await self.session.rollback()
+            return results  # type: ignore[return-value]
+
+        taken_copies = values(
+            column("id", Integer), column("n", Integer), name="taken_copies"
+        ).data(list(taken.items()))
+        await self.session.execute(
+            update(Book)
+            .where(Book.id == taken_copies.c.id)
+            .values(
+                available_copies=Book.available_copies - taken_copies.c.n,
+                version=Book.version + 1,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        loaned_at = datetime.now()
+        loans = (
+            await self.session.scalars(
+                insert(Loan).returning(Loan, sort_by_parameter_order=True),
+                [
+                    {
+                        "book_id": items[index][0],
+                        "user_id": items[index][1],
+                        "loaned_at": loaned_at,
+                        "due_date": loaned_at + LOAN_PERIOD,
+                    }
+                    for index in accepted
+                ],
+            )
+        ).all()
+        borrowed = values(
+            column("user_id", Integer), column("book_id", Integer), name="borrowed"
+        ).data(sorted({(items[index][1], items[index][0]) for index in accepted}))
+        await self.session.execute(
+            insert(user_books_association).from_select(
+                ["user_id", "book_id"],
+                select(borrowed.c.user_id, borrowed.c.book_id).where(
+                    ~exists().where(
+                        user_books_association.c.user_id == borrowed.c.user_id,
+                        user_books_association.c.book_id == borrowed.c.book_id,
+                    )
+                ),
+            )
+        )
+        await invalidate_books(self.session, taken)
+        await publish_availability(
+            self.session,
+            taken,
+            loans=[(loan.id, loan.book_id, "checkout") for loan in loans],
+        )
+        await self.session.commit()
+        for index, loan in zip(accepted, loans):
+            results[index] = loan
+        return results  # type: ignore[return-value]
+
+    async def return_many(
+        self, items: list[tuple[int, datetime]]
+    ) -> list[Loan | LoanError]:
+        results: list[Loan | LoanError | None] = [None] * len(items)
+        first_index: dict[int, int] = {}
+        for index, (id, _) in enumerate(items):
+            if id in first_index:
+                results[index] = LoanError.DUPLICATE
+            else:
+                first_index[id] = index
+
+        returns = values(
+            column("id", Integer), column("returned_at", DateTime), name="returns"
+        ).data([(id, items[index][1]) for id, index in first_index.items()])
+        stmt = (
+            update(Loan)
+            .where(Loan.id == returns.c.id, Loan.returned_at.is_(None))
+            .values(returned_at=returns.c.returned_at)
+            .returning(Loan)
+        )
+        returned = {
+            loan.id: loan
+            for loan in await self.session.scalars(select(Loan).from_statement(stmt))
+        }
+
+        if returned:
+            counts = Counter(loan.book_id for loan in returned.values())
+            await self.session.execute(
+                select(Book.id)
+                .where(Book.id.in_(counts))
+                .order_by(Book.id)
+                .with_for_update()
+            )
+            returned_copies = values(
+                column("id", Integer), column("n", Integer), name="returned_copies"
+            ).data(list(counts.items()))
+            await self.session.execute(
+                update(Book)
+                .where(Book.id == returned_copies.c.id)
+                .values(
+                    available_copies=Book.available_copies + returned_copies.c.n,
+                    version=Book.version + 1,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            unborrowed = values(
+                column("user_id", Integer),
+                column("book_id", Integer),
+                name="unborrowed",
+            ).data(sorted({(loan.user_id, loan.book_id) for loan in returned.values()}))
+            await self.session.execute(
+                delete(user_books_association)
+                .where(
+                    user_books_association.c.user_id == unborrowed.c.user_id,
+                    user_books_association.c.book_id == unborrowed.c.book_id,
+                    ~exists().where(
+                        Loan.user_id == unborrowed.c.user_id,
+                        Loan.book_id == unborrowed.c.book_id,
+                        Loan.returned_at.is_(None),
+                    ),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await invalidate_books(self.session, counts)
+            await publish_availability(
+                self.session,
+                counts,
+                loans=[(loan.id, loan.book_id, "return") for loan in returned.values()],
+            )
+
+        missing = [id for id in first_index if id not in returned]
+        existing = set()
+        if missing:
+            existing.update(
+                await self.session.scalars(select(Loan.id).where(Loan.id.in_(missing)))
+            )
+            # Archived loans were all returned long ago
+            existing.update(
+                await LoanHistoryCRUD(self.session).get_archived_ids(ids=missing)
+            )
+        await self.session.commit()
+        for id, index in first_index.items():
+            if id in returned:
+                results[index] = returned[id]
+            elif id in existing:
+                results[index] = LoanError.ALREADY_RETURNED
+            else:
+                results[index] = LoanError.LOAN_NOT_FOUND
+        return results  # type: ignore[return-value]
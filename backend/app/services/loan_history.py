@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+from sqlalchemy import any_, delete, func, insert, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import schemas
+from app.models import Loan, LoanHistory
+from app.pagination import paginate
+from app.schemas import LoanArchiveReport, LoanHistoryQuery
+
+HISTORY_FIELDS = list(schemas.Loan.model_fields)
+
+
+class LoanHistoryService:
+    def __init__(self, session: AsyncSession):
+        self.crud = LoanHistoryCRUD(session=session)
+
+    async def get_history(
+        self, query: LoanHistoryQuery
+    ) -> tuple[list[schemas.Loan], Optional[str]]:
+        loans = await self.crud.get_history(
+            limit=query.limit + 1,
+            before_id=query.after_id,
+            user_id=query.user_id,
+            book_id=query.book_id,
+        )
+        return paginate(loans, limit=query.limit)
+
+    async def archive(
+        self, older_than: timedelta, batch_size: int
+    ) -> LoanArchiveReport:
+        """Move loans returned more than `older_than` ago to loan_history.
+
+        One batch per transaction, so no transaction outlives a batch and
+        returns and checkouts never wait long on the rows being moved.
+        """
+        report = LoanArchiveReport()
+        cutoff = datetime.now() - older_than
+        while True:
+            archived = await self.crud.archive_batch(cutoff=cutoff, limit=batch_size)
+            report.batches += 1
+            report.archived += archived
+            if archived < batch_size:
+                return report
+
+
+class LoanHistoryCRUD:
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def get_history(
+        self,
+        limit: int,
+        before_id: Optional[int] = None,
+        user_id: Optional[int] = None,
+        book_id: Optional[int] = None,
+    ) -> list[schemas.Loan]:
+        """Returned loans, archived or not yet, newest first."""
+        sides = []
+        for model in (Loan, LoanHistory):
+            stmt = (
+                select(*(getattr(model, name) for name in HISTORY_FIELDS))
+                .order_by(model.id.desc())
+                .limit(limit)
+            )
+            if model is Loan:
+                stmt = stmt.where(Loan.returned_at.is_not(None))
+            if before_id is not None:
+                stmt = stmt.where(model.id < before_id)
+            if user_id is not None:
+                stmt = stmt.where(model.user_id == user_id)
+            if book_id is not None:
+                stmt = stmt.where(model.book_id == book_id)
+            sides.append(stmt.subquery().select())
+        # A loan is in one table or the other in any one snapshot, never both
+        loans = union_all(*sides).subquery()
+        stmt = select(loans).order_by(loans.c.id.desc()).limit(limit)
+        return [
+            schemas.Loan.model_construct(**row._mapping)
+            for row in await self.session.execute(stmt)
+        ]
+
+    async def get_archived_ids(self, ids: Iterable[int]) -> set[int]:
+        stmt = select(LoanHistory.id).where(LoanHistory.id.in_(list(ids)))
+        return set(await self.session.scalars(stmt))
+
+    async def archive_batch(self, cutoff: datetime, limit: int) -> int:
+        """Move up to `limit` loans returned before `cutoff`, returning how many."""
+        # Walks the partial index on returned loans from the oldest return;
+        # rows another archiver holds are left to it
+        batch = (
+            select(Loan.id)
+            .where(Loan.returned_at < cutoff)
+            .order_by(Loan.returned_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        # An array rather than IN, so the delete looks the batch up by key
+        # instead of joining it against the whole table
+        moved = (
+            delete(Loan)
+            .where(Loan.id == any_(func.array(batch.scalar_subquery())))
+            .returning(*(getattr(Loan, name) for name in HISTORY_FIELDS))
+            .cte("moved")
+        )
+        archived = (
+            insert(LoanHistory)
+            .from_select(HISTORY_FIELDS, select(moved))
+            .returning(LoanHistory.id)
+            .cte("archived")
+        )
+        count = await self.session.scalar(select(func.count()).select_from(archived))
+        await self.session.commit()
+        return count or 0
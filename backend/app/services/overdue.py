@@ -0,0 +1,142 @@
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import schemas
+from app.models import Loan, LoanHistory, OverdueNotice, OverdueScanCursor
+from app.pagination import paginate
+from app.schemas import OverdueQuery, OverdueScanReport
+
+logger = logging.getLogger(__name__)
+
+NOTICE_COLUMNS = [
+    OverdueNotice.id,
+    OverdueNotice.loan_id,
+    OverdueNotice.user_id,
+    OverdueNotice.book_id,
+    OverdueNotice.due_date,
+    OverdueNotice.notified_at,
+]
+
+
+class OverdueService:
+    def __init__(self, session: AsyncSession):
+        self.crud = OverdueCRUD(session=session)
+
+    async def get_notices(
+        self, query: OverdueQuery
+    ) -> tuple[list[schemas.OverdueNotice], Optional[str]]:
+        notices = await self.crud.get_notices(
+            limit=query.limit + 1, after_id=query.after_id, open=query.open
+        )
+        return paginate(notices, limit=query.limit)
+
+    async def scan(self, batch_size: int) -> OverdueScanReport:
+        """Record a notice for every open loan that fell due since the last scan.
+
+        Works forward from the stored cursor one batch per transaction, so no
+        transaction outlives a batch and an interrupted scan resumes where it
+        stopped. Loans are only ever created with a future due date, so nothing
+        can appear behind the cursor. The seeder, which backdates loans, resets
+        it.
+        """
+        report = OverdueScanReport()
+        now = datetime.now()
+        while True:
+            found, notified = await self.crud.scan_batch(now=now, limit=batch_size)
+            report.batches += 1
+            report.scanned += found
+            report.notified += notified
+            if found < batch_size:
+                return report
+
+
+class OverdueCRUD:
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def get_notices(
+        self, limit: int, after_id: Optional[int] = None, open: Optional[bool] = None
+    ) -> list[schemas.OverdueNotice]:
+        if open is True:
+            # Open loans are never archived
+            stmt = (
+                select(*NOTICE_COLUMNS, Loan.returned_at)
+                .join(Loan, Loan.id == OverdueNotice.loan_id)
+                .where(Loan.returned_at.is_(None))
+            )
+        else:
+            # The loan is in one table or the other, depending on its age
+            returned_at = func.coalesce(Loan.returned_at, LoanHistory.returned_at)
+            stmt = (
+                select(*NOTICE_COLUMNS, returned_at.label("returned_at"))
+                .outerjoin(Loan, Loan.id == OverdueNotice.loan_id)
+                .outerjoin(LoanHistory, LoanHistory.id == OverdueNotice.loan_id)
+            )
+            if open is False:
+                stmt = stmt.where(returned_at.is_not(None))
+        stmt = stmt.order_by(OverdueNotice.id).limit(limit)
+        if after_id is not None:
+            stmt = stmt.where(OverdueNotice.id > after_id)
+        return [
+            schemas.OverdueNotice.model_construct(**row._mapping)
+            for row in await self.session.execute(stmt)
+        ]
+
+    async def scan_batch(self, now: datetime, limit: int) -> tuple[int, int]:
+        """Process the next batch after the cursor, returning (found, notified)."""
+        # Locking the cursor row makes concurrent scanners take turns per batch
+        cursor = (
+            await self.session.scalars(
+                select(OverdueScanCursor)
+                .where(OverdueScanCursor.id == 1)
+                .with_for_update()
+            )
+        ).one()
+        # Walks the partial index on open loans in (due_date, id) order
+        stmt = (
+            select(Loan.id, Loan.user_id, Loan.book_id, Loan.due_date)
+            .where(Loan.returned_at.is_(None), Loan.due_date < now)
+            .order_by(Loan.due_date, Loan.id)
+            .limit(limit)
+        )
+        if cursor.due_date is not None:
+            stmt = stmt.where(
+                tuple_(Loan.due_date, Loan.id) > (cursor.due_date, cursor.loan_id)
+            )
+        loans = (await self.session.execute(stmt)).all()
+        if not loans:
+            await self.session.rollback()
+            return 0, 0
+        notified = await self.session.scalars(
+            insert(OverdueNotice)
+            .values(
+                [
+                    {
+                        "loan_id": loan.id,
+                        "user_id": loan.user_id,
+                        "book_id": loan.book_id,
+                        "due_date": loan.due_date,
+                        "notified_at": now,
+                    }
+                    for loan in loans
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=[OverdueNotice.loan_id])
+            .returning(OverdueNotice.loan_id)
+        )
+        notified_ids = notified.all()
+        last = loans[-1]
+        await self.session.execute(
+            update(OverdueScanCursor)
+            .where(OverdueScanCursor.id == 1)
+            .values(due_date=last.due_date, loan_id=last.id)
+        )
+        await self.session.commit()
+        for loan_id in notified_ids:
+            logger.info("Loan %s is overdue", loan_id)
+        return len(loans), len(notified_ids)
@@ -1,33 +1,79 @@
+from functools import lru_cache
 from typing import Iterable, Optional
 
-from passlib.context import CryptContext
-from sqlalchemy import select
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
-from app.models import Role, User
-from app.schemas import UserCreate, UserUpdate
+from app import schemas
+from app.cache import TTLCache, get_invalidation_bus
+from app.models import Book, Role, User, user_books_association
+from app.pagination import paginate
+from app.schemas import UserCreate, UserQuery, UserUpdate
+from app.security import get_password_hasher
+from app.settings import get_settings
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Responses are built straight from these columns, skipping ORM hydration
+USER_COLUMNS = [getattr(User, name) for name in schemas.User.model_fields]
+BOOK_COLUMNS = [getattr(Book, name) for name in schemas.Book.model_fields]
+
+
+@lru_cache
+def get_principal_cache() -> TTLCache[str, schemas.User]:
+    """Authenticated users by token subject, so most requests skip the user lookup."""
+    settings = get_settings()
+    cache: TTLCache[str, schemas.User] = TTLCache(
+        maxsize=settings.PRINCIPAL_CACHE_SIZE,
+        ttl=settings.PRINCIPAL_CACHE_TTL_SECONDS,
+    )
+    get_invalidation_bus().subscribe("principals", cache, parse=str)
+    return cache
+
+
+async def invalidate_principals(
+    session: AsyncSession, usernames: Iterable[str]
+) -> None:
+    """Drop the users from every worker's principal cache once the session commits."""
+    await get_invalidation_bus().publish(session, "principals", usernames)
 
 
 class UserService:
-    def __init__(self, session: Session, current_user: Optional[User] = None):
+    def __init__(
+        self, session: AsyncSession, current_user: Optional[schemas.User] = None
+    ):
         self.crud = UserCRUD(session=session)
         self.current_user = current_user
 
-    def get_users(self) -> list[User]:
+    async def get_users(
+        self, query: UserQuery
+    ) -> tuple[list[schemas.User], Optional[str]]:
         roles = {Role.READER}
         if self.current_user and self.current_user.role == Role.ADMIN:
             roles.add(Role.ADMIN)
-        return self.crud.get_users(roles=roles)
-
-    def get_user_by_username(self, username: str) -> Optional[User]:
-        return self.crud.get_user_by_username(username=username)
+        users = await self.crud.get_users(
+            roles=roles, limit=query.limit + 1, after_id=query.after_id
+        )
+        return paginate(users, limit=query.limit)
+
+    async def get_user_by_username(self, username: str) -> Optional[User]:
+        return await self.crud.get_user_by_username(username=username)
+
+    async def get_principal(self, username: str) -> Optional[schemas.User]:
+        cache = get_principal_cache()
+        if (cached := cache.get(username)) is not None:
+            return cached
+        generation = cache.generation
+        principal = await self.crud.get_principal(username=username)
+        if not principal:
+            return None
+        # Skipped if the user was invalidated while it was being read
+        cache.set(username, principal, generation=generation)
+        return principal
 
     # TODO: Signatures should be better aligned.
     # For example, this method includes borrowed books, but the `by_username` method above does not.
-    def get_user_by_id(self, id: int) -> Optional[User]:
-        user = self.crud.get_user_by_id(id=id)
+    async def get_user_by_id(self, id: int) -> Optional[schemas.UserDetail]:
+        user = await self.crud.get_user_detail(id=id)
         if not user:
             return None
         # Initial draft of role-based permissions, where only admins can view other admin users
@@ -39,9 +85,9 @@ class UserService:
             return None
         return user
 
-    def create_user(self, data: UserCreate) -> User:
-        hashed_password = self._get_password_hash(password=data.password)
-        return self.crud.create_user(
+    async def create_user(self, data: UserCreate) -> User:
+        hashed_password = await get_password_hasher().hash(data.password)
+        return await self.crud.create_user(
             username=data.username,
             hashed_password=hashed_password,
             is_active=data.is_active,
@@ -49,45 +95,87 @@ class UserService:
             role=data.role,
         )
 
-    def update_user(self, data: UserUpdate) -> Optional[User]:
-        return self.crud.update_user(data=data)
+    async def update_user(self, data: UserUpdate) -> Optional[User]:
+        return await self.crud.update_user(data=data)
 
-    def authenticate_user(self, username: str, password: str) -> Optional[User]:
-        user = self.get_user_by_username(username=username)
+    async def deactivate_user(self, id: int) -> Optional[schemas.User]:
+        return await self.crud.set_active(id=id, is_active=False)
+
+    async def authenticate_user(self, username: str, password: str) -> Optional[User]:
+        user = await self.get_user_by_username(username=username)
         if not user:
             return None
-        if not self._verify_password(
-            plain_password=password, hashed_password=user.hashed_password
-        ):
+        # Hand the connection back to the pool rather than holding it while bcrypt runs
+        await self.crud.session.close()
+        verified, new_hash = await get_password_hasher().verify_and_update(
+            password, user.hashed_password
+        )
+        if not verified:
             return None
+        # The stored hash predates the current cost settings
+        if new_hash:
+            await self.crud.update_password(id=user.id, hashed_password=new_hash)
         return user
 
-    def _get_password_hash(self, password: str) -> str:
-        return pwd_context.hash(password)
-
-    def _verify_password(self, plain_password: str, hashed_password: str) -> bool:
-        return pwd_context.verify(plain_password, hashed_password)
-
 
 class UserCRUD:
-    def __init__(self, session: Session):
+    def __init__(self, session: AsyncSession):
         self.session = session
 
-    def get_users(self, roles: Iterable[Role]):
-        stmt = select(User).where(User.role.in_(roles))
-        return self.session.scalars(stmt).all()
-
-    def get_user_by_username(self, username: str) -> Optional[User]:
+    async def get_users(
+        self, roles: Iterable[Role], limit: int, after_id: Optional[int] = None
+    ) -> list[schemas.User]:
+        stmt = (
+            select(*USER_COLUMNS)
+            .where(User.role.in_(roles))
+            .order_by(User.id)
+            .limit(limit)
+        )
+        if after_id is not None:
+            stmt = stmt.where(User.id > after_id)
+        # Column types already match the schema, so rows skip validation
+        return [
+            schemas.User.model_construct(**row._mapping)
+            for row in await self.session.execute(stmt)
+        ]
+
+    async def get_user_by_username(self, username: str) -> Optional[User]:
         stmt = select(User).where(User.username == username)
-        return self.session.scalars(stmt).first()
+        return (await self.session.scalars(stmt)).first()
+
+    async def get_principal(self, username: str) -> Optional[schemas.User]:
+        stmt = select(*USER_COLUMNS).where(User.username == username)
+        row = (await self.session.execute(stmt)).first()
+        return schemas.User.model_construct(**row._mapping) if row else None
 
-    def get_user_by_id(self, id: int) -> Optional[User]:
+    async def get_user_by_id(self, id: int) -> Optional[User]:
+        # selectinload fetches the books in a second query, rather than
+        # repeating the user's columns on every joined book row
         stmt = (
-            select(User).options(joinedload(User.borrowed_books)).where(User.id == id)
+            select(User).options(selectinload(User.borrowed_books)).where(User.id == id)
+        )
+        return (await self.session.scalars(stmt)).first()
+
+    async def get_user_detail(self, id: int) -> Optional[schemas.UserDetail]:
+        row = (
+            await self.session.execute(select(*USER_COLUMNS).where(User.id == id))
+        ).first()
+        if not row:
+            return None
+        books = await self.session.execute(
+            select(*BOOK_COLUMNS)
+            .join(user_books_association)
+            .where(user_books_association.c.user_id == id)
+            .order_by(Book.id)
+        )
+        return schemas.UserDetail.model_construct(
+            **row._mapping,
+            borrowed_books=[
+                schemas.Book.model_construct(**book._mapping) for book in books
+            ],
         )
-        return self.session.scalars(stmt).first()
 
-    def create_user(
+    async def create_user(
         self,
         username: str,
         hashed_password: str,
@@ -103,15 +191,36 @@ class UserCRUD:
             role=role,
         )
         self.session.add(user)
-        self.session.commit()
-        self.session.refresh(user)
+        await self.session.commit()
+        await self.session.refresh(user)
         return user
 
-    def update_user(self, data: UserUpdate) -> Optional[User]:
-        user = self.get_user_by_id(id=data.id)
+    async def update_password(self, id: int, hashed_password: str) -> None:
+        stmt = update(User).where(User.id == id).values(hashed_password=hashed_password)
+        await self.session.execute(stmt)
+        await self.session.commit()
+
+    async def update_user(self, data: UserUpdate) -> Optional[User]:
+        user = await self.get_user_by_id(id=data.id)
         if not user:
             return None
         user.borrowed_books = data.borrowed_books
-        self.session.commit()
-        self.session.refresh(user)
+        await self.session.commit()
+        await self.session.refresh(user)
         return user
+
+    async def set_active(self, id: int, is_active: bool) -> Optional[schemas.User]:
+        stmt = (
+            update(User)
+            .where(User.id == id)
+            .values(is_active=is_active)
+            .returning(*USER_COLUMNS)
+        )
+        row = (await self.session.execute(stmt)).first()
+        if not row:
+            await self.session.rollback()
+            return None
+        # Otherwise the user stays signed in on every worker until the TTL runs out
+        await invalidate_principals(self.session, [row.username])
+        await self.session.commit()
+        return schemas.User.model_construct(**row._mapping)
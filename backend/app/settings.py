@@ -1,4 +1,5 @@
 from functools import lru_cache
+from typing import Literal, Optional
 
 from pydantic import (
     PostgresDsn,
@@ -15,12 +16,92 @@ class Settings(BaseSettings):
     FIRST_SUPERUSER_USERNAME: str
     FIRST_SUPERUSER_PASSWORD: str
 
+    # Changing the cost rehashes stored passwords on their owner's next login
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 2
+    # Hashes allowed to wait for a worker before new ones are rejected
+    PASSWORD_HASH_QUEUE_SIZE: int = 16
+
+    # Bounds how long a change to a user can go unseen by a worker the
+    # invalidation bus doesn't reach
+    PRINCIPAL_CACHE_TTL_SECONDS: float = 30
+    PRINCIPAL_CACHE_SIZE: int = 10_000
+    BOOK_CACHE_TTL_SECONDS: float = 60
+    BOOK_CACHE_SIZE: int = 10_000
+    # 'postgres' shares invalidations between workers over LISTEN/NOTIFY
+    CACHE_INVALIDATION_BACKEND: Literal["local", "postgres"] = "local"
+    # Book and loan changes pushed to /feed/availability; each worker that
+    # serves the feed holds one listening connection
+    AVAILABILITY_FEED: bool = True
+    # Events kept per worker for clients that reconnect with Last-Event-ID
+    AVAILABILITY_FEED_BUFFER_SIZE: int = 10_000
+    # Events a subscriber may fall behind by before it is disconnected
+    AVAILABILITY_FEED_QUEUE_SIZE: int = 1000
+
+    # Rows validated and inserted per transaction by the bulk book import
+    IMPORT_BATCH_SIZE: int = 1000
+    EXPORT_CHUNK_SIZE: int = 1000
+    # 0 disables the in-process scan, e.g. when it runs from cron via the CLI
+    OVERDUE_SCAN_INTERVAL_SECONDS: float = 300
+    OVERDUE_SCAN_BATCH_SIZE: int = 500
+    # Returned loans older than this many days move to loan_history; the
+    # interval works as the overdue scan's does
+    LOAN_ARCHIVE_AFTER_DAYS: int = 365
+    LOAN_ARCHIVE_INTERVAL_SECONDS: float = 3600
+    LOAN_ARCHIVE_BATCH_SIZE: int = 5000
+    # Responses to requests with an Idempotency-Key are replayed for this long
+    IDEMPOTENCY_KEY_TTL_SECONDS: float = 24 * 3600
+    IDEMPOTENCY_PURGE_INTERVAL_SECONDS: float = 3600
+    # How long a retry waits for the request holding its key before a 409
+    IDEMPOTENCY_WAIT_SECONDS: float = 10
+    # Serialize read endpoints with precompiled adapters instead of response_model
+    FAST_JSON_RESPONSES: bool = False
+
     POSTGRES_SERVER: str
     POSTGRES_PORT: int
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
     POSTGRES_DB: str
 
+    # Worker processes started by `python -m app.server`; the name is the one
+    # uvicorn and gunicorn read too
+    WEB_CONCURRENCY: int = 1
+    # Seconds a stopping worker waits for in-flight requests to finish
+    SHUTDOWN_TIMEOUT_SECONDS: float = 30
+    # Connections this instance may hold across all its workers; overrides
+    # DB_MAX_OVERFLOW, see app.db.pool_limits
+    DB_CONNECTION_BUDGET: Optional[int] = None
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    # Seconds to wait for a pooled connection before giving up
+    DB_POOL_TIMEOUT: float = 30
+    # Seconds after which connections are replaced; -1 keeps them indefinitely
+    DB_POOL_RECYCLE: int = -1
+    DB_POOL_PRE_PING: bool = False
+    DB_STATEMENT_TIMEOUT_MS: Optional[int] = None
+    # Streaming replicas for the read-only routes, as SQLAlchemy URLs in a JSON
+    # list; each gets a pool of the same size as the primary's
+    DB_REPLICA_URIS: list[str] = []
+    # Replicas further behind than this are skipped until they catch up
+    DB_REPLICA_MAX_LAG_SECONDS: float = 2
+    DB_REPLICA_CHECK_SECONDS: float = 2
+    # After a write, the user reads from the primary for this long; keep it
+    # above the maximum lag plus the check interval
+    READ_YOUR_WRITES_SECONDS: float = 5
+    # Server-Timing header and a profile log line per request
+    REQUEST_PROFILING: bool = True
+    SLOW_QUERY_MS: float = 200
+    # Share of requests run under cProfile; kept if slower than the budget
+    PROFILE_SAMPLE_RATE: float = 0.0
+    PROFILE_LATENCY_BUDGET_MS: float = 500
+    PROFILE_DIR: str = "profiles"
+    # Shared by the workers of one host so any of them can report for all;
+    # clear it before starting them. Unset, each worker reports only itself.
+    METRICS_DIR: Optional[str] = None
+    METRICS_FLUSH_SECONDS: float = 5
+    # If set, /metrics requires it as a bearer token
+    METRICS_TOKEN: Optional[str] = None
+
     @computed_field  # type: ignore[prop-decorator]
     @property
     def SQLALCHEMY_DATABASE_URI(self) -> PostgresDsn:
@@ -33,6 +114,11 @@ class Settings(BaseSettings):
             path=self.POSTGRES_DB,
         )
 
+    @property
+    def PSYCOPG_DATABASE_URI(self) -> str:
+        """The database URI without SQLAlchemy's driver suffix, for psycopg itself."""
+        return str(self.SQLALCHEMY_DATABASE_URI).replace("+psycopg", "", 1)
+
 
 @lru_cache
 def get_settings() -> Settings:
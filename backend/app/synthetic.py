@@ -0,0 +1,325 @@
+"""Generate a large, realistic dataset from a fixed seed and bulk load it.
+
+The same arguments always produce the same rows. Borrowing follows a power
+law, so a few titles and a few readers account for most loans, and loan ids
+increase with their loan date as they would in production. Everything is
+written with COPY in one transaction.
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+from typing import Iterable, Iterator, Optional, Sequence
+
+import psycopg
+from psycopg import sql
+
+from app.feed import CHANNEL
+from app.models import LOAN_PERIOD, Role
+from app.schemas import SeedReport
+from app.security import get_password_hasher
+from app.settings import get_settings
+
+# Loans drawn at a time
+DRAW_SIZE = 10_000
+HISTORY = timedelta(days=3 * 365)
+MEAN_LOAN_DAYS = 9
+# Exponents of the popularity power laws; higher is more skewed
+BOOK_POPULARITY = 1.0
+READER_ACTIVITY = 0.7
+AUTHOR_OUTPUT = 1.1
+
+WORDS = (
+    "river stone garden winter shadow silver glass harbour orchard lantern "
+    "mountain letter island forest memory kingdom ember tide meadow archive "
+    "clock feather crown echo north summer paper salt thread violet"
+).split()
+ADJECTIVES = (
+    "silent hidden last little broken golden distant quiet wild secret "
+    "burning empty forgotten long midnight scarlet hollow bright"
+).split()
+FIRST_NAMES = (
+    "Ada Ben Clara Dev Elena Farid Grace Hugo Ines Jonas Kiri Leo Maya Nils "
+    "Olga Priya Quinn Rosa Sami Tomas Uma Vera Wen Yusuf Zoe"
+).split()
+LAST_NAMES = (
+    "Abara Berg Costa Dahl Ek Fischer Gupta Hale Ivanova Jensen Kato Lund "
+    "Moreau Novak Okafor Park Quist Rossi Sato Torres Ueda Varga Weber Young"
+).split()
+
+
+def power_law_weights(n: int, exponent: float) -> list[float]:
+    """Cumulative weights where the k-th most popular item has weight 1/k^exponent."""
+    return list(accumulate(1 / (rank**exponent) for rank in range(1, n + 1)))
+
+
+def popularity_order(rng: random.Random, n: int) -> list[int]:
+    # Shuffled so that popularity isn't tied to id order
+    order = list(range(n))
+    rng.shuffle(order)
+    return order
+
+
+def book_rows(
+    rng: random.Random, copies: Sequence[int], authors: int
+) -> Iterator[tuple]:
+    author_names = [
+        f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}"
+        for i in range(authors)
+    ]
+    author_order = popularity_order(rng, authors)
+    picks = rng.choices(
+        author_order,
+        cum_weights=power_law_weights(authors, AUTHOR_OUTPUT),
+        k=len(copies),
+    )
+    for index, author in enumerate(picks):
+        words = rng.sample(WORDS, rng.randint(1, 3))
+        title = " ".join([rng.choice(ADJECTIVES), *words]).title()
+        description = None
+        if rng.random() < 0.3:
+            description = f"A {rng.choice(ADJECTIVES)} story of {' and '.join(words)}."
+        yield f"The {title}", author_names[author], description, copies[index]
+
+
+def loan_rows(
+    rng: random.Random,
+    n: int,
+    book_ids: Sequence[int],
+    copies: Sequence[int],
+    user_ids: Sequence[int],
+    now: datetime,
+) -> Iterator[tuple]:
+    book_order = popularity_order(rng, len(book_ids))
+    book_weights = power_law_weights(len(book_ids), BOOK_POPULARITY)
+    user_order = popularity_order(rng, len(user_ids))
+    user_weights = power_law_weights(len(user_ids), READER_ACTIVITY)
+    on_loan = [0] * len(book_ids)
+    # Plain timestamps are several times cheaper to work with than datetimes
+    end = now.timestamp()
+    start = end - HISTORY.total_seconds()
+    step = HISTORY.total_seconds() / max(n, 1)
+    loan_period = LOAN_PERIOD.total_seconds()
+    mean_loan = timedelta(days=MEAN_LOAN_DAYS).total_seconds()
+    to_datetime = datetime.fromtimestamp
+    for offset in range(0, n, DRAW_SIZE):
+        k = min(DRAW_SIZE, n - offset)
+        books = rng.choices(book_order, cum_weights=book_weights, k=k)
+        users = rng.choices(user_order, cum_weights=user_weights, k=k)
+        for i, (book, user) in enumerate(zip(books, users)):
+            loaned_at = start + step * (offset + i + rng.random())
+            returned_at = loaned_at + rng.expovariate(1 / mean_loan)
+            if returned_at > end:
+                # Still out, unless every copy of the book already is
+                if on_loan[book] < copies[book]:
+                    on_loan[book] += 1
+                    returned_at = None
+                else:
+                    returned_at = loaned_at + (end - loaned_at) * rng.random()
+            yield (
+                book_ids[book],
+                user_ids[user],
+                to_datetime(loaned_at),
+                to_datetime(loaned_at + loan_period),
+                None if returned_at is None else to_datetime(returned_at),
+            )
+
+
+async def copy_rows(
+    conn: psycopg.AsyncConnection,
+    statement: str,
+    rows: Iterable[tuple],
+    types: Optional[Sequence[str]] = None,
+) -> None:
+    """COPY the rows in, in binary if the column types are given."""
+    async with conn.cursor() as cursor:
+        async with cursor.copy(statement) as copy:
+            if types:
+                copy.set_types(types)
+            for row in rows:
+                await copy.write_row(row)
+
+
+async def drop_secondary_indexes(
+    conn: psycopg.AsyncConnection, table: str
+) -> list[sql.Composable]:
+    """Drop the table's foreign keys and non-unique indexes.
+
+    Returns the statements that put them back. Building them once after a bulk
+    load is several times faster than maintaining them row by row.
+    """
+    cursor = await conn.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype = 'f'",
+        (table,),
+    )
+    foreign_keys = await cursor.fetchall()
+    cursor = await conn.execute(
+        "SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index "
+        "WHERE indrelid = %s::regclass AND NOT indisunique",
+        (table,),
+    )
+    indexes = await cursor.fetchall()
+    restore: list[sql.Composable] = []
+    for name, definition in foreign_keys:
+        await conn.execute(
+            sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+                sql.Identifier(table), sql.Identifier(name)
+            )
+        )
+        restore.append(
+            sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+                sql.Identifier(table), sql.Identifier(name), sql.SQL(definition)
+            )
+        )
+    for name, definition in indexes:
+        # Already quoted where needed, as regclass names are
+        await conn.execute(sql.SQL("DROP INDEX {}").format(sql.SQL(name)))
+        restore.append(sql.SQL(definition))
+    return restore
+
+
+async def new_ids(conn: psycopg.AsyncConnection, table: str, after: int) -> list[int]:
+    # One COPY draws its ids from the sequence in row order
+    cursor = await conn.execute(
+        f"SELECT id FROM {table} WHERE id > %s ORDER BY id", (after,)
+    )
+    return [id for (id,) in await cursor.fetchall()]
+
+
+async def max_id(conn: psycopg.AsyncConnection, table: str) -> int:
+    cursor = await conn.execute(f"SELECT coalesce(max(id), 0) FROM {table}")
+    return (await cursor.fetchone())[0]
+
+
+async def seed(
+    books: int,
+    users: int,
+    loans: int,
+    seed: int,
+    username_prefix: str,
+    password: str,
+) -> SeedReport:
+    """Add `users` readers, `books` books and `loans` loans over the last three years.
+
+    Open loans take a copy of their book and appear in the reader's borrowed
+    books, as if they had been checked out through the API. Raises ValueError
+    if readers with the prefix already exist.
+    """
+    if loans and not (books and users):
+        raise ValueError("Loans need at least one book and one reader")
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    now = datetime.now().replace(microsecond=0)
+    # Hashing once keeps the seed fast; every reader shares the password
+    hashed_password = await get_password_hasher().hash(password)
+    copies = rng.choices([1, 2, 3, 5, 10], weights=[40, 25, 15, 12, 8], k=books)
+
+    async with await psycopg.AsyncConnection.connect(
+        get_settings().PSYCOPG_DATABASE_URI
+    ) as conn:
+        cursor = await conn.execute(
+            "SELECT 1 FROM users WHERE starts_with(username, %s) LIMIT 1",
+            (username_prefix,),
+        )
+        if await cursor.fetchone():
+            raise ValueError(f"Readers named '{username_prefix}...' already exist")
+
+        first_user = await max_id(conn, "users")
+        await copy_rows(
+            conn,
+            "COPY users (username, hashed_password, is_active, is_superuser, role) "
+            "FROM STDIN",
+            (
+                (
+                    f"{username_prefix}{i}",
+                    hashed_password,
+                    True,
+                    False,
+                    Role.READER.name,
+                )
+                for i in range(1, users + 1)
+            ),
+        )
+        user_ids = await new_ids(conn, "users", after=first_user)
+
+        first_book = await max_id(conn, "books")
+        # Including the search indexes; a GIN index is far cheaper built once
+        restore_books = await drop_secondary_indexes(conn, "books")
+        await copy_rows(
+            conn,
+            "COPY books (title, author, description, available_copies) FROM STDIN",
+            book_rows(rng, copies, authors=max(books // 8, 1)),
+        )
+        book_ids = await new_ids(conn, "books", after=first_book)
+
+        # Takes an exclusive lock on loans until the seed commits
+        restore_loans = await drop_secondary_indexes(conn, "loans")
+        await copy_rows(
+            conn,
+            "COPY loans (book_id, user_id, loaned_at, due_date, returned_at) "
+            "FROM STDIN (FORMAT BINARY)",
+            loan_rows(rng, loans, book_ids, copies, user_ids, now),
+            types=["int4", "int4", "timestamp", "timestamp", "timestamp"],
+        )
+        await conn.execute("SET LOCAL maintenance_work_mem = '512MB'")
+        for statement in restore_loans:
+            await conn.execute(statement)
+        # Bring the copies and borrowed books in line with the open loans
+        await conn.execute(
+            """
+            UPDATE books SET available_copies = available_copies - open.n
+            FROM (
+                SELECT book_id, count(*) AS n FROM loans
+                WHERE returned_at IS NULL AND book_id > %(first_book)s
+                GROUP BY book_id
+            ) AS open
+            WHERE books.id = open.book_id
+            """,
+            {"first_book": first_book},
+        )
+        await conn.execute(
+            """
+            INSERT INTO user_books (user_id, book_id)
+            SELECT DISTINCT user_id, book_id FROM loans
+            WHERE returned_at IS NULL AND book_id > %(first_book)s
+            ON CONFLICT DO NOTHING
+            """,
+            {"first_book": first_book},
+        )
+        # After the update above, so that it doesn't write to them either
+        for statement in restore_books:
+            await conn.execute(statement)
+        cursor = await conn.execute(
+            "SELECT count(*) FROM loans WHERE returned_at IS NULL AND book_id > %s",
+            (first_book,),
+        )
+        open_loans = (await cursor.fetchone())[0]
+        # Seeded loans fell due in the past, behind where the overdue scan
+        # got to, so it starts over; loans already notified are skipped
+        await conn.execute(
+            "UPDATE overdue_scan_cursor SET due_date = NULL, loan_id = NULL "
+            "WHERE id = 1"
+        )
+        # Availability feed subscribers refetch what the load changed
+        await conn.execute(
+            "SELECT pg_notify(%s, json_build_object("
+            "'id', pg_current_xact_id()::text, 'reset', true)::text)",
+            (CHANNEL,),
+        )
+        await conn.commit()
+
+        # Statistics and visibility maps, so the first queries plan and run
+        # as they would on a settled database
+        await conn.set_autocommit(True)
+        for table in ("users", "books", "loans", "user_books"):
+            await conn.execute(f"VACUUM ANALYZE {table}")
+
+    return SeedReport(
+        users=len(user_ids),
+        books=len(book_ids),
+        loans=loans,
+        open_loans=open_loans,
+        seconds=round(time.perf_counter() - started, 1),
+    )
@@ -0,0 +1,368 @@
+"""Drive the main endpoints at fixed concurrency and compare against a baseline.
+
+Run from backend/, against a database that is safe to write to:
+
+    python -m benchmarks.endpoints --save-baseline   # record benchmarks/baseline.json
+    python -m benchmarks.endpoints                   # compare, exit 1 on regression
+
+The app runs in process behind an ASGI transport, so the numbers measure the
+app and the database rather than a network stack. Synthetic readers and books
+are added on the first run and reused afterwards; every checkout made is
+returned again, so repeated runs leave the dataset as they found it.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+# Background jobs would add their queries to whichever scenario they overlap
+os.environ.setdefault("OVERDUE_SCAN_INTERVAL_SECONDS", "0")
+os.environ.setdefault("LOAN_ARCHIVE_INTERVAL_SECONDS", "0")
+os.environ.setdefault("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "0")
+
+import httpx  # noqa: E402
+from sqlalchemy import event, func, select, text  # noqa: E402
+
+from app.db import get_engine, get_sessionmaker, migrate_db  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import Book, User  # noqa: E402
+from app.replicas import get_replica_set  # noqa: E402
+from app.security import get_password_hasher  # noqa: E402
+
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+USERNAME_PREFIX = "bench-"
+PASSWORD = "bench-password"
+# Metrics where a larger number is worse; throughput is the other way round
+HIGHER_IS_WORSE = ("p50_ms", "p95_ms", "p99_ms", "queries_per_request")
+COMPARED = ("p95_ms", "throughput_rps", "queries_per_request")
+
+
+@dataclass
+class Result:
+    scenario: str
+    concurrency: int
+    requests: int
+    errors: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    throughput_rps: float
+    queries_per_request: float
+
+    @property
+    def key(self) -> str:
+        return f"{self.scenario}@{self.concurrency}"
+
+
+@dataclass
+class Dataset:
+    usernames: list[str]
+    user_ids: list[int]
+    book_ids: list[int]
+    tokens: dict[int, str]
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args) -> None:
+        self.count += 1
+
+
+async def seed(users: int, books: int) -> None:
+    """Add any missing synthetic readers and books, sharing one password hash."""
+    hashed_password = await get_password_hasher().hash(PASSWORD)
+    async with get_sessionmaker()() as session:
+        await session.execute(
+            text(
+                """
+                INSERT INTO users
+                    (username, hashed_password, is_active, is_superuser, role)
+                SELECT :prefix || g, :hashed_password, true, false, 'READER'
+                FROM generate_series(1, :n) g
+                ON CONFLICT (username) DO NOTHING
+                """
+            ),
+            {"prefix": USERNAME_PREFIX, "hashed_password": hashed_password, "n": users},
+        )
+        existing = await session.scalar(
+            select(func.count())
+            .select_from(Book)
+            .where(Book.title.startswith("Bench "))
+        )
+        await session.execute(
+            text(
+                """
+                INSERT INTO books (title, author, available_copies)
+                SELECT 'Bench ' || g, 'Bench author ' || g % 100, 1000
+                FROM generate_series(CAST(:start AS integer), :n) g
+                """
+            ),
+            {"start": existing + 1, "n": books},
+        )
+        await session.commit()
+        for table in ("users", "books", "loans", "user_books"):
+            await session.execute(text(f"ANALYZE {table}"))
+
+
+async def load_dataset(client: httpx.AsyncClient, users: int, books: int) -> Dataset:
+    async with get_sessionmaker()() as session:
+        rows = (
+            await session.execute(
+                select(User.id, User.username)
+                .where(User.username.startswith(USERNAME_PREFIX))
+                .order_by(User.id)
+                .limit(users)
+            )
+        ).all()
+        book_ids = (
+            await session.scalars(
+                select(Book.id)
+                .where(Book.title.startswith("Bench "))
+                .order_by(Book.id)
+                .limit(books)
+            )
+        ).all()
+    tokens = {}
+    for id, username in rows[:50]:
+        response = await client.post(
+            "/login/", data={"username": username, "password": PASSWORD}
+        )
+        response.raise_for_status()
+        tokens[id] = response.json()["access_token"]
+    return Dataset(
+        usernames=[username for _, username in rows],
+        user_ids=[id for id, _ in rows],
+        book_ids=list(book_ids),
+        tokens=tokens,
+    )
+
+
+async def run_scenario(
+    name: str,
+    concurrency: int,
+    requests: int,
+    call: Callable[[int], Awaitable[httpx.Response]],
+) -> Result:
+    latencies: list[float] = []
+    errors = 0
+    next_index = 0
+    counter = QueryCounter()
+
+    async def worker() -> None:
+        nonlocal errors, next_index
+        while next_index < requests:
+            index = next_index
+            next_index += 1
+            start = time.perf_counter()
+            response = await call(index)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    # Reads routed to replicas count as much as those on the primary
+    engines = [get_engine()] + [r.engine for r in get_replica_set().replicas]
+    for engine in engines:
+        event.listen(engine.sync_engine, "before_cursor_execute", counter)
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    finally:
+        for engine in engines:
+            event.remove(engine.sync_engine, "before_cursor_execute", counter)
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return Result(
+        scenario=name,
+        concurrency=concurrency,
+        requests=requests,
+        errors=errors,
+        p50_ms=round(percentiles[49] * 1000, 2),
+        p95_ms=round(percentiles[94] * 1000, 2),
+        p99_ms=round(percentiles[98] * 1000, 2),
+        throughput_rps=round(requests / elapsed, 1),
+        queries_per_request=round(counter.count / requests, 2),
+    )
+
+
+async def run(
+    concurrency_levels: list[int], requests: int, users: int, books: int, seed_rng: int
+) -> list[Result]:
+    rng = random.Random(seed_rng)
+    await migrate_db()
+    transport = httpx.ASGITransport(app=app)
+    async with (
+        app.router.lifespan_context(app),
+        httpx.AsyncClient(transport=transport, base_url="http://bench") as client,
+    ):
+        await seed(users=users, books=books)
+        data = await load_dataset(client, users=users, books=books)
+        readers = list(data.tokens)
+
+        def auth(user_id: int) -> dict[str, str]:
+            return {"Authorization": f"Bearer {data.tokens[user_id]}"}
+
+        results = []
+        for concurrency in concurrency_levels:
+            # A fixed seed gives every run the same workload
+            borrowers = [rng.choice(readers) for _ in range(requests)]
+            book_picks = [rng.choice(data.book_ids) for _ in range(requests)]
+            loans: list[tuple[int, int]] = []
+
+            async def login(i: int) -> httpx.Response:
+                username = data.usernames[i % len(data.usernames)]
+                return await client.post(
+                    "/login/", data={"username": username, "password": PASSWORD}
+                )
+
+            async def list_books(i: int) -> httpx.Response:
+                return await client.get(
+                    "/books/", params={"limit": 50}, headers=auth(borrowers[i])
+                )
+
+            async def book_detail(i: int) -> httpx.Response:
+                return await client.get(
+                    f"/books/{book_picks[i]}", headers=auth(borrowers[i])
+                )
+
+            async def checkout(i: int) -> httpx.Response:
+                response = await client.post(
+                    "/loans/",
+                    json={"book_id": book_picks[i], "user_id": borrowers[i]},
+                    headers=auth(borrowers[i]),
+                )
+                if response.status_code == 200:
+                    loans.append((response.json()["id"], borrowers[i]))
+                return response
+
+            async def return_loan(i: int) -> httpx.Response:
+                id, user_id = loans[i]
+                return await client.patch(
+                    "/loans/",
+                    json={"id": id, "returned_at": datetime.now().isoformat()},
+                    headers=auth(user_id),
+                )
+
+            for name, call in (
+                ("login", login),
+                ("list_books", list_books),
+                ("book_detail", book_detail),
+                ("checkout", checkout),
+            ):
+                results.append(await run_scenario(name, concurrency, requests, call))
+            if loans:
+                results.append(
+                    await run_scenario("return", concurrency, len(loans), return_loan)
+                )
+        return results
+
+
+def compare(
+    results: list[Result], baseline: dict[str, dict], threshold: float
+) -> list[str]:
+    """Describe each compared metric that is more than `threshold` worse than baseline.
+
+    Any rise in errors counts, whatever the threshold: a run that got faster
+    by failing requests is not an improvement.
+    """
+    regressions = []
+    for result in results:
+        previous = baseline.get(result.key)
+        if previous is None:
+            continue
+        if result.errors > previous["errors"]:
+            regressions.append(
+                f"{result.key} errors: {previous['errors']} -> {result.errors}"
+            )
+        for metric in COMPARED:
+            old, new = previous[metric], getattr(result, metric)
+            if not old:
+                continue
+            change = (new - old) / old
+            if metric not in HIGHER_IS_WORSE:
+                change = -change
+            if change > threshold:
+                regressions.append(
+                    f"{result.key} {metric}: {old} -> {new} ({change:+.0%} worse)"
+                )
+    return regressions
+
+
+def print_results(results: list[Result]) -> None:
+    print(
+        f"{'scenario':<16}{'conc':>5}{'reqs':>6}{'errors':>7}{'p50 ms':>9}"
+        f"{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'queries':>9}"
+    )
+    for r in results:
+        print(
+            f"{r.scenario:<16}{r.concurrency:>5}{r.requests:>6}{r.errors:>7}"
+            f"{r.p50_ms:>9}{r.p95_ms:>9}{r.p99_ms:>9}{r.throughput_rps:>9}"
+            f"{r.queries_per_request:>9}"
+        )
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1, 8, 32],
+        help="Comma-separated concurrency levels",
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--books", type=int, default=5_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Fractional change counted as a regression",
+    )
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--output", type=Path, help="Also write this run's results")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(
+        run(
+            concurrency_levels=args.concurrency,
+            requests=args.requests,
+            users=args.users,
+            books=args.books,
+            seed_rng=args.seed,
+        )
+    )
+    print_results(results)
+    report = {result.key: asdict(result) for result in results}
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+        return
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}; run with --save-baseline first")
+        return
+    regressions = compare(
+        results, json.loads(args.baseline.read_text()), args.threshold
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
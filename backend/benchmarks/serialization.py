@@ -0,0 +1,60 @@
+"""Per-row cost of serializing a page of books, default path vs fast path.
+
+Run from backend/: python -m benchmarks.serialization [--rows N]
+
+The default path mirrors FastAPI's response_model handling: validate, dump to
+Python objects in JSON mode, then json.dumps as JSONResponse does. The fast
+path is what app.api.responses.render does with FAST_JSON_RESPONSES on.
+"""
+
+import argparse
+import json
+import timeit
+
+from app import schemas
+from app.api.responses import get_adapter
+
+
+def make_page(rows: int) -> dict:
+    books = [
+        schemas.Book.model_construct(
+            id=id,
+            title=f"Book {id}",
+            author=f"Author {id % 100}",
+            description="A description long enough to be representative " * 2,
+            available_copies=id % 5,
+        )
+        for id in range(1, rows + 1)
+    ]
+    return {"items": books, "next_cursor": None}
+
+
+def default_path(page: dict) -> bytes:
+    adapter = get_adapter(schemas.Page[schemas.Book])
+    value = adapter.validate_python(page, from_attributes=True)
+    content = adapter.dump_python(value, mode="json")
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def fast_path(page: dict) -> bytes:
+    adapter = get_adapter(schemas.Page[schemas.Book])
+    return adapter.dump_json(adapter.validate_python(page, from_attributes=True))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    page = make_page(args.rows)
+    assert json.loads(default_path(page)) == json.loads(fast_path(page))
+    for name, path in (("default", default_path), ("fast", fast_path)):
+        best = min(timeit.repeat(lambda: path(page), number=1, repeat=args.repeat))
+        print(f"{name:>8}: {best * 1e6 / args.rows:6.2f} us/row")
+
+
+if __name__ == "__main__":
+    main()
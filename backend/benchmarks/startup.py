@@ -0,0 +1,106 @@
+"""Time how long a production worker takes to start serving, against a budget.
+
+Run from backend/, with the database settings in the environment:
+
+    python -m benchmarks.startup                  # exit 1 if over the budget
+    python -m benchmarks.startup --budget-ms 2000
+
+Each run starts the server the way the image does, without the reloader, and
+measures from process start to the first successful /health response. The
+import of app.main on its own is timed as well, since it is most of the cost.
+"""
+
+import argparse
+import json
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+IMPORT_SCRIPT = (
+    "import time; start = time.perf_counter(); import app.main; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_import() -> float:
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def time_to_ready(timeout: float) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [
+            *(sys.executable, "-m", "app.server"),
+            *("--host", "127.0.0.1", "--port", str(port)),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"Server exited with {server.returncode}")
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError(f"Server not ready after {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=3000,
+        help="Largest acceptable median time to the first response",
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", type=Path, help="Also write the results")
+    args = parser.parse_args(argv)
+
+    # The first run also warms the bytecode and filesystem caches
+    time_to_ready(args.timeout)
+    imports = [time_import() for _ in range(args.runs)]
+    ready = [time_to_ready(args.timeout) for _ in range(args.runs)]
+    report = {
+        "import_ms": round(statistics.median(imports) * 1000, 1),
+        "ready_ms": round(statistics.median(ready) * 1000, 1),
+        "ready_max_ms": round(max(ready) * 1000, 1),
+        "budget_ms": args.budget_ms,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+    if report["ready_ms"] > args.budget_ms:
+        print(f"OVER BUDGET: ready in {report['ready_ms']}ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import httpx
+import pytest
+
+from app.models import Book
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_list_etag_follows_page(client: httpx.AsyncClient, reader, book: Book):
+    params = {"title": book.title}
+    first = await client.get("/books/", params=params, headers=reader.headers)
+    etag = first.headers["ETag"]
+    unchanged = await client.get(
+        "/books/", params=params, headers={**reader.headers, "If-None-Match": etag}
+    )
+    assert unchanged.status_code == 304
+
+    checkout = await client.post(
+        "/loans/",
+        json={"book_id": book.id, "user_id": reader.id},
+        headers=reader.headers,
+    )
+    assert checkout.status_code == 200
+    changed = await client.get(
+        "/books/", params=params, headers={**reader.headers, "If-None-Match": etag}
+    )
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()["items"] == [
+        {**first.json()["items"][0], "available_copies": 4}
+    ]
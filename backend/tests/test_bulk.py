@@ -0,0 +1,45 @@
+import pytest
+
+from app.bulk import NOT_UTF8, iter_csv_records, iter_ndjson_records
+
+pytestmark = pytest.mark.anyio
+
+
+async def chunks(data: bytes, size: int = 7):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+async def records(parse, data: bytes) -> list:
+    return [record async for record in parse(chunks(data))]
+
+
+async def test_csv_quoted_fields_span_lines():
+    data = (
+        b'title,author\r\n"Line one\nline two",Someone\r\n\r\nPlain,"Quoted, comma"\n'
+    )
+    assert await records(iter_csv_records, data) == [
+        (2, {"title": "Line one\nline two", "author": "Someone"}),
+        (5, {"title": "Plain", "author": "Quoted, comma"}),
+    ]
+
+
+async def test_csv_quote_inside_unquoted_field():
+    data = b'title,author\n12" Single,Someone\nNext,Else\n'
+    assert await records(iter_csv_records, data) == [
+        (2, {"title": '12" Single', "author": "Someone"}),
+        (3, {"title": "Next", "author": "Else"}),
+    ]
+
+
+async def test_invalid_utf8_rejects_only_its_record():
+    data = b"title,author\nBad \xff title,Someone\nGood,Else\n"
+    assert await records(iter_csv_records, data) == [
+        (2, NOT_UTF8),
+        (3, {"title": "Good", "author": "Else"}),
+    ]
+    data = b'{"title": "Bad \xff"}\n{"title": "Good"}\n'
+    assert await records(iter_ndjson_records, data) == [
+        (1, NOT_UTF8),
+        (2, '{"title": "Good"}'),
+    ]
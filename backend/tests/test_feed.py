@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import psycopg
+import pytest
+
+from app.db import get_sessionmaker
+from app.feed import (
+    CHANNEL,
+    MAX_EVENT_ITEMS,
+    AvailabilityFeed,
+    publish_availability,
+)
+from app.models import Book
+from app.settings import get_settings
+
+pytestmark = pytest.mark.anyio
+
+
+async def published(book_ids, loans) -> dict:
+    """The event a write announcing `book_ids` and `loans` sends on commit."""
+    async with await psycopg.AsyncConnection.connect(
+        get_settings().PSYCOPG_DATABASE_URI, autocommit=True
+    ) as conn:
+        await conn.execute(f"LISTEN {CHANNEL}")
+        async with get_sessionmaker()() as session:
+            await publish_availability(session, book_ids, loans)
+            await session.commit()
+        async for notify in conn.notifies(timeout=5, stop_after=1):
+            return json.loads(notify.payload)
+    raise AssertionError("No event was sent")
+
+
+async def test_event_carries_copies_and_loans(client, book: Book):
+    event = await published([book.id], [(1, book.id, "checkout")])
+    assert event["books"] == [{"id": book.id, "available_copies": 5}]
+    assert event["loans"] == [{"id": 1, "book_id": book.id, "event": "checkout"}]
+
+
+async def test_large_write_sends_reset(client, book: Book):
+    # A bulk return of this many loans would overflow a NOTIFY payload
+    loans = [(2**31 - 1 - i, book.id, "return") for i in range(MAX_EVENT_ITEMS * 3)]
+    event = await published([book.id], loans)
+    assert event["reset"] is True
+    assert "loans" not in event
+
+
+async def read_event(stream) -> tuple[str, str, str]:
+    """The id, name and data of the stream's next event, skipping keepalives."""
+    while True:
+        message = (await asyncio.wait_for(anext(stream), 5)).decode()
+        if not message.startswith(":"):
+            fields = dict(line.split(": ", 1) for line in message.strip().split("\n"))
+            return fields["id"], fields["event"], fields["data"]
+
+
+async def test_stream_resumes_after_last_event(client, book: Book):
+    feed = AvailabilityFeed(
+        dsn=get_settings().PSYCOPG_DATABASE_URI, buffer_size=10, queue_size=10
+    )
+    assert await feed.start(timeout=5)
+    try:
+        stream = feed.stream(after=None)
+        hello, name, _ = await read_event(stream)
+        assert name == "hello"
+        async with get_sessionmaker()() as session:
+            await publish_availability(session, [book.id])
+            await session.commit()
+        id, name, data = await read_event(stream)
+        assert name == "availability"
+        assert json.loads(data)["books"] == [{"id": book.id, "available_copies": 5}]
+        await stream.aclose()
+
+        # As a client reconnecting would
+        assert (await read_event(feed.stream(after=hello)))[0] == id
+        assert feed._backlog(after=id) == []
+        _, name, _ = await read_event(feed.stream(after="unknown"))
+        assert name == "reset"
+    finally:
+        await feed.stop()
@@ -0,0 +1,69 @@
+import asyncio
+from uuid import uuid4
+
+import httpx
+import pytest
+from sqlalchemy import func, select
+
+from app.db import get_sessionmaker
+from app.models import Book, Loan
+
+pytestmark = pytest.mark.anyio
+
+
+async def count_loans(book: Book) -> int:
+    async with get_sessionmaker()() as session:
+        return await session.scalar(
+            select(func.count()).select_from(Loan).where(Loan.book_id == book.id)
+        )
+
+
+async def test_retry_replays_response(client: httpx.AsyncClient, reader, book):
+    headers = {**reader.headers, "Idempotency-Key": str(uuid4())}
+    body = {"book_id": book.id, "user_id": reader.id}
+    first = await client.post("/loans/", json=body, headers=headers)
+    retry = await client.post("/loans/", json=body, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert await count_loans(book) == 1
+
+
+async def test_concurrent_retries_wait_for_first(
+    client: httpx.AsyncClient, reader, book
+):
+    headers = {**reader.headers, "Idempotency-Key": str(uuid4())}
+    body = {"book_id": book.id, "user_id": reader.id}
+    responses = await asyncio.gather(
+        *(client.post("/loans/", json=body, headers=headers) for _ in range(2))
+    )
+    assert [response.status_code for response in responses] == [200, 200]
+    assert responses[0].json() == responses[1].json()
+    assert await count_loans(book) == 1
+
+
+async def test_key_reused_for_other_request(client: httpx.AsyncClient, reader, book):
+    headers = {**reader.headers, "Idempotency-Key": str(uuid4())}
+    body = {"book_id": book.id, "user_id": reader.id}
+    await client.post("/loans/", json=body, headers=headers)
+    response = await client.post(
+        "/loans/", json={**body, "book_id": book.id + 1}, headers=headers
+    )
+    assert response.status_code == 422
+
+
+async def test_failed_request_can_be_retried(client: httpx.AsyncClient, reader, book):
+    headers = {**reader.headers, "Idempotency-Key": str(uuid4())}
+    body = {"book_id": book.id, "user_id": reader.id}
+    async with get_sessionmaker()() as session:
+        await session.execute(
+            Book.__table__.update().where(Book.id == book.id).values(available_copies=0)
+        )
+        await session.commit()
+    assert (await client.post("/loans/", json=body, headers=headers)).status_code == 400
+    async with get_sessionmaker()() as session:
+        await session.execute(
+            Book.__table__.update().where(Book.id == book.id).values(available_copies=1)
+        )
+        await session.commit()
+    assert (await client.post("/loans/", json=body, headers=headers)).status_code == 200
@@ -0,0 +1,38 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.models import Book
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_parallel_checkouts_by_one_reader(
+    client: httpx.AsyncClient, reader, book: Book
+):
+    checkouts = await asyncio.gather(
+        *(
+            client.post(
+                "/loans/",
+                json={"book_id": book.id, "user_id": reader.id},
+                headers=reader.headers,
+            )
+            for _ in range(book.available_copies)
+        )
+    )
+    assert [checkout.status_code for checkout in checkouts] == [200] * 5
+    after = await client.get(f"/books/{book.id}", headers=reader.headers)
+    assert after.json()["available_copies"] == 0
+
+
+async def test_checkout_for_unknown_reader(
+    client: httpx.AsyncClient, admin, book: Book
+):
+    checkout = await client.post(
+        "/loans/", json={"book_id": book.id, "user_id": 0}, headers=admin.headers
+    )
+    assert checkout.status_code == 404
+    assert checkout.json() == {"detail": "User not found"}
+    after = await client.get(f"/books/{book.id}", headers=admin.headers)
+    assert after.json()["available_copies"] == book.available_copies
@@ -0,0 +1,94 @@
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    Enum,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    make_url,
+    text,
+)
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app.db import get_alembic_config, get_engine, upgrade_schema
+from app.settings import get_settings
+
+pytestmark = pytest.mark.anyio
+
+# The schema as Base.metadata.create_all made it before there were migrations
+pre_migration = MetaData()
+Table(
+    "users",
+    pre_migration,
+    Column("id", Integer, primary_key=True),
+    Column("username", String, unique=True, nullable=False),
+    Column("hashed_password", String(255), nullable=False),
+    Column("is_active", Boolean, nullable=False),
+    Column("is_superuser", Boolean, nullable=False),
+    Column("role", Enum("ADMIN", "READER", name="role"), nullable=False),
+)
+Table(
+    "books",
+    pre_migration,
+    Column("id", Integer, primary_key=True),
+    Column("title", String, nullable=False),
+    Column("author", String, nullable=False),
+    Column("description", String),
+    Column("available_copies", Integer, nullable=False),
+)
+Table(
+    "user_books",
+    pre_migration,
+    Column("user_id", Integer, ForeignKey("users.id")),
+    Column("book_id", Integer, ForeignKey("books.id")),
+)
+Table(
+    "loans",
+    pre_migration,
+    Column("id", Integer, primary_key=True),
+    Column("book_id", Integer, ForeignKey("books.id"), nullable=False),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("loaned_at", DateTime, nullable=False),
+    Column("due_date", DateTime, nullable=False),
+    Column("returned_at", DateTime),
+)
+
+
+async def test_upgrade_adopts_create_all_schema(client):
+    from alembic.script import ScriptDirectory
+
+    head = ScriptDirectory.from_config(get_alembic_config()).get_current_head()
+    database = f"test_{uuid4().hex}"
+    admin = get_engine().execution_options(isolation_level="AUTOCOMMIT")
+    async with admin.connect() as conn:
+        await conn.execute(text(f"CREATE DATABASE {database}"))
+    url = make_url(str(get_settings().SQLALCHEMY_DATABASE_URI))
+    scratch = create_async_engine(url.set(database=database), poolclass=NullPool)
+    try:
+        async with scratch.begin() as conn:
+            await conn.run_sync(pre_migration.create_all)
+            await conn.execute(
+                text(
+                    "INSERT INTO users VALUES (1, 'old', '!', true, false, 'READER');"
+                    "INSERT INTO books VALUES (1, 'Old', 'Author', NULL, 1);"
+                    "INSERT INTO loans VALUES (1, 1, 1, now(), now(), NULL)"
+                )
+            )
+        async with scratch.begin() as conn:
+            await conn.run_sync(upgrade_schema)
+        async with scratch.connect() as conn:
+            version = await conn.scalar(text("SELECT version_num FROM alembic_version"))
+            assert version == head
+            assert await conn.scalar(text("SELECT version FROM books")) == 1
+            assert await conn.scalar(text("SELECT count(*) FROM loans")) == 1
+    finally:
+        await scratch.dispose()
+        async with admin.connect() as conn:
+            await conn.execute(text(f"DROP DATABASE {database}"))
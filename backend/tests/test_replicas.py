@@ -0,0 +1,47 @@
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.db import build_engine
+from app.replicas import Replica, ReplicaSet
+from app.settings import get_settings
+
+pytestmark = pytest.mark.anyio
+
+
+def make_replica(name: str, uri: str) -> Replica:
+    engine = build_engine(uri, get_settings(), connect_timeout=1)
+    return Replica(
+        name=name, engine=engine, sessionmaker=async_sessionmaker(bind=engine)
+    )
+
+
+async def test_check_measures_lag(client):
+    primary_uri = str(get_settings().SQLALCHEMY_DATABASE_URI)
+    # The primary stands in for a replica that is caught up
+    caught_up = make_replica("caught-up", primary_uri)
+    unreachable = make_replica(
+        "unreachable", "postgresql+psycopg://nobody:x@127.0.0.1:1/none"
+    )
+    replica_set = ReplicaSet([caught_up, unreachable], max_lag=2, window=5)
+    try:
+        await replica_set.check()
+        assert caught_up.lag == 0
+        assert unreachable.lag is None
+        assert replica_set.choose(user_id=1) is caught_up
+    finally:
+        await replica_set.dispose()
+
+
+def test_choose_skips_lagging_replicas_and_recent_writers():
+    engine = build_engine(str(get_settings().SQLALCHEMY_DATABASE_URI), get_settings())
+    replicas = [
+        Replica(name=name, engine=engine, sessionmaker=async_sessionmaker(), lag=lag)
+        for name, lag in (("behind", 10.0), ("unknown", None), ("current", 0.5))
+    ]
+    replica_set = ReplicaSet(replicas, max_lag=2, window=5)
+    assert replica_set.choose(user_id=1).name == "current"
+    replica_set.writers.invalidate(1)
+    assert replica_set.choose(user_id=1) is None
+    assert replica_set.choose(user_id=2).name == "current"
+    replicas[2].lag = float("inf")
+    assert replica_set.choose(user_id=2) is None
@@ -0,0 +1,28 @@
+from pathlib import Path
+
+import pytest
+
+from app import server
+from app.settings import get_settings
+
+
+def test_several_workers_need_shared_invalidations(monkeypatch):
+    settings = get_settings().model_copy(
+        update={"WEB_CONCURRENCY": 2, "CACHE_INVALIDATION_BACKEND": "local"}
+    )
+    monkeypatch.setattr(server, "get_settings", lambda: settings)
+    monkeypatch.setattr(server.uvicorn, "run", pytest.fail)
+    with pytest.raises(SystemExit, match="CACHE_INVALIDATION_BACKEND=postgres"):
+        server.main([])
+
+
+def test_clear_worker_metrics_keeps_other_files(tmp_path: Path):
+    for name in ("123.json", "123.tmp", "notes.json", "456.txt"):
+        (tmp_path / name).write_text("{}")
+    (tmp_path / "789.json").mkdir()
+    server.clear_worker_metrics(tmp_path)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "456.txt",
+        "789.json",
+        "notes.json",
+    ]
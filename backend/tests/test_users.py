@@ -0,0 +1,29 @@
+import httpx
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_deactivation_signs_the_user_out(
+    client: httpx.AsyncClient, reader, admin
+):
+    # Caches the reader's principal
+    assert (await client.get("/books/", headers=reader.headers)).status_code == 200
+
+    deactivated = await client.post(
+        f"/users/{reader.id}/deactivate", headers=admin.headers
+    )
+    assert deactivated.status_code == 200
+    assert deactivated.json()["is_active"] is False
+    after = await client.get("/books/", headers=reader.headers)
+    assert after.status_code == 400
+    assert after.json() == {"detail": "Inactive user"}
+
+
+async def test_only_admins_deactivate(client: httpx.AsyncClient, reader, admin):
+    forbidden = await client.post(
+        f"/users/{admin.id}/deactivate", headers=reader.headers
+    )
+    assert forbidden.status_code == 403
+    missing = await client.post("/users/0/deactivate", headers=admin.headers)
+    assert missing.status_code == 404